@@ -6,6 +6,12 @@ Created on May 6, 2014
 from __future__ import absolute_import, print_function
 from ScopeFoundry import HardwareComponent
 from collections import OrderedDict
+from contextlib import contextmanager
+import os
+import json
+import time
+import numpy as np
+from .andor_ccd_background import BackgroundLibrary
 try:
     from .andor_ccd_interface import AndorCCD, AndorReadMode, DEFAULT_TEMPERATURE
 except Exception as err:
@@ -16,7 +22,41 @@ class AndorCCDHW(HardwareComponent):
     def setup(self):
         self.name = "andor_ccd"
         self.debug = True
-        self.background = None
+        
+        # backgrounds for each readout configuration, see background_key()
+        self.bg_library = BackgroundLibrary()
+        self.settings.New('bg_library_file', dtype='file', initial='andor_ccd_bg_library.h5',
+                          description='HDF5 sidecar of the background library, one per camera serial number, '
+                                      'relative to the per user config dir (see config_path())')
+        self.settings.New('bg_library_size', dtype=float, unit='MB', initial=256, vmin=1, si=False)
+        self.settings.New('bg_library_file_size', dtype=float, unit='MB', initial=1024, vmin=1, si=False,
+                          description='backgrounds kept in bg_library_file, also those dropped from memory')
+        self.settings.New('bg_library_entries', dtype=int, initial=0, ro=True)
+        self.settings.bg_library_size.add_listener(self.on_bg_library_size_change)
+        self.settings.bg_library_file_size.add_listener(self.on_bg_library_size_change)
+        self.add_operation('clear_bg_library', self.clear_bg_library)
+        
+        # wavelength axes of the current readout, see get_wl_axis()
+        self._wl_axes = {}
+        self._wl_axes_generation = 0
+        self._wl_watched_hw = set()
+        
+        # configuration transactions, see apply_config()
+        self.config_transaction_active = False
+        self.readout_pending = False
+        self.settings.New('config_apply_time', dtype=float, unit='s', si=True, ro=True,
+                          description='duration of the last apply_config()')
+        
+        # static camera properties, cached per serial number and SDK version
+        self.settings.New('capability_cache_file', dtype='file', initial='andor_ccd_capabilities.json',
+                          description='JSON cache of the camera capabilities, '
+                                      'relative to the per user config dir (see config_path())')
+        self.settings.New('capabilities_cached', dtype=bool, initial=False, ro=True,
+                          description='capabilities came from the cache on connect, verified in the background')
+        self.capability_check_pending = False
+        
+        self.settings.New('simulate', dtype=bool, initial=False,
+                          description='use a simulated Andor SDK instead of the camera (takes effect on connect)')
         
         # Create logged quantities
         self.status = self.add_logged_quantity(name='ccd_status', dtype=str, initial="?", fmt="%s",ro=True)
@@ -28,6 +68,13 @@ class AndorCCDHW(HardwareComponent):
         self.settings.New('temp_status', dtype=str, ro=True, initial="?",)
         
         self.cooler_on = self.add_logged_quantity(name="cooler_on", dtype=bool, ro=False, initial=True)
+        
+        # status and temperature are polled by the hardware update thread,
+        # see threaded_update() and self.telemetry
+        self.settings.New('telemetry_interval', dtype=float, unit='s', initial=1.0, vmin=0.1,
+                          description='period of the background status / temperature polling')
+        self.telemetry = dict(time=0, ccd_status='?', temperature=None,
+                              temp_status='?', cooler_on=None, temp_time=0)
 
         self.exposure_time = self.add_logged_quantity(name="exposure_time", 
                                                       dtype=float,spinbox_decimals=4,
@@ -42,7 +89,7 @@ class AndorCCDHW(HardwareComponent):
                                                 vmin=1, vmax=4096)
         
         self.acq_mode = self.add_logged_quantity('acq_mode', dtype=str, 
-                                 initial='single', choices=('single', 'accumulate', 'kinetic', 'run_till_abort') )
+                                 initial='single', choices=('single', 'accumulate', 'kinetic', 'run_till_abort', 'fast_kinetics') )
         
         
         self.acc_time = self.add_logged_quantity('acc_time', dtype=float, unit='s', initial=0.1, si=True)
@@ -50,6 +97,29 @@ class AndorCCDHW(HardwareComponent):
         self.num_acc = self.add_logged_quantity('num_acc', dtype=int, initial=1, vmin=1)
         self.num_kin = self.add_logged_quantity('num_kin', dtype=int, initial=1, vmin=1)
         
+        self.settings.New('kinetic_stream', dtype=bool, initial=False,
+                          description='kinetic series are streamed frame by frame (andor_ccd_kinetic) instead of held in memory')
+        
+        # frame transfer: no dead time between exposures in kinetic and run_till_abort
+        self.settings.New('frame_transfer', dtype=bool, initial=False)
+        
+        # fast kinetics: series of exposures of a sub-area, shifted under the mask
+        self.settings.New('fk_exposed_rows', dtype=int, unit='px', initial=32, vmin=1)
+        self.settings.New('fk_series_length', dtype=int, initial=16, vmin=1)
+        self.settings.New('fk_exposure_time', dtype=float, unit='s', initial=1e-3, si=True,
+                          reread_from_hardware_after_write=True)
+        self.settings.New('fk_offset', dtype=int, unit='px', initial=0, vmin=0)
+        
+        # int32 or native 16 bit (GetAcquiredData16 etc) data buffers
+        self.settings.New('buffer_dtype', dtype=str, initial='int32', choices=('int32', 'uint16'),
+                          description='uint16 halves the memory traffic, accumulations may saturate')
+        
+        # run_till_abort ring buffer
+        self.settings.New('ring_size', dtype=int, initial=64, vmin=2,
+                          description='number of preallocated frames for run_till_abort streaming')
+        self.settings.New('ring_overruns', dtype=int, initial=0, ro=True,
+                          description='frames lost since the last start of a run_till_abort acquisition')
+        
         
         # Output amplifier ( EMCCD or conventional)
         self.output_amp = self.add_logged_quantity("output_amp", dtype=int, ro=False,
@@ -82,7 +152,7 @@ class AndorCCDHW(HardwareComponent):
         # Readout mode
         self.readout_mode = self.add_logged_quantity(name="readout_mode", dtype=str, ro=False,
                                                      initial = 'Image',
-                                                     choices = ("Image", "FullVerticalBinning", "SingleTrack",)
+                                                     choices = ("Image", "FullVerticalBinning", "SingleTrack", "MultiTrack", "RandomTrack")
                                                      )        
         # ROI Parameters for image readout mode.
         self.roi_img_hstart = self.add_logged_quantity("roi_img_hstart", dtype=int, unit='px', 
@@ -106,6 +176,17 @@ class AndorCCDHW(HardwareComponent):
         self.roi_st_hbin = self.add_logged_quantity("roi_st_hbin", dtype=int, unit='px', 
                                                     ro=False, initial=1)
         
+        #ROI parameters for multi track and random track readout modes,
+        # each track is binned on chip into one row of the readout
+        self.settings.New("roi_mt_number", dtype=int, initial=2, vmin=1)
+        self.settings.New("roi_mt_height", dtype=int, unit='px', initial=10, vmin=1)
+        self.settings.New("roi_mt_offset", dtype=int, unit='px', initial=0)
+        self.settings.New("roi_mt_bottom", dtype=int, unit='px', ro=True)
+        self.settings.New("roi_mt_gap", dtype=int, unit='px', ro=True)
+        self.settings.New("roi_rt_positions", dtype=str, initial="123-133, 379-389",
+                          description='first_row-last_row of each random track, 1-based, ascending')
+        self.settings.New("roi_track_hbin", dtype=int, unit='px', initial=1, vmin=1)
+        
         #ROI parameters for full vertical binning
         self.roi_fvb_hbin = self.add_logged_quantity("roi_fvb_hbin", dtype=int, unit='px', 
                                                      ro=False, initial=1)
@@ -128,8 +209,27 @@ class AndorCCDHW(HardwareComponent):
         if self.debug: self.log.debug( "Connecting to Andor EMCCD " )
         
         # Open connection to hardware
-        self.ccd_dev = AndorCCD(debug = self.debug, initialize_to_defaults=False)
-
+        andorlib = None
+        if self.settings['simulate']:
+            from .andor_ccd_sim import AndorSDKSim
+            andorlib = AndorSDKSim()
+        self.ccd_dev = AndorCCD(debug = self.debug, initialize_to_defaults=False, andorlib=andorlib,
+                                cached_capabilities=self.load_capability_cache())
+        self.settings['capabilities_cached'] = self.ccd_dev.capabilities_cached
+        if self.ccd_dev.capabilities_cached:
+            # verified by the hardware update thread, see check_capabilities()
+            self.capability_check_pending = True
+        else:
+            self.save_capabilities()
+        
+        # buffers are allocated once, by the set_readout() at the end
+        with self.ccd_dev.defer_buffer():
+            self.connect_settings()
+        
+        self.load_bg_library()
+    
+    def connect_settings(self):
+        """connects the settings to ccd_dev and writes them to the camera"""
         # connect logged quantities
         self.status.hardware_read_func = self.ccd_dev.get_status
         
@@ -146,7 +246,7 @@ class AndorCCDHW(HardwareComponent):
         self.exposure_time.hardware_read_func = self.ccd_dev.get_exposure_time
         self.exposure_time.write_to_hardware()
         
-        self.settings['has_em_ccd'] = self.ccd_dev.has_em_ccd()
+        self.settings['has_em_ccd'] = self.ccd_dev.em_mode
         if self.settings['has_em_ccd']:
             self.em_gain.hardware_read_func = self.ccd_dev.get_EMCCD_gain
             self.em_gain.hardware_set_func = self.ccd_dev.set_EMCCD_gain
@@ -180,9 +280,27 @@ class AndorCCDHW(HardwareComponent):
         self.vflip.write_to_hardware()
         
         
+        S = self.settings
+        S.fk_exposed_rows.connect_to_hardware(
+            write_func=lambda x: self.write_fast_kinetics(exposed_rows=x))
+        S.fk_series_length.connect_to_hardware(
+            write_func=lambda x: self.write_fast_kinetics(series_length=x))
+        S.fk_exposure_time.connect_to_hardware(
+            read_func=self.ccd_dev.get_fk_exposure_time,
+            write_func=lambda x: self.write_fast_kinetics(exposure_time=x))
+        S.fk_offset.connect_to_hardware(
+            write_func=lambda x: self.write_fast_kinetics(offset=x))
+        self.ccd_dev.set_fast_kinetics(S['fk_exposed_rows'], S['fk_series_length'],
+                                       S['fk_exposure_time'], S['fk_offset'])
+        S.fk_exposure_time.read_from_hardware()
+        
+        S.frame_transfer.connect_to_hardware(
+            write_func=self.ccd_dev.set_frame_transfer)
+        S.frame_transfer.write_to_hardware()
+        
         self.acq_mode.connect_to_hardware(
             #read_func=self.ccd_dev.get_aq_mode,
-            write_func=self.ccd_dev.set_aq_mode)
+            write_func=self.write_acq_mode)
         self.acq_mode.write_to_hardware()
         
         self.num_acc.connect_to_hardware(
@@ -190,6 +308,10 @@ class AndorCCDHW(HardwareComponent):
             write_func=self.ccd_dev.set_num_accumulations)
         self.num_acc.write_to_hardware()
         
+        self.settings.kinetic_stream.connect_to_hardware(
+            write_func=self.ccd_dev.set_kinetic_stream)
+        self.settings.kinetic_stream.write_to_hardware()
+        
         self.num_kin.connect_to_hardware(
             #read_func=self.ccd_dev.get_num_kinetics,
             write_func=self.ccd_dev.set_num_kinetics)
@@ -209,8 +331,66 @@ class AndorCCDHW(HardwareComponent):
             write_func=self.ccd_dev.set_kinetic_cycle_time)
         self.kin_time.write_to_hardware()
         
+        self.settings.buffer_dtype.connect_to_hardware(
+            write_func=self.ccd_dev.set_buffer_dtype)
+        self.settings.buffer_dtype.write_to_hardware()
+        
+        self.settings.ring_size.connect_to_hardware(
+            write_func=self.ccd_dev.set_ring_size)
+        self.settings.ring_size.write_to_hardware()
+        
+        # ROI limits and choice lists from the (possibly cached) capabilities
+        self.update_capability_settings()
+        
+        # For all of the logged quantities, call read from hardware to make sync
+        # everything.
+        self.read_from_hardware()        
+        
+        
+        
+        
+        
+        # Set some default values that are useful
+        #self.ccd_dev.set_temperature(DEFAULT_TEMPERATURE)
+        
+        
+#         if not self.has_been_connected_once:
+#             # initialize the readout parameters
+#             self.output_amp.update_value(0)        #EMCCD mode
+#             self.ad_chan.update_value(0)           #14-bit AD Chan
+#             self.hs_speed_em.update_value(0)       #10 MHz readout speed
+#             self.vs_speed.update_value(self.ccd_dev.numVSSpeeds-1)          #Slowest vertical shift speed
+#             self.hflip.update_value(True)          #Default to true horizontal flip
+#             self.exposure_time.update_value(1)     #Default to a 1 s integration
+#             self.shutter_open.update_value(False)  #Close the shutter.
+#             self.em_gain.update_value(10)
+#             self.cooler_on.update_value(True)
+#             
+#             self.acq_mode.update_value('single')
+#         
+#             # Readout and ROI parameters
+#             self.readout_mode.update_value(AndorReadMode.Image.value)  #Full image readout mode
+#             self.roi_img_hstart.update_value(1)
+#             self.roi_img_hend.update_value(width)
+#             self.roi_img_hbin.update_value(1)
+#             self.roi_img_vstart.update_value(1)
+#             self.roi_img_vend.update_value(height)
+#             self.roi_img_vbin.update_value(1)
+#             self.roi_st_center.update_value(height/2)
+#             self.roi_st_width.update_value(height/10)
+#             self.roi_st_hbin.update_value(1)
+#             self.roi_fvb_hbin.update_value(1)
+        
+        self.set_readout()
+        
+        #self.is_connected = True
+        
+
+    def update_capability_settings(self):
+        """ROI limits and the choices of the AD channel and shift speeds
+        from the capabilities of ccd_dev"""
         # Update the ROI min and max values to the CCD dimensions
-        width, height = self.ccd_dev.get_detector_shape()        
+        width, height = self.ccd_dev.Nx, self.ccd_dev.Ny
         self.settings['ccd_shape'] = height, width
         self.roi_fvb_hbin.change_min_max(1, width)
         self.roi_img_hbin.change_min_max(1, width)
@@ -222,6 +402,9 @@ class AndorCCDHW(HardwareComponent):
         self.roi_st_center.change_min_max(1, height)
         self.roi_st_hbin.change_min_max(1, width)
         self.roi_st_width.change_min_max(1, height)
+        self.settings.roi_mt_number.change_min_max(1, height)
+        self.settings.roi_mt_height.change_min_max(1, height)
+        self.settings.roi_track_hbin.change_min_max(1, width)
         
         
         
@@ -277,51 +460,52 @@ class AndorCCDHW(HardwareComponent):
 #         self.ad_chan.update_value(chan)
 #         print("ad_chan c", self.ad_chan.value)
 #         self.ad_chan.send_display_updates(force=True)
-        
-        # For all of the logged quantities, call read from hardware to make sync
-        # everything.
-        self.read_from_hardware()        
-        
-        
-        
-        
-        
-        # Set some default values that are useful
-        #self.ccd_dev.set_temperature(DEFAULT_TEMPERATURE)
-        
-        
-#         if not self.has_been_connected_once:
-#             # initialize the readout parameters
-#             self.output_amp.update_value(0)        #EMCCD mode
-#             self.ad_chan.update_value(0)           #14-bit AD Chan
-#             self.hs_speed_em.update_value(0)       #10 MHz readout speed
-#             self.vs_speed.update_value(self.ccd_dev.numVSSpeeds-1)          #Slowest vertical shift speed
-#             self.hflip.update_value(True)          #Default to true horizontal flip
-#             self.exposure_time.update_value(1)     #Default to a 1 s integration
-#             self.shutter_open.update_value(False)  #Close the shutter.
-#             self.em_gain.update_value(10)
-#             self.cooler_on.update_value(True)
-#             
-#             self.acq_mode.update_value('single')
-#         
-#             # Readout and ROI parameters
-#             self.readout_mode.update_value(AndorReadMode.Image.value)  #Full image readout mode
-#             self.roi_img_hstart.update_value(1)
-#             self.roi_img_hend.update_value(width)
-#             self.roi_img_hbin.update_value(1)
-#             self.roi_img_vstart.update_value(1)
-#             self.roi_img_vend.update_value(height)
-#             self.roi_img_vbin.update_value(1)
-#             self.roi_st_center.update_value(height/2)
-#             self.roi_st_width.update_value(height/10)
-#             self.roi_st_hbin.update_value(1)
-#             self.roi_fvb_hbin.update_value(1)
-        
-        self.set_readout()
-        
-        #self.is_connected = True
-        
-
+    
+    def threaded_update(self):
+        """Telemetry poller, runs in the ScopeFoundry hardware update thread
+        while connected"""
+        try:
+            if self.capability_check_pending:
+                self.check_capabilities()
+            self.poll_telemetry()
+        finally:
+            # short sleeps, so that disconnecting does not wait for a full interval
+            t_next = time.time() + self.settings['telemetry_interval']
+            while not self.update_thread_interrupted and time.time() < t_next:
+                time.sleep(0.05)
+    
+    def poll_telemetry(self):
+        """Reads status, temperature and cooler state and publishes them
+        as a new self.telemetry snapshot and in the settings.
+        The SDK rejects temperature reads while acquiring, those are skipped
+        and the snapshot keeps the last temperature with its temp_time."""
+        ccd_dev = self.ccd_dev
+        snapshot = dict(self.telemetry)
+        now = time.time()
+        status = ccd_dev.get_status()
+        snapshot.update(time=now, ccd_status=status)
+        if status != 'ACQUIRING':
+            try:
+                temp = ccd_dev.get_temperature()
+                snapshot.update(temp_time=now, temperature=temp,
+                                temp_status=ccd_dev.temp_status_dict[ccd_dev.temperature_status_num],
+                                cooler_on=ccd_dev.get_cooler())
+            except IOError:
+                pass # acquisition started in between
+        # replaced as a whole, readers never see a partial update
+        self.telemetry = snapshot
+        
+        S = self.settings
+        S['ccd_status'] = status
+        if snapshot['temp_time'] == now:
+            S['temperature'] = snapshot['temperature']
+            S['temp_status'] = snapshot['temp_status']
+        return snapshot
+    
+    def get_telemetry(self):
+        """latest telemetry snapshot (dict), does not touch the camera"""
+        return self.telemetry
+    
     def disconnect(self):
         
         #disconnect logged quantities from hardware
@@ -338,6 +522,143 @@ class AndorCCDHW(HardwareComponent):
         
         self.is_connected = False
     
+    ##### Capability cache #####
+    
+    def config_path(self, fname, serial=None):
+        """path of a cache file of the camera in ~/.scope_foundry/<app name>,
+        not the data save_dir which changes with every experiment. With
+        serial, the serial number is added to the file name."""
+        if not fname:
+            return None
+        if serial is not None:
+            root, ext = os.path.splitext(fname)
+            fname = "{}_{}{}".format(root, serial, ext)
+        config_dir = os.path.join(os.path.expanduser('~'), '.scope_foundry', self.app.name.replace(' ', '_'))
+        path = os.path.join(config_dir, fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+    
+    def capability_cache_path(self):
+        # read before the camera is initialized, the entries are keyed by serial number
+        return self.config_path(self.settings['capability_cache_file'])
+    
+    def load_capability_cache(self):
+        """{capability_key: capabilities} from the cache file, empty if there is none"""
+        path = self.capability_cache_path()
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception as err:
+            self.log.error("could not load capability cache {}".format(err))
+            return {}
+    
+    def save_capabilities(self):
+        """adds the capabilities of ccd_dev to the cache file"""
+        path = self.capability_cache_path()
+        if not path:
+            return
+        cache = self.load_capability_cache()
+        cache[self.ccd_dev.capability_key()] = self.ccd_dev.get_capabilities()
+        try:
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp, path)
+        except Exception as err:
+            self.log.error("could not save capability cache {}".format(err))
+    
+    def check_capabilities(self):
+        """Re-reads the capabilities that were loaded from the cache, from
+        the hardware update thread. If they changed, the cache and the
+        choice lists are updated. Postponed while the camera acquires."""
+        ccd_dev = self.ccd_dev
+        cached = ccd_dev.get_capabilities()
+        # no acquisition can start during the check
+        with ccd_dev.lock:
+            if ccd_dev.get_status() == 'ACQUIRING':
+                return
+            try:
+                current = ccd_dev.read_capabilities()
+            except IOError as err:
+                self.log.warning("capability check failed, will retry: {}".format(err))
+                return
+        self.capability_check_pending = False
+        # compare as stored in the cache (tuples are lists there)
+        if json.loads(json.dumps(current)) != json.loads(json.dumps(cached)):
+            self.log.warning("camera capabilities differ from the cache, updating it")
+            self.save_capabilities()
+            self.update_capability_settings()
+    
+    ##### Background library #####
+    
+    # settings that define the readout geometry, per readout mode
+    bg_key_settings = {
+        'Image': ('roi_img_hbin', 'roi_img_vbin', 'roi_img_hstart', 'roi_img_hend',
+                  'roi_img_vstart', 'roi_img_vend'),
+        'FullVerticalBinning': ('roi_fvb_hbin',),
+        'SingleTrack': ('roi_st_center', 'roi_st_width', 'roi_st_hbin'),
+        'MultiTrack': ('roi_mt_number', 'roi_mt_height', 'roi_mt_offset', 'roi_track_hbin'),
+        'RandomTrack': ('roi_rt_positions', 'roi_track_hbin'),
+    }
+    
+    def background_key(self):
+        """readout configuration the current background belongs to:
+        readout mode, ROI and binning, exposure, EM gain, output amplifier
+        and cooler setpoint, as a tuple of (name, value) pairs.
+        The dark of a frame is the same in single, accumulate, kinetic and
+        run_till_abort mode, only fast kinetics has its own frame geometry"""
+        S = self.settings
+        ro_mode = S['readout_mode']
+        names = ['readout_mode'] + list(self.bg_key_settings[ro_mode])
+        names += ['hflip', 'vflip', 'output_amp', 'em_gain']
+        if S['acq_mode'] == 'fast_kinetics':
+            names += ['fk_exposed_rows', 'fk_series_length', 'fk_offset']
+            exposure = S['fk_exposure_time']
+        else:
+            exposure = S['exposure_time']
+        key = [(name, S[name]) for name in names]
+        key.append(('exposure_time', float('%.6g' % exposure)))
+        # the setpoint, the measured temperature changes between acquiring
+        # a background and looking it up. None until the cooler reports
+        # STABILIZED (cooling down, drifting, off or not supported)
+        setpoint = S['temp_setpoint'] if S['temp_status'] == 'STABILIZED' else None
+        key.append(('temp_setpoint', setpoint))
+        return tuple(key)
+    
+    @property
+    def background(self):
+        """background of the current readout configuration or None"""
+        return self.bg_library.get(self.background_key())
+    
+    @background.setter
+    def background(self, bg):
+        if bg is not None and bg.ndim == 3 and self.settings['acq_mode'] != 'fast_kinetics':
+            # a kinetic series, stored as the dark of one frame
+            bg = bg.mean(axis=0)
+        self.bg_library.put(self.background_key(), bg)
+        self.settings['bg_library_entries'] = len(self.bg_library)
+    
+    def bg_library_path(self):
+        return self.config_path(self.settings['bg_library_file'], serial=self.ccd_dev.serialNumber)
+    
+    def load_bg_library(self):
+        try:
+            self.bg_library.load(self.bg_library_path())
+        except Exception as err:
+            self.log.error("could not load background library {}".format(err))
+        self.settings['bg_library_entries'] = len(self.bg_library)
+    
+    def clear_bg_library(self):
+        self.bg_library.clear()
+        self.settings['bg_library_entries'] = 0
+    
+    def on_bg_library_size_change(self):
+        self.bg_library.set_max_bytes(int(self.settings['bg_library_size']*2**20))
+        self.bg_library.set_max_file_bytes(int(self.settings['bg_library_file_size']*2**20))
+        self.settings['bg_library_entries'] = len(self.bg_library)
+    
     def is_background_valid(self):
         bg = self.background
         if bg is not None:
@@ -360,6 +681,169 @@ class AndorCCDHW(HardwareComponent):
         stat = self.settings.ccd_status.read_from_hardware()
         
     
+    def write_fast_kinetics(self, **kwargs):
+        self.ccd_dev.set_fast_kinetics(**kwargs)
+        self.settings['readout_shape'] = [self.ccd_dev.Ny_ro, self.ccd_dev.Nx_ro]
+        self.invalidate_wl_axes()
+    
+    def write_acq_mode(self, mode):
+        was_fast_kinetics = getattr(self.ccd_dev, 'aq_mode', None) == 'fast_kinetics'
+        self.ccd_dev.set_aq_mode(mode)
+        if was_fast_kinetics or mode == 'fast_kinetics':
+            # fast kinetics has its own readout geometry
+            if self.config_transaction_active:
+                self.readout_pending = True
+            else:
+                self.set_readout()
+    
+    ##### Configuration transactions #####
+    
+    # order in which apply_config() writes settings: amplifier and speeds,
+    # acquisition mode and timing, fast kinetics, then everything else.
+    # The readout geometry is applied by one set_readout() at the end.
+    config_order = (
+        'output_amp', 'ad_chan', 'hs_speed_em', 'hs_chan_conventional', 'vertical_shift_speed',
+        'em_gain', 'trigger_mode',
+        'acq_mode', 'frame_transfer', 'kinetic_stream', 'buffer_dtype', 'ring_size',
+        'num_acc', 'num_kin', 'acc_time', 'kin_time', 'exposure_time',
+        'fk_exposed_rows', 'fk_series_length', 'fk_exposure_time', 'fk_offset',
+        )
+    # settings that only reach the camera through set_readout() (besides roi_*)
+    readout_settings = ('readout_mode', 'hflip', 'vflip')
+    
+    def is_readout_setting(self, name):
+        return name in self.readout_settings or name.startswith('roi_')
+    
+    def get_config(self):
+        """copy of the writable camera settings (name -> value), e.g. a preset
+        to restore later with apply_config()"""
+        config = {}
+        for name, lq in self.settings.as_dict().items():
+            if lq.ro or name == 'connected':
+                continue
+            val = lq.val
+            config[name] = val.copy() if isinstance(val, np.ndarray) else val
+        return config
+    
+    def validate_config(self, config):
+        """Checks config (name -> value) against the settings and, when
+        connected, the camera capabilities. Returns a list of problems,
+        empty if config can be applied"""
+        S = self.settings
+        errors = []
+        for name, val in config.items():
+            if name not in S.as_dict():
+                errors.append("unknown setting {}".format(name))
+                continue
+            lq = S.get_lq(name)
+            if lq.ro or name == 'connected':
+                errors.append("{} is read only".format(name))
+                continue
+            try:
+                val = lq.coerce_to_type(val)
+            except (TypeError, ValueError):
+                errors.append("{}={!r} is not a {}".format(name, val, lq.dtype.__name__))
+                continue
+            if lq.choices is not None and val not in [c[1] for c in lq.choices]:
+                errors.append("{}={!r} is not one of the choices".format(name, val))
+        if errors or not (S['connected'] and hasattr(self, 'ccd_dev')):
+            return errors
+        
+        # the resulting configuration against the camera capabilities,
+        # for the groups of settings config touches
+        caps = self.ccd_dev.get_capabilities()
+        def new(name):
+            return S.get_lq(name).coerce_to_type(config.get(name, S[name]))
+        def touches(*names):
+            return any(name in config for name in names)
+        ad_chan = new('ad_chan')
+        if touches('ad_chan', 'hs_chan_conventional', 'hs_speed_em'):
+            if not 0 <= ad_chan < caps['numADChan']:
+                errors.append("ad_chan {} not available".format(ad_chan))
+            else:
+                if not 0 <= new('hs_chan_conventional') < len(caps['HSSpeeds_Conventional'][ad_chan]):
+                    errors.append("hs_chan_conventional {} not available".format(new('hs_chan_conventional')))
+                if caps['em_mode'] and not 0 <= new('hs_speed_em') < len(caps['HSSpeeds_EM'][ad_chan]):
+                    errors.append("hs_speed_em {} not available".format(new('hs_speed_em')))
+        if touches('vertical_shift_speed') and caps['VSSpeeds']:
+            if not 0 <= new('vertical_shift_speed') < len(caps['VSSpeeds']):
+                errors.append("vertical_shift_speed {} not available".format(new('vertical_shift_speed')))
+        if 'em_gain' in config:
+            low, high = caps['em_gain_range']
+            if not caps['em_mode']:
+                errors.append("em_gain: camera has no EM register")
+            elif not low <= new('em_gain') <= high:
+                errors.append("em_gain {} out of range [{}, {}]".format(new('em_gain'), low, high))
+        Nx, Ny = caps['Nx'], caps['Ny']
+        ro_mode = new('readout_mode') if any(map(self.is_readout_setting, config)) else None
+        if ro_mode == 'Image':
+            if not 1 <= new('roi_img_hstart') < new('roi_img_hend') <= Nx:
+                errors.append("roi_img_hstart/hend outside 1..{}".format(Nx))
+            if not 1 <= new('roi_img_vstart') < new('roi_img_vend') <= Ny:
+                errors.append("roi_img_vstart/vend outside 1..{}".format(Ny))
+        elif ro_mode == 'SingleTrack':
+            if not 1 <= new('roi_st_center') <= Ny:
+                errors.append("roi_st_center outside 1..{}".format(Ny))
+        return errors
+    
+    def apply_config(self, config):
+        """Applies config (name -> value) as one transaction:
+        the changed settings are validated (ValueError, nothing is written),
+        then written in config_order, with the driver lock
+        held, followed by a single set_readout() and buffer allocation.
+        Returns the names of the changed settings, the duration is in
+        the config_apply_time setting."""
+        t0 = time.time()
+        S = self.settings
+        changed = []
+        for name, val in config.items():
+            lq = S.as_dict().get(name)
+            try:
+                same = lq is not None and not lq.ro and lq.same_values(lq.val, lq.coerce_to_type(val))
+            except (TypeError, ValueError):
+                same = False
+            if not same:
+                changed.append(name) # invalid ones fail validation below
+        errors = self.validate_config({name: config[name] for name in changed})
+        if errors:
+            raise ValueError("invalid configuration: {}".format("; ".join(errors)))
+        rank = {name:i for i, name in enumerate(self.config_order)}
+        changed.sort(key=lambda name: rank.get(name, len(rank)))
+        
+        if S['connected'] and hasattr(self, 'ccd_dev'):
+            with self.ccd_dev.defer_buffer():
+                self.config_transaction_active = True
+                self.readout_pending = any(self.is_readout_setting(name) for name in changed)
+                try:
+                    for name in changed:
+                        S[name] = config[name]
+                    if self.readout_pending:
+                        self.set_readout()
+                finally:
+                    self.config_transaction_active = False
+                    self.readout_pending = False
+        else:
+            for name in changed:
+                S[name] = config[name]
+        
+        S['config_apply_time'] = time.time() - t0
+        self.log.info("apply_config: {} settings in {:.1f} ms".format(
+            len(changed), 1e3*S['config_apply_time']))
+        return changed
+    
+    @contextmanager
+    def config_transaction(self):
+        """Stages settings in a dict, applied with apply_config() at the
+        end of the block (not applied if the block raises):
+        
+            with ccd_hw.config_transaction() as config:
+                config['readout_mode'] = 'Image'
+                config['roi_img_vbin'] = 4
+        """
+        config = {}
+        yield config
+        self.apply_config(config)
+    
     def set_readout(self):
         """Sets ROI based on values in LoggedQuantities for the current readout mode
         Also sets the flip"""
@@ -380,10 +864,81 @@ class AndorCCDHW(HardwareComponent):
                                              self.roi_img_vend.val)
         elif ro_mode ==  'SingleTrack':
             self.ccd_dev.set_ro_single_track(self.roi_st_center.val, self.roi_st_width.val, self.roi_st_hbin.val)
+        elif ro_mode == 'MultiTrack':
+            S = self.settings
+            bottom, gap = self.ccd_dev.set_ro_multi_track(S['roi_mt_number'], S['roi_mt_height'], 
+                                                          S['roi_mt_offset'], S['roi_track_hbin'])
+            S['roi_mt_bottom'] = bottom
+            S['roi_mt_gap'] = gap
+        elif ro_mode == 'RandomTrack':
+            positions = [[int(row) for row in track.split('-')] 
+                         for track in self.settings['roi_rt_positions'].split(',')]
+            self.ccd_dev.set_ro_random_track(positions, self.settings['roi_track_hbin'])
         else:
             raise NotImplementedError("ro mode not implemented %s", ro_mode)
         
+        if self.ccd_dev.aq_mode == 'fast_kinetics':
+            # exposed rows with the binning of the readout mode
+            self.ccd_dev.set_fast_kinetics()
+        
         self.settings['readout_shape'] = [self.ccd_dev.Ny_ro, self.ccd_dev.Nx_ro]
+        self.invalidate_wl_axes()
+    
+    ##### Wavelength axis #####
+    
+    # wl_calib --> spectrometer hardware name
+    wl_calib_hardware = {
+        'acton_spectrometer': 'acton_spectrometer',
+        'andor_spectrometer': 'andor_spec',
+    }
+    # spectrometer settings the calibration depends on
+    wl_calib_settings = ('center_wl', 'grating_id', 'grating_calib_side_in', 'grating_calib_direct_in')
+    
+    def get_wl_axis(self, wl_calib='pixels', energy=False):
+        """x axis of the current readout (read only array), one of
+            pixels             binned pixel centers
+            raw_pixels         0..width-1
+            acton_spectrometer, andor_spectrometer   wavelengths (nm) from the spectrometer calibration
+        energy=True converts wavelengths to eV.
+        Cached until the readout or the spectrometer calibration settings change."""
+        key = (wl_calib, energy)
+        wls = self._wl_axes.get(key)
+        if wls is None:
+            generation = self._wl_axes_generation
+            wls = self.compute_wl_axis(wl_calib)
+            if energy:
+                wls = 1239.84/wls
+            wls.flags.writeable = False
+            if generation == self._wl_axes_generation:
+                # not invalidated while computing
+                self._wl_axes[key] = wls
+        return wls
+    
+    def compute_wl_axis(self, wl_calib='pixels'):
+        width_px = self.ccd_dev.Nx_ro
+        hbin = self.ccd_dev.get_current_hbin()
+        px_index = np.arange(width_px)
+        if wl_calib in self.wl_calib_hardware:
+            spec_hw = self.app.hardware[self.wl_calib_hardware[wl_calib]]
+            self.watch_wl_calib_settings(spec_hw)
+            return spec_hw.get_wl_calibration(px_index, hbin)
+        elif wl_calib == 'pixels':
+            return hbin*px_index + 0.5*(hbin-1)
+        else:
+            return px_index
+    
+    def watch_wl_calib_settings(self, spec_hw):
+        """invalidate the cached axes when the calibration settings of spec_hw change"""
+        if spec_hw.name in self._wl_watched_hw:
+            return
+        self._wl_watched_hw.add(spec_hw.name)
+        for name in self.wl_calib_settings:
+            if name in spec_hw.settings.as_dict():
+                spec_hw.settings.get_lq(name).add_listener(self.invalidate_wl_axes)
+    
+    def invalidate_wl_axes(self):
+        self._wl_axes_generation += 1
+        self._wl_axes = {}
     
     def read_temp_op(self):
         #print self.ccd_dev.get_status()
@@ -409,10 +964,25 @@ class AndorCCDHW(HardwareComponent):
         self.roi_st_width.update_value(height/10)
         self.roi_st_hbin.update_value(1)
         self.roi_fvb_hbin.update_value(1)        
+        self.settings['roi_track_hbin'] = 1
 
         self.set_readout()
         
         
+    def get_ring_frames(self, flip=True):
+        """Drains new run_till_abort frames into the ccd_dev ring buffer.
+        Returns (frame_indices, frames) views, see AndorCCD.poll_ring_buffer.
+        The caller hands the slots back with ccd_dev.release_ring_frames()
+        flip=False leaves the output amplifier flip to the caller"""
+        frame_indices, frames = self.ccd_dev.poll_ring_buffer()
+        if self.ccd_dev.ring_overruns != self.settings['ring_overruns']:
+            self.settings['ring_overruns'] = self.ccd_dev.ring_overruns
+        
+        # second output amplifier flips the image horizontally
+        if flip and self.settings['output_amp'] == 1:
+            frames = frames[:,:,::-1]
+        return frame_indices, frames
+        
     def get_acquired_data(self):
         
         buffer_ = self.ccd_dev.get_acquired_data()
@@ -421,6 +991,6 @@ class AndorCCDHW(HardwareComponent):
         #image will be flipped horizontally
         # so we correct this here
         if self.settings['output_amp'] == 1:
-            buffer_ = buffer_[:,::-1]
+            buffer_ = buffer_[...,::-1]
             
         return buffer_
\ No newline at end of file
@@ -0,0 +1,198 @@
+from __future__ import absolute_import, print_function
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+
+class BackgroundLibrary(object):
+    """
+    Background (dark) frames keyed by the readout configuration.
+
+    Keys are tuples of (name, value) pairs, see AndorCCDHW.background_key().
+    The library holds at most max_bytes of frames in memory, the least
+    recently used are dropped first. With a sidecar HDF5 file every
+    background is also written to it. The file keeps the backgrounds
+    dropped from memory (up to max_file_bytes, least recently used
+    first), get() reads them back. The last use of each background is
+    stored with it, so load() restores the LRU order.
+    """
+
+    # s, the use time of a background is written at most this often
+    touch_interval = 60.0
+
+    def __init__(self, max_bytes=256*2**20, path=None, max_file_bytes=1024*2**20):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.path = path
+        self.entries = OrderedDict() # key -> array, most recently used last
+        self.nbytes = 0
+        # key -> [nbytes, time of last use] of the sidecar, most recently used last
+        self.stored = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries.keys() | self.stored.keys())
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.stored
+
+    def get(self, key):
+        """background for key or None"""
+        bg = self.entries.get(key)
+        if bg is not None:
+            self.entries.move_to_end(key)
+        elif key in self.stored:
+            bg = self._read_h5(key)
+            self._insert(key, bg)
+            self.evict()
+        if bg is not None:
+            self._touch(key)
+        return bg
+
+    def put(self, key, bg):
+        """stores a copy of bg for key (bg=None removes it)"""
+        if bg is None:
+            self.remove(key)
+            return
+        self._insert(key, np.array(bg, copy=True))
+        self.evict()
+        if self.path:
+            self._write_h5([key])
+            self.evict_file()
+
+    def remove(self, key):
+        self._drop(key)
+        if key in self.stored:
+            self._write_h5([], [key])
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        if self.stored:
+            self._write_h5([], list(self.stored.keys()))
+
+    def evict(self):
+        """drops least recently used backgrounds from memory until within
+        max_bytes, the newest is always kept. Returns the evicted keys"""
+        evicted = []
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            key, bg = self.entries.popitem(last=False)
+            self.nbytes -= bg.nbytes
+            evicted.append(key)
+        return evicted
+
+    def evict_file(self):
+        """deletes least recently used backgrounds from the sidecar until
+        within max_file_bytes, the newest is always kept"""
+        nbytes = sum(n for n, t in self.stored.values())
+        evicted = []
+        for key, (n, t) in self.stored.items():
+            if nbytes <= self.max_file_bytes or len(self.stored) - len(evicted) <= 1:
+                break
+            nbytes -= n
+            evicted.append(key)
+        if evicted:
+            self._write_h5([], evicted)
+        return evicted
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def set_max_file_bytes(self, max_file_bytes):
+        self.max_file_bytes = max_file_bytes
+        self.evict_file()
+
+    def _insert(self, key, bg):
+        self._drop(key)
+        self.entries[key] = bg
+        self.nbytes += bg.nbytes
+
+    def _drop(self, key):
+        bg = self.entries.pop(key, None)
+        if bg is None:
+            return False
+        self.nbytes -= bg.nbytes
+        return True
+
+    def _touch(self, key):
+        """records the use of key, in the sidecar at most every touch_interval"""
+        if key not in self.stored:
+            return
+        self.stored.move_to_end(key)
+        record = self.stored[key]
+        now = time.time()
+        if now - record[1] >= self.touch_interval:
+            import h5py
+            record[1] = now
+            with h5py.File(self.path, 'a') as f:
+                f[self.dataset_name(key)].attrs['time'] = now
+
+    ##### HDF5 sidecar #####
+
+    @staticmethod
+    def key_to_str(key):
+        return json.dumps([list(item) for item in key])
+
+    @staticmethod
+    def str_to_key(s):
+        return tuple( (name, tuple(val) if isinstance(val, list) else val)
+                      for name, val in json.loads(s) )
+
+    @classmethod
+    def dataset_name(cls, key):
+        return hashlib.sha1(cls.key_to_str(key).encode()).hexdigest()
+
+    def _write_h5(self, keys, removed_keys=()):
+        import h5py
+        with h5py.File(self.path, 'a') as f:
+            for key in removed_keys:
+                name = self.dataset_name(key)
+                if name in f:
+                    del f[name]
+                self.stored.pop(key, None)
+            for key in keys:
+                name = self.dataset_name(key)
+                if name in f:
+                    del f[name]
+                bg = self.entries[key]
+                ds = f.create_dataset(name, data=bg)
+                ds.attrs['key'] = self.key_to_str(key)
+                ds.attrs['time'] = t = time.time()
+                self.stored.pop(key, None)
+                self.stored[key] = [bg.nbytes, t]
+
+    def _read_h5(self, key):
+        import h5py
+        with h5py.File(self.path, 'r') as f:
+            return f[self.dataset_name(key)][()]
+
+    def load(self, path=None):
+        """reads the index of the sidecar file, if it exists, and the most
+        recently used backgrounds that fit into max_bytes"""
+        import h5py
+        if path is not None:
+            self.path = path
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        self.stored.clear()
+        with h5py.File(self.path, 'r') as f:
+            index = sorted(((ds.attrs['time'], self.str_to_key(ds.attrs['key']), ds) for ds in f.values()),
+                           key=lambda item: item[0])
+            for t, key, ds in index:
+                self.stored.pop(key, None)
+                self.stored[key] = [ds.dtype.itemsize*ds.size, t]
+            # newest first, then oldest first into memory, so the LRU order survives
+            nbytes, recent = 0, []
+            for t, key, ds in reversed(index):
+                nbytes += ds.dtype.itemsize*ds.size
+                if recent and nbytes > self.max_bytes:
+                    break
+                recent.append((key, ds))
+            for key, ds in reversed(recent):
+                self._insert(key, ds[()])
+        self.evict()
+        self.evict_file()
+        return len(self)
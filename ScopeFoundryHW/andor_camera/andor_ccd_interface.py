@@ -1,11 +1,17 @@
 from __future__ import absolute_import, print_function
 import ctypes
-from ctypes import c_int, c_uint, c_byte, c_ubyte, c_short, c_double, c_float, c_long
-from ctypes import pointer, byref, windll, cdll
+from ctypes import c_int, c_uint, c_byte, c_ubyte, c_short, c_ushort, c_double, c_float, c_long, c_ulong
+from ctypes import c_char_p, c_void_p, POINTER
+from ctypes import pointer, byref, cdll
+try:
+    from ctypes import windll
+except ImportError: # not on Windows, only a simulated SDK can be used
+    windll = None
 import time
 import numpy as np
 import os
-from threading import Lock
+from threading import RLock
+from contextlib import contextmanager
 
 import platform
 import logging
@@ -23,6 +29,96 @@ logger = logging.getLogger(__name__)
 DEFAULT_TEMPERATURE = -80
 DEFAULT_EM_GAIN = 10
 DEFAULT_OUTPUT_AMP = 0  # 0 is electron multiplication, 1 is conventional    
+DEFAULT_RING_SIZE = 64  # frames in the run_till_abort ring buffer
+
+# numpy buffer dtype --> suffix of the SDK retrieval functions
+BUFFER_DTYPES = {
+    'int32':  '',   # at_32 *, GetAcquiredData
+    'uint16': '16', # WORD *,  GetAcquiredData16
+}
+
+# SDK types from atmcd32d.h
+at_32 = c_long    # long on Windows, 32 bit
+at_u32 = c_ulong
+P = POINTER
+
+# argtypes of the SDK functions used by AndorCCD, all return an unsigned int DRV_* code.
+# Data buffers are passed as addresses (c_void_p), see AndorCCD._data_func
+SDK_PROTOTYPES = dict(
+    Initialize = [c_char_p],
+    ShutDown = [],
+    GetHeadModel = [c_char_p],
+    GetCameraSerialNumber = [P(c_int)],
+    GetHardwareVersion = [P(c_uint)]*6,
+    GetSoftwareVersion = [P(c_uint)]*6,
+    GetDetector = [P(c_int), P(c_int)],
+    GetNumberADChannels = [P(c_int)],
+    GetNumberAmp = [P(c_int)],
+    GetNumberPreAmpGains = [P(c_int)],
+    GetPreAmpGain = [c_int, P(c_float)],
+    SetADChannel = [c_int],
+    GetNumberHSSpeeds = [c_int, c_int, P(c_int)],
+    GetHSSpeed = [c_int, c_int, c_int, P(c_float)],
+    GetNumberVSSpeeds = [P(c_int)],
+    GetVSSpeed = [c_int, P(c_float)],
+    SetHSSpeed = [c_int, c_int],
+    SetVSSpeed = [c_int],
+    SetPreAmpGain = [c_int],
+    GetImageFlip = [P(c_int), P(c_int)],
+    SetImageFlip = [c_int, c_int],
+    SetImageRotation = [c_int],
+    SetShutter = [c_int, c_int, c_int, c_int],
+    CoolerON = [],
+    CoolerOFF = [],
+    GetTemperatureRange = [P(c_int), P(c_int)],
+    SetTemperature = [c_int],
+    GetTemperature = [P(c_int)],
+    SetReadMode = [c_int],
+    SetFVBHBin = [c_int],
+    SetSingleTrack = [c_int, c_int],
+    SetSingleTrackHBin = [c_int],
+    SetMultiTrack = [c_int, c_int, c_int, P(c_int), P(c_int)],
+    SetMultiTrackHBin = [c_int],
+    SetRandomTracks = [c_int, P(c_int)],
+    SetCustomTrackHBin = [c_int],
+    SetImage = [c_int]*6,
+    SetAcquisitionMode = [c_int],
+    SetFrameTransferMode = [c_int],
+    SetFastKineticsEx = [c_int, c_int, c_float, c_int, c_int, c_int, c_int],
+    GetFKExposureTime = [P(c_float)],
+    SetTriggerMode = [c_int],
+    IsTriggerModeAvailable = [c_int],
+    SendSoftwareTrigger = [],
+    SetExposureTime = [c_float],
+    SetNumberAccumulations = [c_int],
+    SetNumberKinetics = [c_int],
+    SetAccumulationCycleTime = [c_float],
+    SetKineticCycleTime = [c_float],
+    GetAcquisitionTimings = [P(c_float)]*3,
+    GetKeepCleanTime = [P(c_float)],
+    SetEMAdvanced = [c_int],
+    GetEMGainRange = [P(c_int), P(c_int)],
+    GetEMCCDGain = [P(c_int)],
+    SetEMCCDGain = [c_int],
+    SetEMGainMode = [c_int],
+    SetOutputAmplifier = [c_int],
+    StartAcquisition = [],
+    AbortAcquisition = [],
+    GetStatus = [P(c_int)],
+    WaitForAcquisition = [],
+    WaitForAcquisitionTimeOut = [c_int],
+    CancelWait = [],
+    GetAcquiredData = [c_void_p, at_u32],
+    GetAcquiredData16 = [c_void_p, at_u32],
+    GetTotalNumberImagesAcquired = [P(at_32)],
+    GetNumberNewImages = [P(at_32), P(at_32)],
+    GetNumberAvailableImages = [P(at_32), P(at_32)],
+    GetImages = [at_32, at_32, c_void_p, at_u32, P(at_32), P(at_32)],
+    GetImages16 = [at_32, at_32, c_void_p, at_u32, P(at_32), P(at_32)],
+    GetOldestImage = [c_void_p, at_u32],
+    GetOldestImage16 = [c_void_p, at_u32],
+    GetSizeOfCircularBuffer = [P(at_32)],
+)
 
 
 # Read modes for the EMCCD:
@@ -44,49 +140,46 @@ def _err(retval):
 
 class AndorCCD(object):
     
-    def __init__(self, debug = False, initialize_to_defaults=True):
+    def __init__(self, debug = False, initialize_to_defaults=True, andorlib=None,
+                 cached_capabilities=None):
+        """andorlib: SDK library to use instead of loading the atmcd dll,
+        e.g. andor_ccd_sim.AndorSDKSim() to run without a camera
+        cached_capabilities: {capability_key(): get_capabilities()} of previous
+        sessions, the static camera properties are then not queried again"""
     
         self.debug = debug
-        self.lock = Lock()
-        
+        # reentrant, a configuration transaction holds it across many calls
+        self.lock = RLock()
+        self.buffer_deferred = False
+        self.buffer_pending = False
+        self.ring_size = DEFAULT_RING_SIZE
+        self.kinetic_stream = False
+        self.buffer_dtype = np.dtype('int32')
+        self.frame_transfer = False
+        self.fk_exposed_rows = 32
+        self.fk_series_length = 16
+        self.fk_exposure_time = 1e-3
+        self.fk_offset = 0
         
-        if platform.architecture()[0] == '64bit':
-            andorlibpath = None
-            for path in [r"C:\Program Files\Andor Driver Pack 2\atmcd64d.dll",
-                         r"C:\Program Files\Andor SOLIS\atmcd64d_legacy.dll",]:
-                if os.path.exists(path):
-                    andorlibpath = path
-                    break
-                
-            if andorlibpath is None:    
-                andorlibpath = str(os.path.join(os.path.dirname(__file__),"atmcd64d.dll"))
+        if andorlib is not None:
+            self.andorlib = andorlib
         else:
-            andorlibpath = str(os.path.join(os.path.dirname(__file__),"atmcd32d.dll"))
-        #print andorlibpath
-         
-         
-         
-        self.andorlib = windll.LoadLibrary(andorlibpath)
-
+            self.andorlib = self._load_andorlib()
+        self._setup_prototypes()
+        self._setup_scratch()
         
         if self.debug:  logger.debug("AndorCCD initializing")
             
-        with self.lock: _err(self.andorlib.Initialize(''))
+        with self.lock: _err(self.andorlib.Initialize(b''))
         if self.debug: logger.debug("Andor CCD Library Initialization Successful")
         
-        self.get_head_model()
-        
+        # serial number and SDK version identify cached capabilities
         self.get_serial_number()
-        
-        self.get_hardware_version()
-        
         self.get_software_version()
-        
-        self.get_detector_shape()
-            
-        self.get_num_ad_channels()
-        self.get_num_output_amplifiers()
-
+        caps = (cached_capabilities or {}).get(self.capability_key())
+        self.capabilities_cached = self.set_capabilities(caps)
+        if not self.capabilities_cached:
+            self.read_capabilities()
         
         if initialize_to_defaults:
             self.set_ad_channel() #set default AD channel
@@ -95,25 +188,20 @@ class AndorCCD(object):
             self.set_num_kinetics(1)
 
         # EM gain
-        self.em_mode = self.has_em_ccd()
         if self.em_mode:
-            self.get_EM_gain_range()
             self.get_EMCCD_gain()
         
         #shift speeds
-        self.read_shift_speeds()
         if initialize_to_defaults:
             if self.em_mode: self.set_hs_speed_em()
             self.set_hs_speed_conventional()
             self.set_vs_speed()
 
         # gains
-        self.get_preamp_gains()
         if initialize_to_defaults:
             self.set_preamp_gain()
 
         # temperature        
-        self.get_temperature_range()
         self.get_temperature()
 
         if initialize_to_defaults:
@@ -130,6 +218,50 @@ class AndorCCD(object):
     
     ##### Initialization Functions
     
+    def _load_andorlib(self):
+        if platform.architecture()[0] == '64bit':
+            andorlibpath = None
+            for path in [r"C:\Program Files\Andor Driver Pack 2\atmcd64d.dll",
+                         r"C:\Program Files\Andor SOLIS\atmcd64d_legacy.dll",]:
+                if os.path.exists(path):
+                    andorlibpath = path
+                    break
+                
+            if andorlibpath is None:    
+                andorlibpath = str(os.path.join(os.path.dirname(__file__),"atmcd64d.dll"))
+        else:
+            andorlibpath = str(os.path.join(os.path.dirname(__file__),"atmcd32d.dll"))
+        #print andorlibpath
+        
+        return windll.LoadLibrary(andorlibpath)
+    
+    def _setup_prototypes(self):
+        """Sets argtypes/restype from SDK_PROTOTYPES once on the dll functions, 
+        so ctypes converts plain python numbers itself and rejects wrong argument
+        types. A simulated SDK (python object) is left as it is."""
+        for name, argtypes in SDK_PROTOTYPES.items():
+            try:
+                func = getattr(self.andorlib, name)
+            except AttributeError: # not in this SDK version
+                continue
+            if isinstance(func, ctypes._CFuncPtr):
+                func.argtypes = argtypes
+                func.restype = c_uint
+    
+    def _setup_scratch(self):
+        """Output arguments of the frequently polled calls, reused under self.lock"""
+        self._status = c_int(-1)
+        self._status_ref = byref(self._status)
+        self._temp = c_int(0)
+        self._temp_ref = byref(self._temp)
+        self._num = at_32(0)
+        self._num_ref = byref(self._num)
+        self._first = at_32(0)
+        self._first_ref = byref(self._first)
+        self._last = at_32(0)
+        self._last_ref = byref(self._last)
+
+    
     def get_head_model(self):
         headModel = ctypes.create_string_buffer(consts.MAX_PATH)
         with self.lock: _err(self.andorlib.GetHeadModel(headModel))
@@ -146,14 +278,14 @@ class AndorCCD(object):
         return serialNumber.value
     
     def get_hardware_version(self):
-        HW = [ c_int(i) for i in range(6) ] 
+        HW = [ c_uint(i) for i in range(6) ] 
         with self.lock: _err(self.andorlib.GetHardwareVersion( *[ byref(h) for h in HW ] ))
         self.hardware_version = tuple([ h.value for h in HW])
         if self.debug: logger.debug('Hardware information: {}'.format( repr(self.hardware_version)))
         return self.hardware_version
     
     def get_software_version(self):
-        SW = [ c_int(i) for i in range(6) ] 
+        SW = [ c_uint(i) for i in range(6) ] 
         with self.lock: _err(self.andorlib.GetSoftwareVersion( *[byref(s) for s in SW] ))
         self.software_version = tuple([ s.value for s in SW ])
         if self.debug: logger.debug('Software information: %s' % repr(self.software_version))
@@ -172,16 +304,14 @@ class AndorCCD(object):
     
     def get_num_ad_channels(self):
         numADChan = c_int(-1)
-        retval = self.andorlib.GetNumberADChannels(byref(numADChan)) 
-        assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval    
+        with self.lock: _err(self.andorlib.GetNumberADChannels(byref(numADChan)))
         self.numADChan = numADChan.value
         if self.debug: logger.debug( '# of AD channels [expecting one]: %g' % self.numADChan )
         return self.numADChan
     
     def get_num_output_amplifiers(self):
         ampNum = c_int(-1)
-        retval = self.andorlib.GetNumberAmp(byref(ampNum))
-        assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+        with self.lock: _err(self.andorlib.GetNumberAmp(byref(ampNum)))
         self.ampNum = ampNum.value
         if self.debug: logger.debug( 'Number of output amplifiers: %g' % self.ampNum ) 
         return self.ampNum
@@ -208,6 +338,70 @@ class AndorCCD(object):
     
     
     
+    ##### Capabilities #####
+    
+    def capability_key(self):
+        """camera serial number and SDK version, capabilities are cached per key"""
+        return "{}-{}".format(self.serialNumber, ".".join(str(v) for v in self.software_version))
+    
+    def read_capabilities(self):
+        """queries the static camera properties, returns get_capabilities()"""
+        self.get_head_model()
+        self.get_hardware_version()
+        self.get_detector_shape()
+        self.get_num_ad_channels()
+        self.get_num_output_amplifiers()
+        self.em_mode = self.has_em_ccd() # also reads the EM gain range
+        self.read_shift_speeds()
+        self.get_preamp_gains()
+        self.get_temperature_range()
+        return self.get_capabilities()
+    
+    def get_capabilities(self):
+        """camera capabilities read during initialization (no SDK calls)"""
+        return dict(
+            head_model=self.headModel,
+            serial_number=self.serialNumber,
+            hardware_version=list(self.hardware_version),
+            software_version=list(self.software_version),
+            Nx=self.Nx, Ny=self.Ny,
+            numADChan=self.numADChan,
+            ampNum=self.ampNum,
+            em_mode=self.em_mode,
+            em_gain_range=tuple(getattr(self, 'em_gain_range', (0, 0))),
+            HSSpeeds_EM=[list(speeds) for speeds in self.HSSpeeds_EM],
+            HSSpeeds_Conventional=[list(speeds) for speeds in self.HSSpeeds_Conventional],
+            VSSpeeds=list(self.VSSpeeds),
+            preamp_gains=list(self.preamp_gains),
+            temperature_range=(self.min_temp, self.max_temp),
+            )
+    
+    def set_capabilities(self, caps):
+        """uses caps (from get_capabilities() of an earlier session) instead
+        of read_capabilities(), if it belongs to this camera and SDK version.
+        Returns True if caps was used"""
+        if (not caps or caps['serial_number'] != self.serialNumber
+                or tuple(caps['software_version']) != self.software_version):
+            return False
+        self.headModel = caps['head_model']
+        self.hardware_version = tuple(caps['hardware_version'])
+        self.Nx, self.Ny = caps['Nx'], caps['Ny']
+        self.numADChan = caps['numADChan']
+        self.ampNum = caps['ampNum']
+        self.em_mode = caps['em_mode']
+        if self.em_mode:
+            self.em_gain_range = tuple(caps['em_gain_range'])
+        self.HSSpeeds_EM = [list(speeds) for speeds in caps['HSSpeeds_EM']]
+        self.HSSpeeds_Conventional = [list(speeds) for speeds in caps['HSSpeeds_Conventional']]
+        self.numHSSpeeds_EM = [len(speeds) for speeds in self.HSSpeeds_EM] if self.em_mode else []
+        self.numHSSpeeds_Conventional = [len(speeds) for speeds in self.HSSpeeds_Conventional]
+        self.VSSpeeds = list(caps['VSSpeeds'])
+        self.numVSSpeeds = len(self.VSSpeeds)
+        self.preamp_gains = list(caps['preamp_gains'])
+        self.numGains = len(self.preamp_gains)
+        self.min_temp, self.max_temp = caps['temperature_range']
+        return True
+    
     #####    
     
     def set_ad_channel(self,chan_i=0):
@@ -218,17 +412,149 @@ class AndorCCD(object):
     
     
     def create_buffer(self):
+        if self.buffer_deferred:
+            # allocated once at the end of defer_buffer()
+            self.buffer_pending = True
+            return getattr(self, 'buffer', None)
         if self.aq_mode in ('single', 'accumulate', 'run_till_abort'):
-            self.buffer = np.zeros(shape=(self.Ny_ro, self.Nx_ro), dtype=np.int32 )     
+            self.buffer = np.zeros(shape=(self.Ny_ro, self.Nx_ro), dtype=self.buffer_dtype)     
+        elif self.aq_mode == 'fast_kinetics':
+            self.buffer = np.zeros(shape=(self.fk_series_length, self.Ny_ro, self.Nx_ro), dtype=self.buffer_dtype)
         elif self.aq_mode == 'kinetic':
             self.get_num_kinetics()
-            self.buffer = np.zeros(shape=(self.num_kin, self.Ny_ro, self.Nx_ro), dtype=np.int32)
+            # a streamed series is drained with get_images, no need to hold all frames
+            n_frames = 1 if self.kinetic_stream else self.num_kin
+            self.buffer = np.zeros(shape=(n_frames, self.Ny_ro, self.Nx_ro), dtype=self.buffer_dtype)
         else:
             raise ValueError("Andor Unkown acq mode {}".format(self.aq_mode))
         print(self.buffer.shape)
+        if self.aq_mode == 'run_till_abort':
+            self.create_ring_buffer()
         return self.buffer
     
     
+    @contextmanager
+    def defer_buffer(self):
+        """Holds the driver lock and postpones create_buffer() (and the
+        ring buffer) until the block is left, so a series of readout and
+        acquisition settings allocates the buffers once."""
+        if self.buffer_deferred: # nested
+            yield
+            return
+        with self.lock:
+            self.buffer_deferred = True
+            self.buffer_pending = False
+            try:
+                yield
+            finally:
+                self.buffer_deferred = False
+                if self.buffer_pending:
+                    self.buffer_pending = False
+                    self.create_buffer()
+    
+    def set_buffer_dtype(self, dtype='int32'):
+        """'int32' or 'uint16'. uint16 buffers are filled with the 16 bit
+        SDK calls (GetAcquiredData16, GetImages16, GetOldestImage16) and halve
+        the memory traffic of every copy downstream. The ADC is 16 bit, only
+        accumulations can exceed the uint16 range."""
+        dtype = np.dtype(dtype)
+        assert dtype.name in BUFFER_DTYPES
+        self.buffer_dtype = dtype
+        if hasattr(self, 'buffer'):
+            self.create_buffer()
+    
+    def _data_func(self, name, arr):
+        """SDK retrieval function matching the dtype of arr and the address of its data"""
+        if not arr.flags.c_contiguous:
+            raise ValueError("SDK data buffers must be C contiguous")
+        func = getattr(self.andorlib, name + BUFFER_DTYPES[arr.dtype.name])
+        return func, arr.ctypes.data
+    
+    def set_kinetic_stream(self, stream=True):
+        """When streaming, kinetic series are retrieved frame by frame with
+        get_number_new_images/get_images and create_buffer does not
+        allocate the full (num_kin, Ny_ro, Nx_ro) series"""
+        self.kinetic_stream = bool(stream)
+        if hasattr(self, 'buffer') and self.aq_mode == 'kinetic':
+            self.create_buffer()
+    
+    
+    ##### Ring buffer for run_till_abort streaming #####
+    
+    def set_ring_size(self, n_frames):
+        self.ring_size = int(n_frames)
+        if self.buffer_deferred:
+            self.buffer_pending = True
+        elif hasattr(self, 'ring'):
+            self.create_ring_buffer()
+    
+    def create_ring_buffer(self):
+        """Preallocates ring_size frames that poll_ring_buffer() drains
+        the SDK circular buffer into"""
+        self.ring = np.zeros((self.ring_size, self.Ny_ro, self.Nx_ro), dtype=self.buffer_dtype)
+        self.ring_frame_index = np.zeros(self.ring_size, dtype=np.int64)
+        self._ring_arange = np.arange(self.ring_size, dtype=np.int64)
+        # slot addresses are computed from the base address instead of per call
+        self._ring_func, self._ring_addr = self._data_func('GetImages', self.ring)
+        self._ring_frame_size = self.Ny_ro*self.Nx_ro
+        self.reset_ring_buffer()
+        return self.ring
+    
+    def reset_ring_buffer(self):
+        self.ring_write = 0 # total number of frames written to the ring
+        self.ring_read = 0 # total number of frames released by consumers
+        self.ring_last_index = 0 # SDK index of the last image drained
+        self.ring_overruns = 0 # images overwritten in the SDK before they were drained
+    
+    def poll_ring_buffer(self):
+        """Drains new images from the SDK circular buffer into the ring
+        with a single GetImages call.
+        
+        Returns (frame_indices, frames): views into the ring of the slots
+        filled by this call (empty if there was nothing new or no free slot).
+        Slots stay valid until they are handed back with release_ring_frames().
+        Images that were overwritten in the SDK circular buffer before they
+        could be drained are counted in ring_overruns.
+        """
+        if (not hasattr(self, 'ring') or self.ring.shape[1:] != (self.Ny_ro, self.Nx_ro)
+                or self.ring.dtype != self.buffer_dtype):
+            self.create_ring_buffer()
+        
+        new_images = self.get_number_new_images()
+        if new_images is None:
+            return self.ring_frame_index[:0], self.ring[:0]
+        first, last = new_images
+        
+        if first > self.ring_last_index + 1:
+            self.ring_overruns += first - self.ring_last_index - 1
+        
+        # only fill contiguous free slots, a wrap-around is drained on the next poll
+        slot = self.ring_write % self.ring_size
+        n_free = self.ring_size - (self.ring_write - self.ring_read)
+        count = min(last - first + 1, n_free, self.ring_size - slot)
+        if count <= 0:
+            return self.ring_frame_index[:0], self.ring[:0]
+        last = first + count - 1
+        
+        frames = self.ring[slot:slot+count]
+        size = self._ring_frame_size
+        self._get_images(self._ring_func, first, last,
+                         self._ring_addr + slot*size*self.ring.itemsize, count*size)
+        frame_indices = self.ring_frame_index[slot:slot+count]
+        np.add(self._ring_arange[:count], first, out=frame_indices)
+        
+        self.ring_write += count
+        self.ring_last_index = last
+        return frame_indices, frames
+    
+    def release_ring_frames(self, count=None):
+        """Hands the oldest *count* (default: all) ring slots back for reuse"""
+        if count is None:
+            self.ring_read = self.ring_write
+        else:
+            self.ring_read = min(self.ring_read + count, self.ring_write)
+    
+    
     ##### ReadOut Modes #######################
     def set_readout_mode(self, ro_mode):
         if (ro_mode == AndorReadMode.FullVerticalBinning):
@@ -236,9 +562,10 @@ class AndorCCD(object):
         elif (ro_mode == AndorReadMode.Image):
             self.set_ro_image_mode()
         elif (ro_mode == AndorReadMode.MultiTrack):
-            raise NotImplementedError()
+            self.set_ro_multi_track(2, 10, 0)
         elif (ro_mode == AndorReadMode.RandomTrack):
-            raise NotImplementedError()
+            self.set_ro_random_track([(self.Ny//4 - 5, self.Ny//4 + 4), 
+                                      (3*self.Ny//4 - 5, 3*self.Ny//4 + 4)])
         elif (ro_mode == AndorReadMode.SingleTrack):
             self.set_ro_single_track(256, 20)
     
@@ -251,7 +578,7 @@ class AndorCCD(object):
             Image = 4)
         
         readout_mode_id = read_mode_dict[name]
-        self.set_readmode(readout_mode_id)
+        self.set_read_mode(readout_mode_id)
         
             
     def set_read_mode(self, mode_id):
@@ -283,18 +610,51 @@ class AndorCCD(object):
         
         self.create_buffer()
         
-    def set_ro_multi_track(self, number, height, offset):
-        # NOT YET IMPLEMENTED
-        # SetReadMode(1)
-        # SetMulitTrack
-        raise NotImplementedError
-        #returns bottom, gap
+    def set_ro_multi_track(self, number, height, offset=0, hbin=1):
+        """Read out *number* tracks of *height* rows, evenly spread over the
+        sensor and shifted by *offset* rows. Each track is binned on the chip
+        into one row of the readout.
+        returns bottom (first row of the first track) and gap (rows between tracks)
+        """
+        self.ro_mode = 'MULTI_TRACK'
+        bottom = c_int(0)
+        gap = c_int(0)
+        with self.lock: _err(self.andorlib.SetReadMode(1))
+        with self.lock: _err(self.andorlib.SetMultiTrack(c_int(number), c_int(height), c_int(offset),
+                                                         byref(bottom), byref(gap)))
+        with self.lock: _err(self.andorlib.SetMultiTrackHBin(c_int(hbin)))
+        
+        self.ro_track_hbin = hbin
+        self.ro_multi_track_bottom = bottom.value
+        self.ro_multi_track_gap = gap.value
+        self.ro_tracks = [(bottom.value + i*(height + gap.value), 
+                           bottom.value + i*(height + gap.value) + height - 1)
+                          for i in range(number)]
+        self.Nx_ro = int(self.Nx/hbin)
+        self.Ny_ro = number
+        
+        self.create_buffer()
+        return self.ro_multi_track_bottom, self.ro_multi_track_gap
+        
+    def set_ro_random_track(self, positions, hbin=1):
+        """Read out arbitrary tracks, *positions* is a sequence of 
+        (first_row, last_row) pairs (1-based, inclusive, ascending) 
+        or the equivalent flat list. Each track is one row of the readout.
+        """
+        self.ro_mode = 'RANDOM_TRACK'
+        positions = np.asarray(positions, dtype=int).reshape(-1, 2)
+        n_tracks = len(positions)
+        areas = (c_int*(2*n_tracks))(*positions.flatten())
+        with self.lock: _err(self.andorlib.SetReadMode(2))
+        with self.lock: _err(self.andorlib.SetRandomTracks(c_int(n_tracks), areas))
+        with self.lock: _err(self.andorlib.SetCustomTrackHBin(c_int(hbin)))
+        
+        self.ro_track_hbin = hbin
+        self.ro_tracks = [tuple(p) for p in positions.tolist()]
+        self.Nx_ro = int(self.Nx/hbin)
+        self.Ny_ro = n_tracks
         
-    def set_ro_random_track(self, positions):
-        # NOT YET IMPLEMENTED
-        # SetReadMode(2)
-        #SetRandomTracks(numberoftracks, positionarray)
-        raise NotImplementedError
+        self.create_buffer()
     
     def set_ro_image_mode(self,hbin=1,vbin=1,hstart=1,hend=None,vstart=1,vend=None):
         self.ro_mode = 'IMG'
@@ -330,22 +690,30 @@ class AndorCCD(object):
 
     ### Function to return the binning based on the current readout mode ####
     def get_current_hbin(self):
+        if getattr(self, 'aq_mode', None) == 'fast_kinetics':
+            return self.fk_hbin
         if self.ro_mode == 'IMG':
             return self.hbin
         elif self.ro_mode == 'SINGLE_TRACK':
             return self.ro_st_hbin
         elif self.ro_mode == 'FULL_VERTICAL_BINNING':
             return self.ro_fvb_hbin
+        elif self.ro_mode in ('MULTI_TRACK', 'RANDOM_TRACK'):
+            return self.ro_track_hbin
     
     
     ##### Acquisition Modes #####
     def set_aq_mode(self, mode):
         print('set_aq_mode', mode)
-        assert mode in ('single', 'accumulate', 'kinetic', 'run_till_abort')
-        if mode == 'single': return self.set_aq_single_scan()
-        if mode == 'accumulate': return self.set_aq_accumulate_scan()
-        if mode == 'kinetic': return self.set_aq_kinetic_scan()
-        if mode == 'run_till_abort': return self.set_aq_run_till_abort_scan()
+        assert mode in ('single', 'accumulate', 'kinetic', 'run_till_abort', 'fast_kinetics')
+        if mode == 'single': self.set_aq_single_scan()
+        if mode == 'accumulate': self.set_aq_accumulate_scan()
+        if mode == 'kinetic': self.set_aq_kinetic_scan()
+        if mode == 'run_till_abort': self.set_aq_run_till_abort_scan()
+        if mode == 'fast_kinetics': self.set_aq_fast_kinetic_scan()
+        # the data buffer shape depends on the acquisition mode
+        if hasattr(self, 'buffer'):
+            self.create_buffer()
         
     def get_aq_mode(self):
         return self.aq_mode
@@ -399,13 +767,64 @@ class AndorCCD(object):
         with self.lock: _err(self.andorlib.SetAcquisitionMode(5))
         print('set_aq_run_till_abort_scan')
         
-    def set_aq_fast_kinetic_scan(self):
-        # NOT YET IMPLEMENTED
-        raise NotImplementedError()
+    def set_aq_fast_kinetic_scan(self, exposed_rows=None, series_length=None, 
+                                 exposure_time=None, offset=None):
+        """Fast kinetics: only exposed_rows of the sensor are exposed, then shifted
+        under the mask, series_length times, and the whole series is read out 
+        at the end. Uses FVB or the image binning of the current readout mode."""
+        self.aq_mode = 'fast_kinetics'
+        with self.lock: _err(self.andorlib.SetAcquisitionMode(4))
+        self.set_fast_kinetics(exposed_rows, series_length, exposure_time, offset)
+    
+    def set_fast_kinetics(self, exposed_rows=None, series_length=None, 
+                          exposure_time=None, offset=None):
+        """Sets the fast kinetics parameters, None keeps the previous value.
+        The readout shape is only updated while in fast_kinetics mode"""
+        if exposed_rows is not None: self.fk_exposed_rows = exposed_rows
+        if series_length is not None: self.fk_series_length = series_length
+        if exposure_time is not None: self.fk_exposure_time = exposure_time
+        if offset is not None: self.fk_offset = offset
+        
+        if getattr(self, 'ro_mode', None) == 'FULL_VERTICAL_BINNING':
+            fk_mode, hbin, vbin = 0, self.ro_fvb_hbin, 1
+        elif getattr(self, 'ro_mode', None) == 'IMG':
+            fk_mode, hbin, vbin = 4, self.hbin, self.vbin
+        else:
+            fk_mode, hbin, vbin = 4, 1, 1
+        
+        with self.lock: _err(self.andorlib.SetFastKineticsEx(
+                                c_int(self.fk_exposed_rows), c_int(self.fk_series_length),
+                                c_float(self.fk_exposure_time), c_int(fk_mode),
+                                c_int(hbin), c_int(vbin), c_int(self.fk_offset)))
+        self.get_fk_exposure_time()
+        
+        if getattr(self, 'aq_mode', None) == 'fast_kinetics':
+            self.fk_hbin = hbin
+            self.Nx_ro = int(self.Nx/hbin)
+            self.Ny_ro = 1 if fk_mode == 0 else int(self.fk_exposed_rows/vbin)
+            self.create_buffer()
+    
+    def get_fk_exposure_time(self):
+        """actual fast kinetics exposure time [s]"""
+        t = c_float(0)
+        with self.lock: _err(self.andorlib.GetFKExposureTime(byref(t)))
+        self.fk_exposure_time = t.value
+        return self.fk_exposure_time
                 
     def set_aq_frame_transfer_scan(self):
-        # NOT YET IMPLEMENTED
-        raise NotImplementedError()
+        """Frame transfer is not an acquisition mode of its own in the SDK,
+        it overlaps exposure and readout of kinetic and run_till_abort series.
+        Enables frame transfer and streams with run_till_abort."""
+        self.set_frame_transfer(True)
+        self.set_aq_run_till_abort_scan()
+    
+    def set_frame_transfer(self, enable=True):
+        """Frame transfer mode (frame transfer sensors only): the image is shifted
+        to the masked storage area and the next exposure starts while it is read 
+        out, so there is no dead time between exposures of kinetic and
+        run_till_abort series. The cycle time is then set by max(exposure, readout)."""
+        with self.lock: _err(self.andorlib.SetFrameTransferMode(c_int(bool(enable))))
+        self.frame_transfer = bool(enable)
                 
     
     ##### Triggering ##########
@@ -420,8 +839,17 @@ class AndorCCD(object):
 
     def set_trigger_mode(self, mode='internal'):
         mode = mode.lower()
-        retval = self.andorlib.SetTriggerMode(self.trigger_modes[mode])
-        assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+        with self.lock: _err(self.andorlib.SetTriggerMode(self.trigger_modes[mode]))
+    
+    def is_trigger_mode_available(self, mode):
+        with self.lock:
+            retval = self.andorlib.IsTriggerModeAvailable(self.trigger_modes[mode.lower()])
+        return retval == consts.DRV_SUCCESS
+    
+    def send_software_trigger(self):
+        """Starts one exposure in 'software' trigger mode. The camera has
+        to be ready for it: the previous triggered image is read out"""
+        with self.lock: _err(self.andorlib.SendSoftwareTrigger())
     
     ####### Shift Speeds and Gain ##########
     
@@ -432,16 +860,13 @@ class AndorCCD(object):
         self.numHSSpeeds_Conventional = []
         for chan_i in range(self.numADChan):
             if self.em_mode:
-                retval = self.andorlib.GetNumberHSSpeeds(chan_i, 0, byref(numHSSpeeds)) # EM mode
-                assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+                with self.lock: _err(self.andorlib.GetNumberHSSpeeds(chan_i, 0, byref(numHSSpeeds))) # EM mode
                 self.numHSSpeeds_EM.append(numHSSpeeds.value)
                 
-                retval = self.andorlib.GetNumberHSSpeeds(chan_i, 1, byref(numHSSpeeds)) # conventional mode mode
-                assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+                with self.lock: _err(self.andorlib.GetNumberHSSpeeds(chan_i, 1, byref(numHSSpeeds))) # conventional mode mode
                 self.numHSSpeeds_Conventional.append(numHSSpeeds.value)
             else:
-                retval = self.andorlib.GetNumberHSSpeeds(chan_i, 0, byref(numHSSpeeds)) # EM mode
-                assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+                with self.lock: _err(self.andorlib.GetNumberHSSpeeds(chan_i, 0, byref(numHSSpeeds))) # EM mode
                 self.numHSSpeeds_Conventional.append(numHSSpeeds.value)
 
         logger.debug('# of horizontal speeds EM: {}'.format(self.numHSSpeeds_EM))
@@ -455,8 +880,7 @@ class AndorCCD(object):
             if self.em_mode:
                 hsspeeds = self.HSSpeeds_EM[chan_i]
                 for i in range(self.numHSSpeeds_EM[chan_i]):
-                    retval = self.andorlib.GetHSSpeed(chan_i, 0, i, byref(speed)) # EM mode
-                    assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+                    with self.lock: _err(self.andorlib.GetHSSpeed(chan_i, 0, i, byref(speed))) # EM mode
                     hsspeeds.append(speed.value)
                 conventional_index = 1
             else:
@@ -466,8 +890,7 @@ class AndorCCD(object):
             hsspeeds = self.HSSpeeds_Conventional[chan_i]
             for i in range(self.numHSSpeeds_Conventional[chan_i]):
                 #print chan_i, i
-                retval = self.andorlib.GetHSSpeed(chan_i,  conventional_index, i, byref(speed)) # Conventional mode
-                assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+                with self.lock: _err(self.andorlib.GetHSSpeed(chan_i,  conventional_index, i, byref(speed))) # Conventional mode
                 hsspeeds.append(speed.value)
             
 
@@ -475,18 +898,18 @@ class AndorCCD(object):
         logger.debug('Conventional Horizontal speeds: {} MHz'.format(self.HSSpeeds_Conventional))        
         #Vertical  speeds
         numVSSpeeds = c_int(-1)
-        retval = self.andorlib.GetNumberVSSpeeds(byref(numVSSpeeds))
-        if retval == 20991: # DRV_NOT_SUPPORTED, for the case of iDus IR InGaAs single line detectors
+        with self.lock:
+            retval = self.andorlib.GetNumberVSSpeeds(byref(numVSSpeeds))
+        if retval == consts.DRV_NOT_SUPPORTED: # for the case of iDus IR InGaAs single line detectors
             self.numVSSpeeds = 0
         else:
-            assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+            _err(retval)
             self.numVSSpeeds = numVSSpeeds.value
 
         self.VSSpeeds = []
         speed = c_float(0)
         for i in range(self.numVSSpeeds):
-            retval = self.andorlib.GetVSSpeed(i, byref(speed))
-            assert retval == consts.DRV_SUCCESS, "Andor DRV Failure %i" % retval
+            with self.lock: _err(self.andorlib.GetVSSpeed(i, byref(speed)))
             self.VSSpeeds.append(speed.value)
         if self.debug: logger.debug( 'Vertical speeds [microseconds per pixel shift]: %s' % self.VSSpeeds)
     
@@ -555,17 +978,26 @@ class AndorCCD(object):
     
     ####### Shutter Control ##########
     
+    # SetShutter closing and opening times [ms], the shutter is moved for
+    # every exposure in auto mode
+    shutter_closing_time = 0
+    shutter_opening_time = 0
+    shutter_auto = False
+    
     def set_shutter_auto(self):
-        with self.lock: _err(self.andorlib.SetShutter(0, 0, 0, 0))
+        with self.lock: _err(self.andorlib.SetShutter(0, 0, self.shutter_closing_time, self.shutter_opening_time))
+        self.shutter_auto = True
         
     def set_shutter_open(self, open=True):
         if open:
             with self.lock: _err(self.andorlib.SetShutter(0, 1, 0, 0))
+            self.shutter_auto = False
         else:
             self.set_shutter_close()
             
     def set_shutter_close(self):
         with self.lock: _err(self.andorlib.SetShutter(0, 2, 0, 0))
+        self.shutter_auto = False
     
     
     ####### Temperature Control ###########
@@ -600,15 +1032,15 @@ class AndorCCD(object):
         self.get_temperature()
 
     def get_temperature(self):
-        lastTemp = c_int(0)
         with self.lock:
-            retval = self.andorlib.GetTemperature(byref(lastTemp))
+            retval = self.andorlib.GetTemperature(self._temp_ref)
+            temp = self._temp.value
         if retval == consts.DRV_ACQUIRING:
             raise IOError( "Camera busy acquiring" )
         elif retval in (consts.DRV_NOT_INITIALIZED, consts.DRV_ERROR_ACK):
             _err(retval)
         else:
-            self.temperature = lastTemp.value
+            self.temperature = temp
             self.temperature_status_num = retval
             return self.temperature
 
@@ -647,9 +1079,87 @@ class AndorCCD(object):
     
     def start_acquisition(self):
         with self.lock: _err(self.andorlib.StartAcquisition())
+        if hasattr(self, 'ring'):
+            self.reset_ring_buffer()
 
     def abort_acquisition(self):
         with self.lock: _err(self.andorlib.AbortAcquisition())
+    
+    # longest single WaitForAcquisitionTimeOut call, sets how quickly
+    # wait_for_acquisition reacts to interrupt_func
+    wait_slice = 0.05 # seconds
+    
+    def wait_for_acquisition(self, timeout=None, interrupt_func=None):
+        """Blocks until the driver signals the end of the acquisition
+        (single, accumulate, kinetic) or a new image (run_till_abort).
+        
+        Uses WaitForAcquisitionTimeOut, so the thread sleeps in the driver
+        instead of polling GetStatus. The driver lock is not held while
+        waiting, other threads can keep talking to the camera.
+        
+        timeout: seconds, None waits indefinitely
+        interrupt_func: called between wait slices, e.g.
+            lambda: self.interrupt_measurement_called, stops waiting when True
+        
+        Returns True on completion / new image, False on timeout,
+        interruption or cancel_wait()
+        """
+        t_end = None if timeout is None else time.perf_counter() + timeout
+        self._wait_cancelled = False
+        while True:
+            if interrupt_func is not None and interrupt_func():
+                return False
+            dt = self.wait_slice
+            if t_end is not None:
+                dt = min(dt, t_end - time.perf_counter())
+            retval = self.andorlib.WaitForAcquisitionTimeOut(max(int(1000*dt), 0))
+            if self._wait_cancelled:
+                return False
+            if retval == consts.DRV_SUCCESS:
+                if self.aq_mode == 'run_till_abort' or self.get_status() == 'IDLE':
+                    return True
+            elif retval == consts.DRV_NO_NEW_DATA:
+                # the acquisition can end before the wait was entered
+                if self.aq_mode != 'run_till_abort' and self.get_status() == 'IDLE':
+                    return True
+            else:
+                _err(retval)
+            if t_end is not None and time.perf_counter() >= t_end:
+                return False
+    
+    def wait_for_images(self, n_images, timeout=None, interrupt_func=None):
+        """Blocks until n_images images of the current acquisition are
+        acquired, e.g. the image of the last trigger of a triggered kinetic
+        series. Waits in the driver like wait_for_acquisition.
+        
+        Returns True when the images are there, False on timeout,
+        interruption, cancel_wait() or if the acquisition stopped short
+        """
+        t_end = None if timeout is None else time.perf_counter() + timeout
+        self._wait_cancelled = False
+        while self.get_total_number_images_acquired() < n_images:
+            if interrupt_func is not None and interrupt_func():
+                return False
+            dt = self.wait_slice
+            if t_end is not None:
+                dt = min(dt, t_end - time.perf_counter())
+            retval = self.andorlib.WaitForAcquisitionTimeOut(max(int(1000*dt), 0))
+            if self._wait_cancelled:
+                return False
+            if retval == consts.DRV_NO_NEW_DATA:
+                if (self.get_status() == 'IDLE' 
+                        and self.get_total_number_images_acquired() < n_images):
+                    return False
+            elif retval != consts.DRV_SUCCESS:
+                _err(retval)
+            if t_end is not None and time.perf_counter() >= t_end:
+                return self.get_total_number_images_acquired() >= n_images
+        return True
+    
+    def cancel_wait(self):
+        """Makes a wait_for_acquisition() in another thread return False"""
+        self._wait_cancelled = True
+        with self.lock: _err(self.andorlib.CancelWait())
 
     _status_name_dict = {
         consts.DRV_IDLE: "IDLE",
@@ -662,16 +1172,17 @@ class AndorCCD(object):
         consts.DRV_SPOOLERROR: "SPOOLERROR",
     }
     def get_status(self):
-        status = c_int(-1)
-        with self.lock: _err(self.andorlib.GetStatus(byref(status)))
-        self.status_id   = status.value
+        with self.lock:
+            _err(self.andorlib.GetStatus(self._status_ref))
+            self.status_id = self._status.value
         self.status_name = self._status_name_dict[self.status_id]
         return self.status_name            
 
     
     def get_acquired_data(self):
         #print("buffer size", self.buffer.size)
-        with self.lock: _err(self.andorlib.GetAcquiredData(self.buffer.ctypes.data_as(ctypes.POINTER(c_long)), c_uint(self.buffer.size)))
+        func, addr = self._data_func('GetAcquiredData', self.buffer)
+        with self.lock: _err(func(addr, self.buffer.size))
         return self.buffer
 
     
@@ -689,6 +1200,25 @@ class AndorCCD(object):
         self.kinetic_cycle_time = kinetic.value
         
         return self.exposure_time, self.accumulation_time, self.kinetic_cycle_time  
+    
+    def get_keep_clean_time(self):
+        """duration of a keep clean cycle [s], which can delay the start of
+        an exposure, 0 if the SDK does not report it"""
+        t = c_float(0)
+        try:
+            with self.lock: retval = self.andorlib.GetKeepCleanTime(byref(t))
+        except AttributeError: # not in this SDK version
+            return 0.0
+        return t.value if retval == consts.DRV_SUCCESS else 0.0
+    
+    def get_exposure_end_margin(self, latency=5e-3):
+        """time [s] after StartAcquisition (or a trigger) and the exposure
+        time by which the exposure has surely ended: a keep clean cycle, the
+        shutter opening and closing in auto mode and the call latency"""
+        margin = self.get_keep_clean_time() + latency
+        if self.shutter_auto:
+            margin += 1e-3*(self.shutter_opening_time + self.shutter_closing_time)
+        return margin
         
     
     def set_exposure_time(self, dt):
@@ -714,6 +1244,8 @@ class AndorCCD(object):
         print('set_num_kinetics', num)
         with self.lock: _err(self.andorlib.SetNumberKinetics(int(num)))
         self.num_kin = num
+        if hasattr(self, 'buffer') and self.aq_mode == 'kinetic' and not self.kinetic_stream:
+            self.create_buffer()
     
     def get_num_kinetics(self):
         return self.num_kin
@@ -726,7 +1258,7 @@ class AndorCCD(object):
     
     ###### Electron Multiplication Mode (EM) ########
     def set_EM_advanced(self, state=True):
-        with self.lock: _err(self.andorlib.SetEMGainRange(c_int(state)))
+        with self.lock: _err(self.andorlib.SetEMAdvanced(c_int(state)))
         
     def get_EM_gain_range(self):
         low, high = c_int(-1), c_int(-1)
@@ -756,9 +1288,9 @@ class AndorCCD(object):
         with self.lock: _err(self.andorlib.ShutDown())
     
     def get_total_number_images_acquired(self):
-        num = c_long(0)
-        with self.lock: _err(self.andorlib.GetTotalNumberImagesAcquired(byref(num)))
-        return num.value
+        with self.lock:
+            _err(self.andorlib.GetTotalNumberImagesAcquired(self._num_ref))
+            return self._num.value
     
     def get_number_new_images(self):
         """
@@ -769,37 +1301,40 @@ class AndorCCD(object):
         latest images. If any images are overwritten in
          the circular buffer they can no longer be retrieved
          and the information returned will treat overwritten images as having been retrieved.
+        
+        returns (first, last) or None if there are no new images
         """
-        first = c_long(0)
-        last = c_long(0)
-        with self.lock: _err(self.andorlib.GetNumberNewImages(byref(first),byref(last)))
-        return first.value, last.value
+        with self.lock:
+            retval = self.andorlib.GetNumberNewImages(self._first_ref, self._last_ref)
+            first, last = self._first.value, self._last.value
+        if retval == consts.DRV_NO_NEW_DATA:
+            return None
+        _err(retval)
+        return first, last
     
     def get_number_available_images(self):
-        first = c_long(0)
-        last = c_long(0)
-        with self.lock: _err(self.andorlib.GetNumberAvailableImages(byref(first),byref(last)))
-        return first.value, last.value
+        with self.lock:
+            _err(self.andorlib.GetNumberAvailableImages(self._first_ref, self._last_ref))
+            return self._first.value, self._last.value
     
     def get_images(self,first,last, buf):
-        validfirst = c_long(0)
-        validlast = c_long(0)
-        
-        with self.lock: _err(self.andorlib.GetImages(c_long(first), c_long(last), 
-                                buf.ctypes.data_as(ctypes.POINTER(c_long)),
-                                c_uint(buf.size),
-                                byref(validfirst),byref(validlast)))
-        
-        return validfirst, validlast, buf
+        """Retrieves images first..last (1-based SDK indices) into buf.
+        returns validfirst, validlast, buf"""
+        func, addr = self._data_func('GetImages', buf)
+        return self._get_images(func, first, last, addr, buf.size) + (buf,)
+    
+    def _get_images(self, func, first, last, addr, size):
+        with self.lock:
+            _err(func(first, last, addr, size, self._first_ref, self._last_ref))
+            return self._first.value, self._last.value
 
     def get_oldest_image(self, arr=None):
         if arr is None:
-            arr = np.zeros((self.Ny_ro, self.Nx_ro), dtype=np.int32)
+            arr = np.zeros((self.Ny_ro, self.Nx_ro), dtype=self.buffer_dtype)
          
-        arr_ptr = arr.ctypes.data_as(ctypes.POINTER(c_long))
-        arr_size = c_uint(arr.size)
+        func, addr = self._data_func('GetOldestImage', arr)
         with self.lock:
-            retval = self.andorlib.GetOldestImage(arr_ptr, arr_size)
+            retval = func(addr, arr.size)
         #print("GetOldestImage", retval)
         if retval == consts.DRV_NO_NEW_DATA: # DRV_NO_NEW_DATA
             #print("no new data")
@@ -0,0 +1,911 @@
+'''
+Simulated Andor SDK (atmcd) for running the AndorCCD stack without a camera.
+
+AndorSDKSim exposes the same function names and calling conventions as the
+atmcd32d/atmcd64d dll, so it can be handed to AndorCCD(andorlib=...) in place
+of windll.LoadLibrary(...). Output arguments are written through the
+byref()/pointer() objects the interface passes in, data is written into the
+numpy buffers behind the ctypes pointers, and every call returns a DRV_* code.
+
+Exposure, readout, accumulation and kinetic cycle times are modeled so that
+acquisition loops can be profiled for frames/s and latency on any platform.
+'''
+from __future__ import absolute_import, print_function, division
+import ctypes
+import time
+import bisect
+import threading
+import numpy as np
+
+from . import andor_ccd_consts as consts
+
+
+def _in(x):
+    """value of an input argument, either a python number or a ctypes object"""
+    return getattr(x, 'value', x)
+
+
+def _out(ref, value):
+    """write value to an output argument created with byref() or pointer()"""
+    obj = ref._obj if hasattr(ref, '_obj') else ref.contents
+    obj.value = value
+
+
+def _as_array(ptr, size, dtype=np.int32):
+    """numpy view of the memory behind a ctypes data pointer"""
+    ctype = np.ctypeslib.as_ctypes_type(dtype)
+    return np.ctypeslib.as_array(ctypes.cast(ptr, ctypes.POINTER(ctype)), shape=(size,))
+
+
+class AndorSDKSim(object):
+
+    # number of noisy frames that are pre-computed per readout configuration
+    N_BANK = 8
+
+    def __init__(self, width=512, height=512, em_ccd=True, num_ad_channels=1,
+                 circular_buffer_size=256, seed=0):
+        self.Nx = width
+        self.Ny = height
+        self.em_ccd = em_ccd
+        self.num_ad_channels = num_ad_channels
+        self.circular_buffer_size = circular_buffer_size
+        self.rng = np.random.default_rng(seed)
+
+        self.initialized = False
+
+        # capabilities
+        self.hs_speeds = {0: [10.0, 5.0, 3.0, 1.0],  # EM amplifier, MHz
+                          1: [3.0, 1.0, 0.05]}       # conventional amplifier, MHz
+        if not em_ccd:
+            self.hs_speeds = {0: self.hs_speeds[1]}
+        self.vs_speeds = [0.6, 1.13, 2.2, 4.33]  # us per row shift
+        self.preamp_gains = [1.0, 2.0, 4.0]
+        self.em_gain_range = (1, 1000)
+        self.temperature_range = (-100, 30)
+
+        # settings
+        self.ad_chan = 0
+        self.hs_type = 0
+        self.hs_index = 0
+        self.vs_index = 0
+        self.preamp_gain_index = 0
+        self.output_amp = 0
+        self.em_gain = 10
+        self.trigger_mode = 0
+        self.hflip = 0
+        self.vflip = 0
+        self.rotation = 0
+        self.shutter_mode = 0
+        self.keep_clean_time = 2e-3
+
+        self.acq_mode = 1
+        self.exposure_time = 0.1
+        self.num_acc = 1
+        self.acc_cycle_time = 0.0
+        self.num_kin = 1
+        self.kin_cycle_time = 0.0
+        self.frame_transfer = 0
+        # fast kinetics: exposed_rows, series_length, exposure, mode, hbin, vbin, offset
+        self.fast_kinetics = (self.Ny//8, 8, 1e-3, 4, 1, 1, 0)
+
+        self.read_mode = 4
+        self.fvb_hbin = 1
+        self.single_track = (self.Ny//2, 1)
+        self.single_track_hbin = 1
+        self.multi_track = self._multi_track_layout(1, 1, 0)
+        self.random_tracks = [(1, self.Ny)]
+        self.track_hbin = 1
+        self.image = (1, 1, 1, self.Nx, 1, self.Ny)
+
+        # temperature model
+        self.cooler_on = False
+        self.temp_setpoint = 20
+        self.temp = 20.0
+        self.temp_t = time.perf_counter()
+        self.temp_tau = 30.0 # seconds
+
+        # acquisition state
+        self.acquiring = False
+        self.acq_t0 = 0.0
+        self.n_acquired = 0
+        self.n_retrieved = 0
+        self.n_events = 0 # acquisition events already returned by WaitForAcquisition
+        self.trigger_done = [] # software trigger: read out times of the triggered frames
+        self.cancel_event = threading.Event()
+        self.frames_dirty = True
+        self._timings_cache = None
+
+        self._base_image = self._make_base_image()
+
+
+    ##### helpers
+
+    def _make_base_image(self):
+        """signal rate [counts/s/pixel] on the full sensor: a few spectral
+        lines plus a broad continuum, on a fiber-like vertical profile"""
+        x = np.arange(self.Nx, dtype=float)
+        y = np.arange(self.Ny, dtype=float)
+        spec = 50 + 200*np.exp(-0.5*((x - 0.4*self.Nx)/(0.2*self.Nx))**2)
+        for x0, amp in [(0.3, 2000), (0.5, 5000), (0.72, 1000)]:
+            spec += amp*np.exp(-0.5*((x - x0*self.Nx)/2.0)**2)
+        profile = np.exp(-0.5*((y - 0.5*self.Ny)/(0.125*self.Ny))**2)
+        return profile[:,None]*spec[None,:]
+
+    def _bin(self, img, vbin, hbin):
+        ny = (img.shape[0]//vbin)*vbin
+        nx = (img.shape[1]//hbin)*hbin
+        img = img[:ny, :nx]
+        return img.reshape(ny//vbin, vbin, nx//hbin, hbin).sum(axis=(1,3))
+
+    def _readout(self, img):
+        """apply the current read mode to a full sensor image"""
+        if self.acq_mode == 4: # fast kinetics, only the exposed rows are read
+            rows, series, exp, mode, hbin, vbin, offset = self.fast_kinetics
+            area = img[offset:offset+rows]
+            if mode == 0:
+                return self._bin(area, rows, hbin)
+            return self._bin(area, vbin, hbin)
+        if self.read_mode == 0: # FVB
+            return self._bin(img, self.Ny, self.fvb_hbin)
+        if self.read_mode == 3: # single track
+            center, width = self.single_track
+            r0 = center - 1 - width//2
+            return self._bin(img[r0:r0+width], width, self.single_track_hbin)
+        if self.read_mode == 4: # image
+            hbin, vbin, hstart, hend, vstart, vend = self.image
+            return self._bin(img[vstart-1:vend, hstart-1:hend], vbin, hbin)
+        if self.read_mode in (1, 2): # multi track, random track
+            return np.concatenate([self._bin(img[r0-1:r1], r1 - r0 + 1, self.track_hbin)
+                                   for r0, r1 in self._tracks()])
+        raise ValueError("read mode {} not simulated".format(self.read_mode))
+
+    def _frame_shape(self):
+        """(rows, columns) of a frame in the current read mode"""
+        if self.acq_mode == 4:
+            rows, series, exp, mode, hbin, vbin, offset = self.fast_kinetics
+            return (1 if mode == 0 else rows//vbin), self.Nx//hbin
+        if self.read_mode == 0:
+            return 1, self.Nx//self.fvb_hbin
+        if self.read_mode == 3:
+            return 1, self.Nx//self.single_track_hbin
+        if self.read_mode in (1, 2):
+            return len(self._tracks()), self.Nx//self.track_hbin
+        hbin, vbin, hstart, hend, vstart, vend = self.image
+        return (vend - vstart + 1)//vbin, (hend - hstart + 1)//hbin
+
+    def _make_frames(self):
+        """precompute a bank of noisy frames for the current configuration"""
+        gain = self.em_gain if (self.em_ccd and self.output_amp == 0) else 1
+        signal = self._readout(self._base_image) * self.exposure_time * gain
+        shape = (self.N_BANK,) + signal.shape
+        frames = (signal
+                  + np.sqrt(np.maximum(signal, 0)*gain)*self.rng.standard_normal(shape)
+                  + 5.0*self.rng.standard_normal(shape)
+                  + 300)
+        frames = np.clip(frames, 0, 2**31-1).astype(np.int32)
+        if self.hflip ^ (self.output_amp == 1):
+            frames = frames[:,:,::-1]
+        if self.vflip:
+            frames = frames[:,::-1,:]
+        self.frames = np.ascontiguousarray(frames)
+        # the ADC is 16 bit, GetAcquiredData16 and friends return the same counts
+        self.frames16 = np.minimum(self.frames, 2**16-1).astype(np.uint16)
+        self.frame_size = self.frames[0].size
+        self.frames_dirty = False
+
+    def _multi_track_layout(self, number, height, offset):
+        """(bottom, gap, tracks) of evenly spaced tracks centered on the sensor"""
+        gap = (self.Ny - number*height)//number
+        total = number*height + (number - 1)*gap
+        bottom = 1 + (self.Ny - total)//2 + offset
+        tracks = [(bottom + i*(height + gap), bottom + i*(height + gap) + height - 1)
+                  for i in range(number)]
+        return bottom, gap, tracks
+
+    def _tracks(self):
+        """(first_row, last_row) of each track in the current track read mode"""
+        if self.read_mode == 1:
+            return self.multi_track[2]
+        return self.random_tracks
+
+    def _readout_time(self):
+        hs = self.hs_speeds[self.hs_type][self.hs_index]*1e6
+        vs = self.vs_speeds[self.vs_index]*1e-6
+        n_rows, n_cols = self._frame_shape()
+        return self.Ny*vs + n_rows*n_cols/hs
+
+    def _timings(self):
+        """exposure, accumulation cycle and kinetic cycle times [s]"""
+        if self._timings_cache is not None:
+            return self._timings_cache
+        exp = self.exposure_time
+        frame = exp + self._readout_time()
+        acc = max(self.acc_cycle_time, frame)
+        if self.acq_mode == 4:
+            # rows are shifted under the mask between the exposures of the series
+            rows, series, exp = self.fast_kinetics[:3]
+            acc = kin = exp + rows*self.vs_speeds[self.vs_index]*1e-6
+        elif self.frame_transfer and self.acq_mode in (3, 5):
+            # the next exposure overlaps the readout of the storage area
+            acc = kin = max(exp, self._readout_time())
+        elif self.acq_mode in (2, 3):
+            kin = max(self.kin_cycle_time, self.num_acc*acc)
+        else:
+            kin = max(self.kin_cycle_time, frame)
+        self._timings_cache = exp, acc, kin
+        return self._timings_cache
+
+    def _first_frame_time(self):
+        exp, acc, kin = self._timings()
+        if self.acq_mode == 2 or (self.acq_mode == 3 and not self.frame_transfer):
+            return self.num_acc*acc
+        if self.acq_mode == 4:
+            # the whole series is read out after the last exposure
+            series = self.fast_kinetics[1]
+            return series*kin + series*self._readout_time()
+        return exp + self._readout_time()
+
+    def _series_length(self):
+        return {1: 1, 2: 1, 3: self.num_kin, 4: self.fast_kinetics[1], 5: None}[self.acq_mode]
+
+    def _update_acquisition(self):
+        """advance the acquisition to the current time"""
+        if not self.acquiring:
+            return
+        n_total = self._series_length()
+        if self.trigger_mode == 10:
+            # one frame per SendSoftwareTrigger
+            n = bisect.bisect_right(self.trigger_done, time.perf_counter())
+        else:
+            first, kin = self._first_frame_time(), self._timings()[2]
+            dt = time.perf_counter() - self.acq_t0
+            n = 0 if dt < first else int((dt - first)//kin) + 1
+            if self.acq_mode == 4 and n > 0:
+                n = n_total
+        if n_total is not None and n >= n_total:
+            n = n_total
+            self.acquiring = False
+        self.n_acquired = n
+
+    def _oldest_available(self):
+        return max(1, self.n_acquired - self.circular_buffer_size + 1)
+
+    def _copy_frames(self, first, last, ptr, size, dtype=np.int32):
+        """write frames first..last (1-based) to the buffer behind ptr"""
+        count = last - first + 1
+        if size != count*self.frame_size:
+            return consts.DRV_P4INVALID
+        bank = self.frames16 if dtype == np.uint16 else self.frames
+        out = _as_array(ptr, size, dtype).reshape(count, self.frame_size)
+        idx = (np.arange(first - 1, last) % self.N_BANK)
+        np.take(bank.reshape(self.N_BANK, -1), idx, axis=0, out=out)
+        return consts.DRV_SUCCESS
+
+    def _setting(self, name, value):
+        """settings are rejected by the driver while acquiring"""
+        self._update_acquisition()
+        if self.acquiring:
+            return consts.DRV_ACQUIRING
+        setattr(self, name, value)
+        self.frames_dirty = True
+        self._timings_cache = None
+        return consts.DRV_SUCCESS
+
+
+    ##### Initialization
+
+    def Initialize(self, directory):
+        self.initialized = True
+        return consts.DRV_SUCCESS
+
+    def ShutDown(self):
+        self.acquiring = False
+        self.initialized = False
+        return consts.DRV_SUCCESS
+
+    def GetHeadModel(self, buf):
+        buf.value = b"SIMULATED"
+        return consts.DRV_SUCCESS
+
+    def GetCameraSerialNumber(self, serial):
+        _out(serial, 12345)
+        return consts.DRV_SUCCESS
+
+    def GetHardwareVersion(self, *refs):
+        for ref, v in zip(refs, (1, 0, 0, 0, 1, 0)):
+            _out(ref, v)
+        return consts.DRV_SUCCESS
+
+    def GetSoftwareVersion(self, *refs):
+        for ref, v in zip(refs, (2, 104, 0, 0, 2, 104)):
+            _out(ref, v)
+        return consts.DRV_SUCCESS
+
+    def GetDetector(self, x, y):
+        _out(x, self.Nx)
+        _out(y, self.Ny)
+        return consts.DRV_SUCCESS
+
+    def GetNumberADChannels(self, num):
+        _out(num, self.num_ad_channels)
+        return consts.DRV_SUCCESS
+
+    def GetNumberAmp(self, num):
+        _out(num, 2 if self.em_ccd else 1)
+        return consts.DRV_SUCCESS
+
+    def GetNumberPreAmpGains(self, num):
+        _out(num, len(self.preamp_gains))
+        return consts.DRV_SUCCESS
+
+    def GetPreAmpGain(self, index, gain):
+        _out(gain, self.preamp_gains[_in(index)])
+        return consts.DRV_SUCCESS
+
+
+    ##### Shift speeds, gains, amplifiers
+
+    def GetNumberHSSpeeds(self, channel, typ, num):
+        if _in(typ) not in self.hs_speeds:
+            return consts.DRV_P2INVALID
+        _out(num, len(self.hs_speeds[_in(typ)]))
+        return consts.DRV_SUCCESS
+
+    def GetHSSpeed(self, channel, typ, index, speed):
+        _out(speed, self.hs_speeds[_in(typ)][_in(index)])
+        return consts.DRV_SUCCESS
+
+    def SetHSSpeed(self, typ, index):
+        if _in(typ) not in self.hs_speeds or not 0 <= _in(index) < len(self.hs_speeds[_in(typ)]):
+            return consts.DRV_P1INVALID
+        ret = self._setting('hs_type', _in(typ))
+        return ret if ret != consts.DRV_SUCCESS else self._setting('hs_index', _in(index))
+
+    def GetNumberVSSpeeds(self, num):
+        _out(num, len(self.vs_speeds))
+        return consts.DRV_SUCCESS
+
+    def GetVSSpeed(self, index, speed):
+        _out(speed, self.vs_speeds[_in(index)])
+        return consts.DRV_SUCCESS
+
+    def SetVSSpeed(self, index):
+        if not 0 <= _in(index) < len(self.vs_speeds):
+            return consts.DRV_P1INVALID
+        return self._setting('vs_index', _in(index))
+
+    def SetADChannel(self, chan):
+        if not 0 <= _in(chan) < self.num_ad_channels:
+            return consts.DRV_P1INVALID
+        return self._setting('ad_chan', _in(chan))
+
+    def SetPreAmpGain(self, index):
+        if not 0 <= _in(index) < len(self.preamp_gains):
+            return consts.DRV_P1INVALID
+        return self._setting('preamp_gain_index', _in(index))
+
+    def SetOutputAmplifier(self, amp):
+        if not 0 <= _in(amp) < (2 if self.em_ccd else 1):
+            return consts.DRV_P1INVALID
+        return self._setting('output_amp', _in(amp))
+
+    def GetEMGainRange(self, low, high):
+        if not self.em_ccd:
+            return consts.DRV_NOT_AVAILABLE
+        _out(low, self.em_gain_range[0])
+        _out(high, self.em_gain_range[1])
+        return consts.DRV_SUCCESS
+
+    def GetEMCCDGain(self, gain):
+        if not self.em_ccd:
+            return consts.DRV_NOT_AVAILABLE
+        _out(gain, self.em_gain)
+        return consts.DRV_SUCCESS
+
+    def SetEMCCDGain(self, gain):
+        if not self.em_ccd:
+            return consts.DRV_NOT_AVAILABLE
+        return self._setting('em_gain', _in(gain))
+
+    def SetEMGainMode(self, mode):
+        return consts.DRV_SUCCESS
+
+    def SetEMAdvanced(self, state):
+        return consts.DRV_SUCCESS
+
+
+    ##### Read modes
+
+    def SetReadMode(self, mode):
+        if _in(mode) not in (0, 1, 2, 3, 4):
+            return consts.DRV_P1INVALID
+        return self._setting('read_mode', _in(mode))
+
+    def SetFVBHBin(self, hbin):
+        return self._setting('fvb_hbin', _in(hbin))
+
+    def SetSingleTrack(self, center, height):
+        center, height = _in(center), _in(height)
+        if not 1 <= center <= self.Ny:
+            return consts.DRV_P1INVALID
+        first_row = center - height//2
+        if height < 1 or first_row < 1 or first_row + height - 1 > self.Ny:
+            return consts.DRV_P2INVALID
+        return self._setting('single_track', (center, height))
+
+    def SetSingleTrackHBin(self, hbin):
+        return self._setting('single_track_hbin', _in(hbin))
+
+    def SetMultiTrack(self, number, height, offset, bottom, gap):
+        number, height, offset = _in(number), _in(height), _in(offset)
+        if not 1 <= number <= self.Ny:
+            return consts.DRV_P1INVALID
+        if height < 1 or number*height > self.Ny:
+            return consts.DRV_P2INVALID
+        layout = self._multi_track_layout(number, height, offset)
+        tracks = layout[2]
+        if tracks[0][0] < 1 or tracks[-1][1] > self.Ny:
+            return consts.DRV_P3INVALID
+        ret = self._setting('multi_track', layout)
+        if ret == consts.DRV_SUCCESS:
+            _out(bottom, layout[0])
+            _out(gap, layout[1])
+        return ret
+
+    def SetMultiTrackHBin(self, hbin):
+        return self._setting('track_hbin', _in(hbin))
+
+    def SetRandomTracks(self, num_tracks, areas):
+        num_tracks = _in(num_tracks)
+        if not 1 <= num_tracks <= self.Ny:
+            return consts.DRV_P1INVALID
+        rows = [int(r) for r in list(areas)[:2*num_tracks]]
+        tracks = list(zip(rows[0::2], rows[1::2]))
+        prev_end = 0
+        for r0, r1 in tracks:
+            if not prev_end < r0 <= r1 <= self.Ny:
+                return consts.DRV_P2INVALID
+            prev_end = r1
+        return self._setting('random_tracks', tracks)
+
+    def SetCustomTrackHBin(self, hbin):
+        return self._setting('track_hbin', _in(hbin))
+
+    def SetImage(self, hbin, vbin, hstart, hend, vstart, vend):
+        image = tuple(_in(v) for v in (hbin, vbin, hstart, hend, vstart, vend))
+        hbin, vbin, hstart, hend, vstart, vend = image
+        checks = [(1 <= hbin <= self.Nx, consts.DRV_P1INVALID),
+                  (1 <= vbin <= self.Ny, consts.DRV_P2INVALID),
+                  (1 <= hstart <= self.Nx, consts.DRV_P3INVALID),
+                  (hstart <= hend <= self.Nx, consts.DRV_P4INVALID),
+                  (1 <= vstart <= self.Ny, consts.DRV_P5INVALID),
+                  (vstart <= vend <= self.Ny, consts.DRV_P6INVALID)]
+        for ok, retval in checks:
+            if not ok:
+                return retval
+        return self._setting('image', image)
+
+    def SetImageFlip(self, hflip, vflip):
+        ret = self._setting('hflip', int(_in(hflip)))
+        return ret if ret != consts.DRV_SUCCESS else self._setting('vflip', int(_in(vflip)))
+
+    def GetImageFlip(self, hflip, vflip):
+        _out(hflip, self.hflip)
+        _out(vflip, self.vflip)
+        return consts.DRV_SUCCESS
+
+    def SetImageRotation(self, rotate):
+        return self._setting('rotation', _in(rotate))
+
+
+    ##### Acquisition modes and timings
+
+    def SetAcquisitionMode(self, mode):
+        if _in(mode) not in (1, 2, 3, 4, 5):
+            return consts.DRV_P1INVALID
+        return self._setting('acq_mode', _in(mode))
+
+    def SetExposureTime(self, t):
+        return self._setting('exposure_time', float(_in(t)))
+
+    def SetNumberAccumulations(self, num):
+        return self._setting('num_acc', int(_in(num)))
+
+    def SetAccumulationCycleTime(self, t):
+        return self._setting('acc_cycle_time', float(_in(t)))
+
+    def SetNumberKinetics(self, num):
+        return self._setting('num_kin', int(_in(num)))
+
+    def SetKineticCycleTime(self, t):
+        return self._setting('kin_cycle_time', float(_in(t)))
+
+    def SetFrameTransferMode(self, mode):
+        if _in(mode) not in (0, 1):
+            return consts.DRV_P1INVALID
+        return self._setting('frame_transfer', _in(mode))
+
+    def SetFastKineticsEx(self, exposed_rows, series_length, time, mode, hbin, vbin, offset):
+        fk = [_in(v) for v in (exposed_rows, series_length, time, mode, hbin, vbin, offset)]
+        rows, series, exp, mode, hbin, vbin, offset = fk
+        checks = [(1 <= rows <= self.Ny, consts.DRV_P1INVALID),
+                  (series >= 1, consts.DRV_P2INVALID),
+                  (exp > 0, consts.DRV_P3INVALID),
+                  (mode in (0, 4), consts.DRV_P4INVALID),
+                  (1 <= hbin <= self.Nx, consts.DRV_P5INVALID),
+                  (1 <= vbin <= rows, consts.DRV_P6INVALID),
+                  (0 <= offset <= self.Ny - rows, consts.DRV_P7INVALID)]
+        for ok, retval in checks:
+            if not ok:
+                return retval
+        return self._setting('fast_kinetics', (rows, series, float(exp), mode, hbin, vbin, offset))
+
+    def SetFastKinetics(self, exposed_rows, series_length, time, mode, hbin, vbin):
+        return self.SetFastKineticsEx(exposed_rows, series_length, time, mode, hbin, vbin, 0)
+
+    def GetFKExposureTime(self, time):
+        _out(time, self.fast_kinetics[2])
+        return consts.DRV_SUCCESS
+
+    def SetTriggerMode(self, mode):
+        if _in(mode) not in (0, 1, 6, 7, 9, 10):
+            return consts.DRV_P1INVALID
+        return self._setting('trigger_mode', _in(mode))
+
+    def IsTriggerModeAvailable(self, mode):
+        if _in(mode) in (0, 1, 6, 7, 9, 10):
+            return consts.DRV_SUCCESS
+        return consts.DRV_INVALID_MODE
+
+    def SendSoftwareTrigger(self):
+        self._update_acquisition()
+        if self.trigger_mode != 10:
+            return consts.DRV_INVALID_MODE
+        if not self.acquiring:
+            return consts.DRV_IDLE
+        now = time.perf_counter()
+        if self.trigger_done and self.trigger_done[-1] > now:
+            # not ready, the previous frame is still exposed or read out
+            return consts.DRV_ACQUIRING
+        self.trigger_done.append(now + self._timings()[0] + self._readout_time())
+        return consts.DRV_SUCCESS
+
+    def GetAcquisitionTimings(self, exposure, accumulate, kinetic):
+        exp, acc, kin = self._timings()
+        _out(exposure, exp)
+        _out(accumulate, acc)
+        _out(kinetic, kin)
+        return consts.DRV_SUCCESS
+
+    def GetKeepCleanTime(self, t):
+        _out(t, self.keep_clean_time)
+        return consts.DRV_SUCCESS
+
+    def GetSizeOfCircularBuffer(self, size):
+        _out(size, self.circular_buffer_size)
+        return consts.DRV_SUCCESS
+
+
+    ##### Shutter and temperature
+
+    def SetShutter(self, typ, mode, closing_time, opening_time):
+        self.shutter_mode = _in(mode)
+        return consts.DRV_SUCCESS
+
+    def CoolerON(self):
+        self._update_temperature()
+        self.cooler_on = True
+        return consts.DRV_SUCCESS
+
+    def CoolerOFF(self):
+        self._update_temperature()
+        self.cooler_on = False
+        return consts.DRV_SUCCESS
+
+    def GetTemperatureRange(self, min_t, max_t):
+        _out(min_t, self.temperature_range[0])
+        _out(max_t, self.temperature_range[1])
+        return consts.DRV_SUCCESS
+
+    def SetTemperature(self, temp):
+        temp = _in(temp)
+        if not self.temperature_range[0] <= temp <= self.temperature_range[1]:
+            return consts.DRV_P1INVALID
+        self._update_temperature()
+        self.temp_setpoint = temp
+        return consts.DRV_SUCCESS
+
+    def _update_temperature(self):
+        t = time.perf_counter()
+        target = self.temp_setpoint if self.cooler_on else 20.0
+        self.temp = target + (self.temp - target)*np.exp(-(t - self.temp_t)/self.temp_tau)
+        self.temp_t = t
+
+    def GetTemperature(self, temp):
+        self._update_acquisition()
+        if self.acquiring:
+            return consts.DRV_ACQUIRING
+        self._update_temperature()
+        _out(temp, int(round(self.temp)))
+        if not self.cooler_on:
+            return consts.DRV_TEMP_OFF
+        if abs(self.temp - self.temp_setpoint) < 1.0:
+            return consts.DRV_TEMP_STABILIZED
+        return consts.DRV_TEMP_NOT_REACHED
+
+
+    ##### Acquisition
+
+    def StartAcquisition(self):
+        self._update_acquisition()
+        if self.acquiring:
+            return consts.DRV_ACQUIRING
+        if self.frames_dirty:
+            self._make_frames()
+        self.n_acquired = 0
+        self.n_retrieved = 0
+        self.n_events = 0
+        self.trigger_done = []
+        self.acquiring = True
+        self.acq_t0 = time.perf_counter()
+        return consts.DRV_SUCCESS
+
+    def AbortAcquisition(self):
+        self._update_acquisition()
+        if not self.acquiring:
+            return consts.DRV_IDLE
+        self.acquiring = False
+        return consts.DRV_SUCCESS
+
+    def _next_event_time(self):
+        if self.trigger_mode == 10:
+            if self.n_acquired < len(self.trigger_done):
+                return self.trigger_done[self.n_acquired]
+            return float('inf')
+        return self.acq_t0 + self._first_frame_time() + self.n_acquired*self._timings()[2]
+
+    def WaitForAcquisitionTimeOut(self, timeout_ms):
+        """an event is raised for every new image; events that happened
+        before the call are returned immediately"""
+        t_end = time.perf_counter() + _in(timeout_ms)/1000.
+        self.cancel_event.clear()
+        while True:
+            self._update_acquisition()
+            if self.n_acquired > self.n_events:
+                self.n_events = self.n_acquired
+                return consts.DRV_SUCCESS
+            now = time.perf_counter()
+            if not self.acquiring or now >= t_end:
+                return consts.DRV_NO_NEW_DATA
+            if self.cancel_event.wait(max(0, min(self._next_event_time(), t_end) - now)):
+                return consts.DRV_NO_NEW_DATA
+
+    def WaitForAcquisition(self):
+        return self.WaitForAcquisitionTimeOut(2**31-1)
+
+    def CancelWait(self):
+        self.cancel_event.set()
+        return consts.DRV_SUCCESS
+
+    def GetStatus(self, status):
+        self._update_acquisition()
+        _out(status, consts.DRV_ACQUIRING if self.acquiring else consts.DRV_IDLE)
+        return consts.DRV_SUCCESS
+
+    def GetAcquiredData(self, arr, size):
+        return self._get_acquired_data(arr, size, np.int32)
+
+    def GetAcquiredData16(self, arr, size):
+        return self._get_acquired_data(arr, size, np.uint16)
+
+    def _get_acquired_data(self, arr, size, dtype):
+        self._update_acquisition()
+        if self.acquiring:
+            return consts.DRV_ACQUIRING
+        if self.n_acquired == 0:
+            return consts.DRV_NO_NEW_DATA
+        size = _in(size)
+        if self.acq_mode in (3, 4):
+            # an aborted series fills the first n_acquired frames
+            count = min(self.n_acquired, size//self.frame_size)
+            if size % self.frame_size:
+                return consts.DRV_P2INVALID
+            return self._copy_frames(1, count, arr, count*self.frame_size, dtype)
+        if size != self.frame_size:
+            return consts.DRV_P2INVALID
+        out = _as_array(arr, size, dtype)
+        frame = self.frames[(self.n_acquired - 1) % self.N_BANK].ravel()
+        if self.acq_mode == 2:
+            frame = frame*self.num_acc
+        if dtype == np.uint16:
+            frame = np.minimum(frame, 2**16-1)
+        out[:] = frame
+        return consts.DRV_SUCCESS
+
+    def GetTotalNumberImagesAcquired(self, num):
+        self._update_acquisition()
+        _out(num, self.n_acquired)
+        return consts.DRV_SUCCESS
+
+    def GetNumberNewImages(self, first, last):
+        self._update_acquisition()
+        first_new = max(self.n_retrieved + 1, self._oldest_available())
+        if first_new > self.n_acquired:
+            return consts.DRV_NO_NEW_DATA
+        _out(first, first_new)
+        _out(last, self.n_acquired)
+        return consts.DRV_SUCCESS
+
+    def GetNumberAvailableImages(self, first, last):
+        self._update_acquisition()
+        if self.n_acquired == 0:
+            return consts.DRV_NO_NEW_DATA
+        _out(first, self._oldest_available())
+        _out(last, self.n_acquired)
+        return consts.DRV_SUCCESS
+
+    def GetImages(self, first, last, arr, size, validfirst, validlast):
+        return self._get_images(first, last, arr, size, validfirst, validlast, np.int32)
+
+    def GetImages16(self, first, last, arr, size, validfirst, validlast):
+        return self._get_images(first, last, arr, size, validfirst, validlast, np.uint16)
+
+    def _get_images(self, first, last, arr, size, validfirst, validlast, dtype):
+        self._update_acquisition()
+        first, last = _in(first), _in(last)
+        if not self._oldest_available() <= first <= self.n_acquired:
+            return consts.DRV_P1INVALID
+        if not first <= last <= self.n_acquired:
+            return consts.DRV_P2INVALID
+        ret = self._copy_frames(first, last, arr, _in(size), dtype)
+        if ret == consts.DRV_SUCCESS:
+            _out(validfirst, first)
+            _out(validlast, last)
+            self.n_retrieved = max(self.n_retrieved, last)
+        return ret
+
+    def GetOldestImage(self, arr, size):
+        return self._get_oldest_image(arr, size, np.int32)
+
+    def GetOldestImage16(self, arr, size):
+        return self._get_oldest_image(arr, size, np.uint16)
+
+    def _get_oldest_image(self, arr, size, dtype):
+        self._update_acquisition()
+        first = max(self.n_retrieved + 1, self._oldest_available())
+        if first > self.n_acquired:
+            return consts.DRV_NO_NEW_DATA
+        ret = self._copy_frames(first, first, arr, _in(size), dtype)
+        if ret == consts.DRV_SUCCESS:
+            self.n_retrieved = first
+        return ret
+
+
+def benchmark(n_frames=200, exposure_time=1e-3, readout='Image', **sim_kwargs):
+    """frames/s and per-frame latency of the AndorCCD acquisition paths
+    running on the simulated SDK"""
+    from .andor_ccd_interface import AndorCCD
+
+    cam = AndorCCD(andorlib=AndorSDKSim(**sim_kwargs))
+    if readout == 'FullVerticalBinning':
+        cam.set_ro_full_vertical_binning()
+    elif readout == 'MultiTrack':
+        cam.set_ro_multi_track(4, 20, 0)
+    else:
+        cam.set_ro_image_mode()
+    cam.set_exposure_time(exposure_time)
+    results = dict()
+
+    # single scans: StartAcquisition() --> GetStatus() --> GetAcquiredData()
+    cam.set_aq_mode('single')
+    cam.create_buffer()
+    latency = np.zeros(n_frames)
+    t0 = time.perf_counter()
+    for i in range(n_frames):
+        t = time.perf_counter()
+        cam.start_acquisition()
+        cam.wait_for_acquisition()
+        cam.get_acquired_data()
+        latency[i] = time.perf_counter() - t
+    results['single'] = (n_frames/(time.perf_counter() - t0), latency)
+
+    # run_till_abort streaming with GetOldestImage
+    cam.set_aq_mode('run_till_abort')
+    cam.set_kinetic_cycle_time(0)
+    cam.create_buffer()
+    latency = np.zeros(n_frames)
+    cam.start_acquisition()
+    t0 = t = time.perf_counter()
+    i = 0
+    while i < n_frames:
+        if cam.get_oldest_image() is None:
+            continue
+        now = time.perf_counter()
+        latency[i] = now - t
+        t = now
+        i += 1
+    cam.abort_acquisition()
+    results['run_till_abort'] = (n_frames/(time.perf_counter() - t0), latency)
+
+    # run_till_abort streaming into the preallocated ring buffer
+    latency = []
+    cam.start_acquisition()
+    t0 = t = time.perf_counter()
+    i = 0
+    while i < n_frames:
+        cam.wait_for_acquisition()
+        frame_indices, frames = cam.poll_ring_buffer()
+        if len(frame_indices) == 0:
+            continue
+        cam.release_ring_frames(len(frame_indices))
+        now = time.perf_counter()
+        latency.append(now - t)
+        t = now
+        i += len(frame_indices)
+    cam.abort_acquisition()
+    results['ring_buffer'] = (i/(time.perf_counter() - t0), np.array(latency))
+
+    cam.close()
+    return results
+
+
+def benchmark_calls(n_calls=20000, repeat=5, **sim_kwargs):
+    """per-call latency [us] of frequently polled AndorCCD methods and of the
+    bare simulated SDK call they wrap. The difference is the Python-side
+    overhead of the interface (argument objects, locking, error checks)."""
+    from .andor_ccd_interface import AndorCCD
+
+    cam = AndorCCD(andorlib=AndorSDKSim(**sim_kwargs))
+    cam.set_ro_full_vertical_binning()
+    cam.set_exposure_time(1e-3)
+    cam.set_aq_mode('run_till_abort')
+    cam.set_kinetic_cycle_time(0)
+    cam.create_buffer()
+    # leave some frames in the circular buffer
+    cam.start_acquisition()
+    time.sleep(0.05)
+    cam.abort_acquisition()
+
+    sdk = cam.andorlib
+    i0, i1, i2 = ctypes.c_int(0), ctypes.c_long(0), ctypes.c_long(0)
+    frame = np.zeros((1,) + cam.buffer.shape, dtype=np.int32)
+    frame_ptr = frame.ctypes.data_as(ctypes.POINTER(ctypes.c_long))
+    calls = [
+        ('get_status', cam.get_status,
+            lambda: sdk.GetStatus(ctypes.byref(i0))),
+        ('get_temperature', cam.get_temperature,
+            lambda: sdk.GetTemperature(ctypes.byref(i0))),
+        ('get_total_number_images_acquired', cam.get_total_number_images_acquired,
+            lambda: sdk.GetTotalNumberImagesAcquired(ctypes.byref(i1))),
+        ('get_number_available_images', cam.get_number_available_images,
+            lambda: sdk.GetNumberAvailableImages(ctypes.byref(i1), ctypes.byref(i2))),
+        ('get_images', lambda: cam.get_images(1, 1, frame),
+            lambda: sdk.GetImages(1, 1, frame_ptr, frame.size, ctypes.byref(i1), ctypes.byref(i2))),
+    ]
+
+    def per_call(func):
+        best = np.inf
+        for r in range(repeat):
+            t0 = time.perf_counter()
+            for i in range(n_calls):
+                func()
+            best = min(best, time.perf_counter() - t0)
+        return 1e6*best/n_calls
+
+    results = dict()
+    for name, method, bare in calls:
+        results[name] = (per_call(method), per_call(bare))
+    cam.close()
+    return results
+
+
+if __name__ == '__main__':
+    for readout in ('Image', 'MultiTrack', 'FullVerticalBinning'):
+        print(readout)
+        for name, (fps, latency) in benchmark(readout=readout).items():
+            print("{:>16s}: {:8.1f} frames/s, latency median {:.3f} ms, max {:.3f} ms".format(
+                name, fps, 1e3*np.median(latency), 1e3*np.max(latency)))
+
+    print("per call latency [us]       AndorCCD  bare SDK  overhead")
+    for name, (t_method, t_bare) in benchmark_calls().items():
+        print("{:>32s}: {:8.2f}  {:8.2f}  {:8.2f}".format(name, t_method, t_bare, t_method - t_bare))
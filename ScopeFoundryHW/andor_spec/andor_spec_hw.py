@@ -163,8 +163,11 @@ class AndorShamrockSpecHW(HardwareComponent):
     #     self.ui.activateWindow()
     
        
-    def get_wl_calibration(self, px_index, binning=1, m_order=1):
+    def get_wl_calibration(self, px_index, binning=1, m_order=1, center_wl=None):
+        """wavelengths of px_index, at center_wl (default: the current one)"""
         S = self.settings
+        if center_wl is None:
+            center_wl = S['center_wl']
         grating_id = S['grating_id'] - 1
         
         
@@ -177,7 +180,7 @@ class AndorShamrockSpecHW(HardwareComponent):
         if len(grating_calib_array) > 7:
             curvature = grating_calib_array[7]
         binned_px = binning*px_index + 0.5*(binning-1)
-        wl = wl_p_calib(binned_px, n0, offset_adjust, S['center_wl'], m_order, d_grating, x_pixel, f, delta, gamma, curvature)
+        wl = wl_p_calib(binned_px, n0, offset_adjust, center_wl, m_order, d_grating, x_pixel, f, delta, gamma, curvature)
         
         #print('get_wl_calibration', 'grating#', grating_id, 'grating calib:', S['grating_calibrations'][grating_id], 'center wl:', S['center_wl'], 'output:', wl)
         
@@ -3,6 +3,7 @@ from __future__ import division, print_function
 from ScopeFoundry.scanning import BaseRaster2DSlowScan, BaseRaster2DFrameSlowScan
 #from ScopeFoundry import Measurement, LQRange
 import time
+from .scan_trajectory import ScanTrajectory
 
 class MCLStage2DSlowScan(BaseRaster2DSlowScan):
     
@@ -17,6 +18,13 @@ class MCLStage2DSlowScan(BaseRaster2DSlowScan):
         
         self.settings.New("h_axis", initial="X", dtype=str, choices=("X", "Y", "Z"))
         self.settings.New("v_axis", initial="Y", dtype=str, choices=("X", "Y", "Z"))
+        # piezo stage: no lost motion by default, approach_travel > 0 makes
+        # every pixel be approached from the side of its scan line (hysteresis)
+        self.settings.New("backlash", dtype=float, initial=0.0, vmin=0, unit="um", spinbox_decimals=3)
+        self.settings.New("approach_travel", dtype=float, initial=0.0, vmin=0, unit="um")
+        self.settings.New("est_stage_time", dtype=float, ro=True, unit="s")
+        if "serpentine" in self.settings.scan_type.choices:
+            self.settings["scan_type"] = "serpentine"
         
         self.ax_map = dict(X=0, Y=1, Z=2)
         #Hardware
@@ -41,11 +49,17 @@ class MCLStage2DSlowScan(BaseRaster2DSlowScan):
         
     def setup_figure(self):
         BaseRaster2DSlowScan.setup_figure(self)
-        self.set_details_widget(widget=self.settings.New_UI(include=['h_axis', 'v_axis']))
+        self.set_details_widget(widget=self.settings.New_UI(include=['h_axis', 'v_axis', 'backlash',
+                                                                     'approach_travel', 'est_stage_time']))
         
 
     def pre_scan_setup(self):
         BaseRaster2DSlowScan.pre_scan_setup(self)
+        S = self.settings
+        self.trajectory = ScanTrajectory(self.scan_h_positions, self.scan_v_positions, self.scan_slow_move,
+                                         backlash=S['backlash'], approach_travel=S['approach_travel'],
+                                         speed=self.stage.settings['move_speed'])
+        S['est_stage_time'] = self.trajectory.total_time
         if hasattr(self.app.settings, 'open_shutter_before_scan'):
             if self.app.settings.open_shutter_before_scan.val:
                 self.app.hardware.shutter_servo.settings['shutter_open'] = True
@@ -60,37 +74,35 @@ class MCLStage2DSlowScan(BaseRaster2DSlowScan):
 
         
 
-    def move_position_start(self, h,v):
-        #self.stage.y_position.update_value(x)
-        #self.stage.y_position.update_value(y)
-        
+    def move_to(self, h, v, slow=True):
         S = self.settings
-        
         coords = [None, None, None]
         coords[self.ax_map[S['h_axis']]] = h
         coords[self.ax_map[S['v_axis']]] = v
-        
-        #self.stage.move_pos_slow(x,y,None)
-        self.stage.move_pos_slow(*coords)
+        if slow:
+            self.stage.move_pos_slow(*coords)
+        else:
+            self.stage.move_pos_fast(*coords)
+
+    def read_position(self):
         self.stage.settings.x_position.read_from_hardware()
         self.stage.settings.y_position.read_from_hardware()
         self.stage.settings.z_position.read_from_hardware()
+
+    def move_position_start(self, h,v):
+        self.move_to(h, v, slow=True)
+        self.read_position()
     
     def move_position_slow(self, h,v, dh,dv):
-        self.move_position_start(h, v)
+        for h_cmd, v_cmd in self.trajectory.moves(self.pixel_i):
+            self.move_to(h_cmd, v_cmd, slow=True)
+        self.read_position()
 
     def move_position_fast(self,  h,v, dh,dv):
-        #self.stage.x_position.update_value(x)
-        S = self.settings        
-        coords = [None, None, None]
-        coords[self.ax_map[S['h_axis']]] = h
-        coords[self.ax_map[S['v_axis']]] = v
-        self.stage.move_pos_fast(*coords)
-        #self.stage.move_pos_fast(x, y, None)
-        #self.current_stage_pos_arrow.setPos(x, y)
-        self.stage.settings.x_position.read_from_hardware()
-        self.stage.settings.y_position.read_from_hardware()
-        self.stage.settings.z_position.read_from_hardware()
+        # planned trajectory: take-up moves before the pixel, if any
+        for h_cmd, v_cmd in self.trajectory.moves(self.pixel_i):
+            self.move_to(h_cmd, v_cmd, slow=False)
+        self.read_position()
         
     
 class MCLStage2DFrameSlowScan(BaseRaster2DFrameSlowScan):
@@ -107,10 +119,12 @@ class MCLStage2DFrameSlowScan(BaseRaster2DFrameSlowScan):
         MCLStage2DSlowScan.move_position_start(self, h, v)
     
     def move_position_slow(self, h,v, dh,dv):
-        MCLStage2DSlowScan.move_position_slow(self, h,v, dh,dv)
+        MCLStage2DSlowScan.move_to(self, h, v, slow=True)
+        MCLStage2DSlowScan.read_position(self)
         
     def move_position_fast(self,  h,v, dh,dv):
-        MCLStage2DSlowScan.move_position_fast(self,  h,v, dh,dv)
+        MCLStage2DSlowScan.move_to(self, h, v, slow=False)
+        MCLStage2DSlowScan.read_position(self)
     
     def on_new_stage_limits(self):
         MCLStage2DSlowScan.on_new_stage_limits(self)
@@ -0,0 +1,130 @@
+from __future__ import division, print_function
+import numpy as np
+
+# MicroDrive defaults, see mcl_microdrive.py
+MICRODRIVE_SPEED = 190.5  # um/s, MCLMicroDrive.velocity 0.1905 mm/s
+MOVE_OVERHEAD = 0.01  # s per axis move (USB command and MCL_MicroDriveWait)
+
+
+def line_directions(x, line_start):
+    """
+    Approach direction (+1/-1) of every pixel on one axis, per scan line:
+    the direction of the axis within the line, for lines along which it
+    does not move the direction of the move into the line, else the
+    direction of the previous line (+1 for the first).
+    """
+    starts = list(np.flatnonzero(line_start)) + [len(x)]
+    if starts[0] != 0:
+        starts.insert(0, 0)
+    line_dirs = []
+    for a, b in zip(starts[:-1], starts[1:]):
+        d = np.sign(x[b-1] - x[a])
+        if d == 0 and a > 0:
+            d = np.sign(x[a] - x[a-1])
+        line_dirs.append(d)
+    # the first line along the slow axis has no move into it, use the next one
+    if line_dirs and line_dirs[0] == 0 and len(line_dirs) > 1:
+        line_dirs[0] = line_dirs[1]
+    a = np.zeros(len(x))
+    prev = 1
+    for (s, e), d in zip(zip(starts[:-1], starts[1:]), line_dirs):
+        prev = d if d != 0 else prev
+        a[s:e] = prev
+    return a
+
+
+class ScanTrajectory(object):
+    """
+    Move plan of a slow scan over the pixel positions h, v (in scan order)
+    on a stage with backlash (lost motion when an axis reverses).
+
+    Every pixel is approached on each axis in the direction of its scan
+    line (single sided per line). A move that keeps the direction of the
+    axis is made as it is. When the axis moves against the approach, or
+    reverses by less than approach_travel (start of a serpentine line),
+    the stage first goes approach_travel to the other side of the pixel,
+    so the lost motion is taken up before the pixel is reached. A
+    serpentine scan compensates once per line on the fast axis and never
+    on the slow axis.
+
+    With backlash (the lost motion, um) the commanded positions are
+    shifted by backlash/2 in the approach direction: the target is
+    pixel + approach*backlash/2, with approach +1 for increasing and -1
+    for decreasing positions. A stage approaching from one side stops
+    backlash/2 short of the commanded position (taking the middle of the
+    hysteresis as the true position), so the shift puts it on the pixel
+    and lines scanned in opposite directions line up.
+
+    moves(i)        commanded (h, v) positions to go through for pixel i
+    move_time       estimated stage time per pixel [s]
+    total_time      estimated stage time of the scan [s]
+    n_compensations number of take-up moves in the plan
+    """
+
+    def __init__(self, h, v, line_start, backlash=0.0, approach_travel=0.0,
+                 speed=MICRODRIVE_SPEED, move_overhead=MOVE_OVERHEAD, start=None):
+        h = np.asarray(h, dtype=float)
+        v = np.asarray(v, dtype=float)
+        self.speed = speed
+        self.move_overhead = move_overhead
+        approach = np.array([line_directions(h, line_start), line_directions(v, line_start)])
+        targets = np.array([h, v]) + 0.5*backlash*approach
+
+        pos = np.array(start if start is not None else targets[:, 0], dtype=float)
+        last_dir = np.zeros(2) # unknown, the first move is compensated
+        self.plan = []
+        self.move_time = np.zeros(len(h))
+        self.n_compensations = 0
+        for i in range(len(h)):
+            t, a = targets[:, i], approach[:, i]
+            m = np.sign(t - pos)
+            # against the approach, or reversing by less than approach_travel
+            short = np.abs(t - pos) < approach_travel
+            need = ((m != a) & ~((m == 0) & (last_dir == a))) | ((last_dir != a) & short)
+            need &= approach_travel > 0
+            moves = []
+            if need.any():
+                moves.append(tuple(np.where(need, t - a*approach_travel, t)))
+                self.n_compensations += 1
+            moves.append(tuple(t))
+            for p in moves:
+                p = np.array(p)
+                self.move_time[i] += self.estimate_move(pos, p)
+                d = np.sign(p - pos)
+                last_dir = np.where(d != 0, d, last_dir)
+                pos = p
+            self.plan.append(moves)
+        self.total_time = self.move_time.sum()
+
+    def estimate_move(self, p0, p1):
+        """axes are moved one after the other"""
+        dist = np.abs(np.asarray(p1) - np.asarray(p0))
+        return np.sum(dist[dist > 0]/self.speed + self.move_overhead)
+
+    def moves(self, i):
+        return self.plan[i]
+
+
+def compare_line_start_correction(Nh=200, Nv=200, step=0.5, steps=300, step_size=0.095,
+                                  backlash=1.0, approach_travel=28.5):
+    """estimated stage time [s] of a raster scan with the correction of
+    Example2DSlowScanMeasure (0.1 s wait, -steps and +steps at every line
+    start) and of a planned serpentine scan"""
+    II, JJ = np.meshgrid(np.arange(Nh), np.arange(Nv))
+    h, v = II.ravel()*step, JJ.ravel()*step
+    line_start = (II.ravel() == 0)
+    raster = ScanTrajectory(h, v, line_start)
+    correction = Nv*(0.1 + 2*(steps*step_size/MICRODRIVE_SPEED + MOVE_OVERHEAD))
+    before = raster.total_time + correction
+
+    serpentine_h = np.where(JJ % 2, (Nh - 1 - II), II).ravel()*step
+    planned = ScanTrajectory(serpentine_h, v, line_start, backlash, approach_travel)
+    return before, planned.total_time, planned.n_compensations
+
+
+if __name__ == '__main__':
+    pixels = 200*199*(0.5/MICRODRIVE_SPEED + MOVE_OVERHEAD) # fast axis steps, needed by both
+    before, after, n = compare_line_start_correction()
+    print("200x200 map, 0.5 um pixels: stage time {:.0f} s raster + line start correction, "
+          "{:.0f} s planned serpentine ({} take-up moves)".format(before, after, n))
+    print("overhead beyond the pixel steps: {:.0f} s -> {:.0f} s".format(before - pixels, after - pixels))
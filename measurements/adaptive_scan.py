@@ -0,0 +1,299 @@
+import numpy as np
+from ScopeFoundry import h5_io
+
+
+def lattice(n, step):
+    """every step-th index of range(n) and the last one"""
+    return np.union1d(np.arange(0, n, step), [n - 1])
+
+
+def new_adaptive_settings(settings):
+    """adds the scan_mode and adaptive_* settings of a slow scan measurement"""
+    # adaptive: a coarse pass, then only where there is signal, see AdaptiveGrid
+    settings.New("scan_mode", dtype=str, initial="uniform", choices=("uniform", "adaptive"))
+    settings.New("adaptive_coarse_step", dtype=int, initial=8, vmin=1,
+                 description="pixel step of the first pass, halved by every refinement pass")
+    settings.New("adaptive_signal_threshold", dtype=float, initial=0.2, vmin=0,
+                 description="refine where the signal reaches this fraction of the first pass range")
+    settings.New("adaptive_gradient_threshold", dtype=float, initial=0.1, vmin=0,
+                 description="refine where neighbouring samples differ by this fraction of the first pass range")
+
+
+def new_adaptive_grid(settings, Nv, Nh):
+    """AdaptiveGrid of an Nv x Nh plane with the adaptive_* settings"""
+    return AdaptiveGrid(Nv, Nh, settings["adaptive_coarse_step"],
+                        settings["adaptive_signal_threshold"], settings["adaptive_gradient_threshold"])
+
+
+def pass_scan_arrays(k, pixels, h_array, v_array):
+    """scan_h_positions, scan_v_positions, scan_slow_move and scan_index_array
+    of the (j, i) pixels of a pass in plane k"""
+    j, i = pixels[:, 0], pixels[:, 1]
+    return (h_array[i], v_array[j], np.append(True, j[1:] != j[:-1]),
+            np.stack([np.full(len(j), k), j, i], axis=1))
+
+
+def save_adaptive(h5_group, grids, positions, index):
+    """adaptive_map and adaptive_pass, one plane per grid, and the positions
+    {axis: array} and scan indices (n, 3) of the samples in the order they
+    were taken, as adaptive_<axis>_positions and adaptive_index_array
+    (scan_h_positions etc. are the full raster)"""
+    h5_group["adaptive_map"] = np.stack([grid.interpolated() for grid in grids])
+    h5_group["adaptive_pass"] = np.stack([grid.sample_pass for grid in grids])
+    for axis, pos in positions.items():
+        h5_group["adaptive_{}_positions".format(axis)] = pos
+    h5_group["adaptive_index_array"] = np.asarray(index, dtype=int).reshape(-1, 3)
+
+
+class AdaptiveGrid(object):
+    """
+    Multi-resolution sampling of an Nv x Nh scan grid.
+
+    The first pass samples a lattice of every coarse_step-th row and column
+    (and the last ones). Every later pass halves the step, but only inside
+    the lattice cells of the previous pass worth refining: cells where a
+    corner has a signal of at least signal_threshold, or where the corners
+    differ by at least gradient_threshold. Both are fractions of the signal
+    range of the first pass (5th percentile to max). The signal level is
+    at least 5 times its noise above the median and the gradient level 6
+    times its noise, so empty substrate is left at the coarse step. A flat
+    first pass is only refined above its value. The last pass has step 1.
+
+        grid = AdaptiveGrid(Nv, Nh, coarse_step=8)
+        pixels = grid.next_pass()      # (n, 2) array of (j, i), serpentine
+        while len(pixels):
+            grid.add(pixels, values)   # one scalar per pixel
+            pixels = grid.next_pass()
+        image = grid.interpolated()
+
+    interpolated() fills the pixels that were not sampled bilinearly from
+    the finest lattice around them.
+    """
+
+    def __init__(self, Nv, Nh, coarse_step=8, signal_threshold=0.2, gradient_threshold=0.1):
+        self.shape = (Nv, Nh)
+        self.signal_threshold = signal_threshold
+        self.gradient_threshold = gradient_threshold
+        # powers of two, so each lattice contains the previous one
+        step = 1
+        while 2*step <= min(coarse_step, max(Nv, Nh)):
+            step *= 2
+        self.steps = []
+        while step >= 1:
+            self.steps.append(step)
+            step //= 2
+        self.values = np.full(self.shape, np.nan)
+        self.sampled = np.zeros(self.shape, dtype=bool)
+        self.sample_pass = np.full(self.shape, -1, dtype=int)
+        self.level = -1
+        self.done = False # no pass left, level stays at the last pass scanned
+        self.active = None # lattice cells sampled in the current pass
+        self.signal_level = None # raw units, set after the first pass
+        self.gradient_level = None
+        self.strict = False # flat first pass, only refine above its level
+
+    def cells(self, level):
+        step = self.steps[level]
+        return lattice(self.shape[0], step), lattice(self.shape[1], step)
+
+    def next_pass(self):
+        """pixels of the next pass, (n, 2) (j, i) in serpentine order, empty when done"""
+        if self.done or self.level + 1 >= len(self.steps):
+            self.done = True
+            return np.zeros((0, 2), dtype=int)
+        if self.level < 0:
+            ys, xs = self.cells(0)
+            active = np.ones((len(ys) - 1, len(xs) - 1), dtype=bool)
+        else:
+            active = self.refined_cells()
+            if active.size and not active.any():
+                self.done = True
+                return np.zeros((0, 2), dtype=int)
+        self.level += 1
+        self.active = active
+        ys, xs = self.cells(self.level)
+        if active.size == 0:
+            # a single row or column
+            want = np.ones((len(ys), len(xs)), dtype=bool)
+        else:
+            want = np.zeros((len(ys), len(xs)), dtype=bool)
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    want[dy:len(ys) - 1 + dy, dx:len(xs) - 1 + dx] |= active
+        J, I = np.meshgrid(ys, xs, indexing='ij')
+        want &= ~self.sampled[J, I]
+        pixels = []
+        for r in range(len(ys)):
+            row = I[r][want[r]]
+            if len(pixels) % 2:
+                row = row[::-1]
+            if len(row):
+                pixels.append(np.stack([np.full(len(row), ys[r]), row], axis=1))
+        if not pixels:
+            return self.next_pass()
+        return np.concatenate(pixels)
+
+    def refined_cells(self):
+        """cells of the next lattice inside the cells of the current one worth refining"""
+        ys, xs = self.cells(self.level)
+        ys2, xs2 = self.cells(self.level + 1)
+        if len(ys) < 2 or len(xs) < 2:
+            # a single row or column has no cells, it is sampled at every step
+            return np.zeros((len(ys2) - 1, len(xs2) - 1), dtype=bool)
+        # unsampled corners (outside the active cells) from the interpolation
+        v = self.interpolated()[np.ix_(ys, xs)]
+        if self.signal_level is None:
+            self.set_levels(v)
+        corners = np.stack([v[:-1, :-1], v[:-1, 1:], v[1:, :-1], v[1:, 1:]])
+        reaches = np.greater if self.strict else np.greater_equal
+        with np.errstate(invalid='ignore'):
+            refine = (reaches(corners.max(axis=0), self.signal_level)
+                      | reaches(corners.max(axis=0) - corners.min(axis=0), self.gradient_level))
+        refine &= self.active
+        # each cell of the next lattice lies in one cell of this one
+        a = np.searchsorted(ys, ys2[:-1], side='right') - 1
+        b = np.searchsorted(xs, xs2[:-1], side='right') - 1
+        return refine[np.ix_(a, b)]
+
+    def set_levels(self, v):
+        """refinement levels from the first pass lattice v"""
+        finite = v[np.isfinite(v)]
+        if not len(finite):
+            self.signal_level, self.gradient_level = np.inf, np.inf
+            return
+        lo = np.percentile(finite, 5)
+        span = finite.max() - lo
+        # with a zero span the levels can be 0 above lo, >= would refine everything
+        self.strict = span == 0
+        # noise from neighbouring samples (robust, a few particles do not count)
+        d = np.diff(v, axis=1)
+        d = d[np.isfinite(d)]
+        noise = 1.4826*np.median(np.abs(d))/np.sqrt(2) if len(d) else 0.0
+        # the floors are above the noise extremes of a few hundred samples
+        self.signal_level = max(lo + self.signal_threshold*span, np.median(finite) + 5*noise)
+        self.gradient_level = max(self.gradient_threshold*span, 6*noise)
+
+    def add(self, pixels, values):
+        pixels = np.asarray(pixels)
+        j, i = pixels[:, 0], pixels[:, 1]
+        self.values[j, i] = values
+        self.sampled[j, i] = True
+        self.sample_pass[j, i] = self.level
+
+    def interpolated(self):
+        """map of the samples, the other pixels interpolated"""
+        image = None
+        for level in range(max(self.level, 0) + 1):
+            ys, xs = self.cells(level)
+            known = np.where(self.sampled, self.values, image if image is not None else np.nan)
+            lat = known[np.ix_(ys, xs)]
+            rows = np.array([np.interp(np.arange(self.shape[1]), xs, r) for r in lat])
+            image = np.array([np.interp(np.arange(self.shape[0]), ys, c) for c in rows.T]).T
+        if image is None:
+            return np.full(self.shape, np.nan)
+        return np.where(self.sampled, self.values, image)
+
+
+class SparseScanWriter(object):
+    """
+    Stores the pixels of an adaptive scan as a list of samples instead of
+    a dense map. Has the create_dataset() interface of ScanBlockWriter:
+
+        signal_map = writer.create_dataset('signal_map', pixel_shape=(1600,))
+        signal_map[k, j, i] = signal
+
+    appends signal to the extendable dataset signal_map (n,) + pixel_shape
+    and (k, j, i) to signal_map_index (n, 3). Samples are written in
+    blocks of block_size.
+    """
+
+    def __init__(self, h5_group, block_size=64):
+        self.h5_group = h5_group
+        self.block_size = block_size
+        self.datasets = []
+
+    def create_dataset(self, name, pixel_shape=(), dtype=float, layout=None):
+        """layout is ignored, samples are chunked in blocks of block_size"""
+        dset = _SparseDataset(self.h5_group, name, tuple(pixel_shape), np.dtype(dtype), self.block_size)
+        self.datasets.append(dset)
+        return dset
+
+    def close(self):
+        for dset in self.datasets:
+            dset.commit()
+        self.h5_group.file.flush()
+
+
+class _SparseDataset(object):
+
+    def __init__(self, h5_group, name, pixel_shape, dtype, block_size):
+        self.data_h5 = h5_io.create_extendable_h5_dataset(
+            h5_group, name, shape=(0,) + pixel_shape, dtype=dtype, chunks=(block_size,) + pixel_shape)
+        self.index_h5 = h5_io.create_extendable_h5_dataset(
+            h5_group, name + '_index', shape=(0, 3), dtype=np.int32, chunks=(block_size, 3))
+        self.round = dtype.kind in 'iu'
+        self.buf = np.zeros((block_size,) + pixel_shape, dtype=dtype)
+        self.index = np.zeros((block_size, 3), dtype=np.int32)
+        self.n = 0
+
+    def __setitem__(self, index, value):
+        if self.round:
+            value = np.rint(value)
+        self.buf[self.n] = value
+        self.index[self.n] = index
+        self.n += 1
+        if self.n == len(self.buf):
+            self.commit()
+
+    def commit(self):
+        n0 = len(self.data_h5)
+        n1 = n0 + self.n
+        for ds in (self.data_h5, self.index_h5):
+            ds.resize(n1, axis=0)
+        self.data_h5[n0:n1] = self.buf[:self.n]
+        self.index_h5[n0:n1] = self.index[:self.n]
+        self.n = 0
+
+
+def run_grid(field, coarse_step):
+    """samples field with an AdaptiveGrid to completion, returns the grid
+    and the number of samples of every pass"""
+    grid = AdaptiveGrid(field.shape[0], field.shape[1], coarse_step=coarse_step)
+    n_samples = []
+    pixels = grid.next_pass()
+    while len(pixels):
+        grid.add(pixels, field[pixels[:, 0], pixels[:, 1]])
+        n_samples.append(len(pixels))
+        pixels = grid.next_pass()
+    return grid, n_samples
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(1)
+
+    # runs to completion, empty and flat fields stop after the coarse pass
+    for name, field, n_passes in (("empty", 100 + rng.normal(0, 2, (32, 32)), 1),
+                                  ("flat", np.full((32, 32), 5.0), 1),
+                                  ("alternating", 100 + np.indices((32, 32)).sum(axis=0) % 2, None)):
+        grid, n_samples = run_grid(field, coarse_step=8)
+        assert grid.done and np.isfinite(grid.interpolated()).all(), name
+        assert n_passes is None or len(n_samples) == n_passes, (name, n_samples)
+
+    # 256x256 field with a few particles on an empty substrate
+    N = 256
+    J, I = np.mgrid[0:N, 0:N]
+    field = 100 + rng.normal(0, 2, (N, N))
+    for y, x in rng.uniform(20, N - 20, size=(6, 2)):
+        field += 1000*np.exp(-((J - y)**2 + (I - x)**2)/(2*4.0**2))
+    grid, n_samples = run_grid(field, coarse_step=16)
+    image = grid.interpolated()
+    signal = field > 300
+    assert grid.done and grid.steps[grid.level] == 1
+    assert grid.sampled[signal].all()
+    assert np.abs(image - field)[signal].max() < 1e-9
+    print("{} passes, {} of {} pixels sampled ({:.1%}): {}".format(
+        len(n_samples), sum(n_samples), N*N, sum(n_samples)/(N*N), n_samples))
+    print("particle pixels sampled {:.1%}, interpolated map error: max {:.1f} on the particles,"
+          " rms {:.1f} elsewhere (noise 2)".format(
+              grid.sampled[signal].mean(), np.abs(image - field)[signal].max(),
+              np.sqrt(np.mean((image - field)[~signal]**2))))
@@ -1,6 +1,8 @@
 from ScopeFoundry import Measurement
 from ScopeFoundry import h5_io
 from ScopeFoundry.helper_funcs import load_qt_ui_file, sibling_path
+from .frame_stats import FrameStats
+from .live_image_display import LiveImageDisplay
 import pyqtgraph as pg
 import numpy as np
 import time
@@ -10,7 +12,19 @@ class AndorCCDKineticMeasure(Measurement):
     name = 'andor_ccd_kinetic'
     
     def setup(self):
-        pass
+        self.settings.New('save_h5', dtype=bool, initial=True)
+        self.settings.New('chunk_frames', dtype=int, initial=16, vmin=1,
+                          description='max frames retrieved per get_images call')
+        self.settings.New('frames_saved', dtype=int, ro=True)
+        self.settings.New('frames_lost', dtype=int, ro=True)
+        self.settings.New('save_frames', dtype=bool, initial=True,
+                          description='save every frame, otherwise only frame_stats (if enabled)')
+        self.settings.New('frame_stats', dtype=bool, initial=False,
+                          description='running per-pixel mean, variance, min and max of the series')
+        self.settings.New('display_mode', dtype=str, initial='last_frame', choices=('last_frame', 'sum'))
+        
+        self.display_frame = None
+        self.display_count = 0 # chunks appended, the display only draws new ones
     
     def setup_figure(self):
         ui = self.ui = load_qt_ui_file(sibling_path(__file__, 'andor_ccd_readout.ui'))
@@ -24,7 +38,8 @@ class AndorCCDKineticMeasure(Measurement):
         andor.settings.shutter_open.connect_to_widget(ui.andor_ccd_shutter_open_checkBox)
         
         #self.settings.bg_subtract.connect_to_widget(ui.andor_ccd_bgsub_checkBox)
-        ui.andor_ccd_acquire_cont_checkBox.stateChanged.connect(self.start_stop)
+        self.settings.activation.connect_to_pushButton(ui.andor_ccd_start_pushButton)
+        self.settings.save_h5.connect_to_widget(ui.save_h5_checkBox)
         #ui.andor_ccd_acq_bg_pushButton.clicked.connect(self.acquire_bg_start)
         #ui.andor_ccd_read_single_pushButton.clicked.connect(self.acquire_single_start)
 
@@ -52,29 +67,182 @@ class AndorCCDKineticMeasure(Measurement):
         self.hist_lut.autoHistogramRange()
         self.hist_lut.setImageItem(self.img_item)
         self.graph_layout.addItem(self.hist_lut)
+        self.live_display = LiveImageDisplay(self.img_item, self.hist_lut)
+    
+    def update_display(self):
+        if self.display_frame is None:
+            return
+        mode = self.settings['display_mode']
+        frame_id = (mode, self.display_count)
+        if frame_id == self.live_display.frame_id:
+            return # no new frames
+        if mode == 'sum':
+            self.live_display.render(self.display_sum, frame_id)
+            self.spec_plot_line.setData(self.display_sum_spectrum)
+        else:
+            self.live_display.render(self.display_frame, frame_id)
+            self.spec_plot_line.setData(self.display_spectrum)
     
     def run(self):
+        """
+        Streams a kinetic series to disk. New frames are drained from the
+        camera with get_images into a chunk buffer of chunk_frames and
+        appended to extendable h5 datasets, so memory use does not depend
+        on the length of the series.
+        In fast_kinetics mode the series is read out in one go at the end
+        and saved the same way.
+        With frame_stats, per-pixel running statistics of the series are
+        saved as well; save_frames=False keeps only those.
+        """
+        S = self.settings
         ccd_hw = self.app.hardware['andor_ccd']
         ccd_dev = ccd_hw.ccd_dev
-
-        N = ccd_dev.get_num_kinetics()
-        width_px = ccd_dev.Nx_ro
-        height_px = ccd_dev.Ny_ro
         
+        # acq_mode and kinetic_stream are restored in the end, later
+        # measurements must not get a streaming (one frame) buffer
+        ccd_config0 = ccd_hw.get_config()
         try:
-            ccd_dev.start_acquisition()
+            fast_kinetics = ccd_hw.settings['acq_mode'] == 'fast_kinetics'
+            if not fast_kinetics:
+                ccd_hw.settings['acq_mode'] = 'kinetic'
+                ccd_hw.settings['kinetic_stream'] = True
+            ccd_hw.set_readout()
 
-            stat = ccd_hw.settings.ccd_status.read_from_hardware()
-            
-            while stat == 'ACQUIRING':
-                print(stat, "GetTotalNumberImagesAcquired",
-                      ccd_dev.get_total_number_images_acquired())
-                
-                time.sleep(0.1)
-                stat = ccd_hw.settings.ccd_status.read_from_hardware()
-                if self.interrupt_measurement_called:
-                    ccd_hw.interrupt_acquisition()
-                    break
+            width_px = ccd_dev.Nx_ro
+            height_px = ccd_dev.Ny_ro
+            if fast_kinetics:
+                N = ccd_dev.fk_series_length
+                kin_time = ccd_dev.get_fk_exposure_time()
+                chunk = N
+            else:
+                N = ccd_dev.get_num_kinetics()
+                exp_time, acc_time, kin_time = ccd_dev.get_acquisition_timings()
+                chunk = min(S['chunk_frames'], N)
+        
+            # buffers reused for every drain
+            self.frames = np.zeros((chunk, height_px, width_px), dtype=ccd_dev.buffer_dtype)
+            self.frame_indices = np.zeros(chunk, dtype=np.int64)
+            self.frame_times = np.zeros(chunk, dtype=float)
+            self.display_frame = np.zeros((height_px, width_px), dtype=ccd_dev.buffer_dtype)
+            self.display_spectrum = np.zeros(width_px, dtype=float)
+            # running sum of the series, updated per drained chunk
+            self.display_sum = np.zeros((height_px, width_px), dtype=np.float64)
+            self.display_sum_spectrum = np.zeros(width_px, dtype=float)
+            self.frame_stats = FrameStats((height_px, width_px)) if S['frame_stats'] else None
+            save_frames = S['save_h5'] and S['save_frames']
+            flip = ccd_hw.settings['output_amp'] == 1
+        
+            S['frames_saved'] = 0
+            S['frames_lost'] = 0
+            self.n_saved = 0
+            self.last_index = 0
+        
+            if S['save_h5']:
+                self.t0 = time.time()
+                self.h5_file = h5_io.h5_base_file(self.app, measurement=self)
+                self.h5_file.attrs['time_id'] = self.t0
+                H = self.h5_meas_group = h5_io.h5_create_measurement_group(self, self.h5_file)
+                H.attrs['cycle_time'] = kin_time
+                H.attrs['fast_kinetics'] = fast_kinetics
+            if save_frames:
+                # roughly 1MB hdf5 chunks
+                frame_bytes = self.frames[0].nbytes
+                chunk_frames_h5 = int(max(1, min(N, 2**20 // frame_bytes)))
+                self.frames_h5 = h5_io.create_extendable_h5_dataset(
+                    H, 'frames', shape=(0, height_px, width_px), dtype=self.frames.dtype,
+                    chunks=(chunk_frames_h5, height_px, width_px))
+                self.frame_index_h5 = h5_io.create_extendable_h5_dataset(
+                    H, 'frame_index', shape=(0,), dtype=np.int64, chunks=(1024,))
+                self.frame_time_h5 = h5_io.create_extendable_h5_dataset(
+                    H, 'frame_time', shape=(0,), dtype=float, chunks=(1024,))
+                H['frame_time'].attrs['unit'] = 's'
+                H['frame_time'].attrs['description'] = 'nominal start of exposure, start_time + (frame_index-1)*cycle_time'
+            self.save_frames = save_frames
+        
+            try:
+                ccd_dev.start_acquisition()
+                self.start_time = time.time()
+                if S['save_h5']:
+                    self.h5_meas_group.attrs['start_time'] = self.start_time
+
+                while True:
+                    done = ccd_dev.wait_for_acquisition(timeout=0.1,
+                                    interrupt_func=lambda: self.interrupt_measurement_called)
+                    if fast_kinetics:
+                        if done:
+                            self.append_frames(ccd_hw.get_acquired_data(), 1, kin_time)
+                    else:
+                        self.drain_new_images(ccd_dev, kin_time, flip)
+                    self.set_progress(100.0*self.last_index/N)
+                    if done:
+                        break
+                    if self.interrupt_measurement_called:
+                        ccd_hw.interrupt_acquisition()
+                        # frames acquired before the abort are still retrievable
+                        if not fast_kinetics:
+                            self.drain_new_images(ccd_dev, kin_time, flip)
+                        break
+                ccd_hw.settings.ccd_status.read_from_hardware()
                 
+            finally:
+                if S['save_h5']:
+                    if self.frame_stats is not None:
+                        self.frame_stats.save_h5(self.h5_meas_group)
+                    self.h5_file.close()
+                self.log.info("{} frames saved".format(self.n_saved))
         finally:
-            print("done")
+            ccd_hw.apply_config(ccd_config0)
+    
+    def drain_new_images(self, ccd_dev, kin_time, flip=False):
+        """retrieve all new images in chunks of at most chunk_frames
+        and append them to the h5 datasets"""
+        S = self.settings
+        chunk = len(self.frames)
+        while True:
+            new_images = ccd_dev.get_number_new_images()
+            if new_images is None:
+                return
+            first, last = new_images
+            if first > self.last_index + 1:
+                # overwritten in the camera circular buffer before retrieval
+                S['frames_lost'] += first - self.last_index - 1
+            last = min(last, first + chunk - 1)
+            count = last - first + 1
+            
+            frames = self.frames[:count]
+            ccd_dev.get_images(first, last, frames)
+            if flip:
+                frames = frames[:,:,::-1]
+            self.append_frames(frames, first, kin_time)
+    
+    def append_frames(self, frames, first, cycle_time):
+        """append frames with indices starting at first to the h5 datasets"""
+        S = self.settings
+        count = len(frames)
+        last = first + count - 1
+        idx = self.frame_indices[:count]
+        np.add(np.arange(count), first, out=idx)
+        t = self.frame_times[:count]
+        np.multiply(idx - 1, cycle_time, out=t)
+        t += self.start_time
+        
+        if self.frame_stats is not None:
+            self.frame_stats.update(frames)
+        
+        if self.save_frames:
+            n0, n1 = self.n_saved, self.n_saved + count
+            for ds in (self.frames_h5, self.frame_index_h5, self.frame_time_h5):
+                ds.resize(n1, axis=0)
+            self.frames_h5[n0:n1] = frames
+            self.frame_index_h5[n0:n1] = idx
+            self.frame_time_h5[n0:n1] = t
+        
+        self.display_frame[:] = frames[-1]
+        np.mean(self.display_frame, axis=0, out=self.display_spectrum)
+        for frame in frames:
+            self.display_sum += frame
+        np.sum(self.display_sum, axis=0, out=self.display_sum_spectrum)
+        self.display_count += 1
+        self.n_saved += count
+        self.last_index = last
+        S['frames_saved'] = self.n_saved
@@ -1,6 +1,7 @@
 import numpy as np
 import time
 import pyqtgraph as pg
+from qtpy import QtWidgets
 
 from ScopeFoundry import Measurement 
 
@@ -8,6 +9,12 @@ from time import sleep
 
 from ScopeFoundry import h5_io
 from ScopeFoundry.helper_funcs import load_qt_ui_file, sibling_path
+from .frame_stats import FrameStats
+from .frame_pipeline import FramePipeline
+from .live_image_display import LiveImageDisplay
+from .h5_frame_writer import H5FrameWriter
+from .spectrum_glue import SpectrumGlue
+from .spectrometer_sweep import SpectrometerMover
 
 # ROW0 = 240
 # ROW1 = 271
@@ -67,6 +74,31 @@ class AndorCCDReadoutMeasure(Measurement):
         self.add_operation('run_acquire_single', self.acquire_single_start)
         
         self.settings.New('show_line', bool, initial=False)
+        
+        # streaming per-pixel statistics of all raw frames (every run_till_abort frame)
+        self.settings.New('frame_stats', bool, initial=False,
+                          description='''running per-pixel mean, variance, min and max of all raw frames. 
+                                         Continuous runs save only these statistics (if <b>save_h5</b>).''')
+        self.settings.New('stats_frames', dtype=int, initial=0, ro=True)
+        self.settings.New('stats_display', dtype=str, initial='frame', choices=('frame', 'mean', 'std', 'min', 'max'))
+        self.add_operation('reset_frame_stats', self.reset_frame_stats)
+        self.frame_stats = None
+        
+        self.frame_count = 0 # processed frames, the display only draws new ones
+        
+        # continuous recording, frames are written by a background thread
+        self.settings.New('record', bool, initial=False,
+                          description='''in <b>continuous</b> mode append every processed frame with 
+                                         time and count rate to an h5 file''')
+        self.settings.New('record_compression', dtype=str, initial='none', choices=('none', 'lzf', 'gzip'))
+        self.settings.New('record_queue_size', dtype=int, initial=64, vmin=2,
+                          description='frames buffered for the writer')
+        self.settings.New('record_backpressure', bool, initial=False,
+                          description='wait for the writer if the queue is full instead of dropping frames')
+        self.settings.New('record_flush_interval', dtype=float, unit='s', initial=1.0, vmin=0.01)
+        self.settings.New('frames_recorded', dtype=int, initial=0, ro=True)
+        self.settings.New('frames_dropped', dtype=int, initial=0, ro=True)
+        self.recorder = None
 
         
         
@@ -171,6 +203,7 @@ class AndorCCDReadoutMeasure(Measurement):
         self.hist_lut.autoHistogramRange()
         self.hist_lut.setImageItem(self.img_item)
         self.img_layout.addItem(self.hist_lut)
+        self.live_display = LiveImageDisplay(self.img_item, self.hist_lut)
         # self.ui.image_view_checkBox.setCheckState(False) #hide first.
                 
         ### CCD settings
@@ -179,6 +212,19 @@ class AndorCCDReadoutMeasure(Measurement):
         # self.ui.show_ccd_settings_checkBox.setCheckState(False) #hide first.
         
         
+    def reset_frame_stats(self):
+        if self.frame_stats is not None:
+            self.frame_stats.reset()
+        self.settings['stats_frames'] = 0
+    
+    def update_frame_stats(self, frames):
+        stats = self.frame_stats
+        shape = frames.shape[-2:]
+        if stats is None or stats.shape != shape:
+            stats = self.frame_stats = FrameStats(shape)
+        stats.update(frames)
+        self.settings['stats_frames'] = stats.n
+
     def on_change_show_line(self):
         if self.settings['show_line']:
             self.spec_plot.addItem(self.spec_infline)
@@ -195,13 +241,29 @@ class AndorCCDReadoutMeasure(Measurement):
         
         ccd_hw.settings['trigger_mode'] = 'internal'
         
+        # multi/random track: every row of the readout is one track (fiber) binned on chip
+        self.track_mode = ccd_hw.settings['readout_mode'] in ('MultiTrack', 'RandomTrack')
+        
         t_acq = self.app.hardware['andor_ccd'].settings['exposure_time'] #in seconds
+        if ccd_hw.settings['acq_mode'] == 'fast_kinetics':
+            t_acq = ccd_hw.settings['fk_exposure_time']
+        
+        if self.settings['frame_stats']:
+            self.reset_frame_stats()
+        
+        # flip, divide, bg subtract and row average into preallocated buffers
+        flip = ccd_hw.settings['output_amp'] == 1
+        self.pipeline = FramePipeline(ccd_dev.buffer.shape, flip=flip)
         
         wait_time = 0.01 #np.min(1.0,np.max(0.05*t_acq, 0.05)) # limit update period to 50ms (in ms) or as slow as 1sec
         
         # print('andor_ccd_readout run')
             
         try:
+            if (self.settings['record'] and self.settings.continuous.val 
+                    and not self.acquire_bg.val):
+                self.start_recording(ccd_dev.buffer.shape, t_acq)
+            
             self.log.info("starting acq")
             
             # print("starting acq")
@@ -221,55 +283,68 @@ class AndorCCDReadoutMeasure(Measurement):
 
             while not self.interrupt_measurement_called:
 
-                wl_calib = self.settings['wl_calib']
-                hbin = ccd_dev.get_current_hbin()
-                if wl_calib=='acton_spectrometer':
-                    px_index = np.arange(width_px)
-                    spec_hw = self.app.hardware['acton_spectrometer']
-                    self.wls = spec_hw.get_wl_calibration(px_index, hbin)
-                elif wl_calib=='andor_spectrometer':
-                    px_index = np.arange(width_px)
-                    spec_hw = self.app.hardware['andor_spec']
-                    self.wls = spec_hw.get_wl_calibration(px_index, hbin)   
-                elif wl_calib=='pixels':
-                    binning = hbin
-                    px_index = np.arange(width_px)
-                    self.wls = binned_px = binning*px_index + 0.5*(binning-1)
-                elif wl_calib=='raw_pixels':
-                    self.wls = np.arange(width_px)
-                else:
-                    self.wls = np.arange(width_px)
+                # cached in ccd_hw, recomputed only after a readout or calibration change
+                self.wls = ccd_hw.get_wl_axis(self.settings['wl_calib'])
 
             
-                stat = ccd_hw.settings.ccd_status.read_from_hardware()
-                if stat == 'IDLE':
+                # sleep in the driver until the frame is done, wake up regularly
+                # for progress and interrupts
+                new_data = ccd_dev.wait_for_acquisition(timeout=0.1, 
+                                                        interrupt_func=lambda: self.interrupt_measurement_called)
+                n_ring = 0
+                if new_data and ccd_hw.settings['acq_mode'] == 'run_till_abort':
+                    # streaming: newest frame in the ring buffer, camera keeps running
+                    frame_indices, frames = ccd_hw.get_ring_frames(flip=False)
+                    n_ring = len(frame_indices)
+                    new_data = n_ring > 0
+                    if new_data:
+                        raw = frames[-1]
+                elif new_data:
                     # grab data
-                    self.buffer_ = ccd_hw.get_acquired_data()
+                    frames = raw = ccd_dev.get_acquired_data()
+                
+                if new_data:
                                         
-                    #print('andor_ccd buffer', self.buffer_.shape, ccd_dev.buffer.shape)
-                            
+                    if self.settings['frame_stats']:
+                        self.update_frame_stats(frames[...,::-1] if flip else frames)
+                    
+                    divisor = 1
                     if ccd_hw.settings['acq_mode'] == 'accumulate':
-                        self.buffer_ = self.buffer_ / ccd_hw.settings['num_acc']
-                        print(self.name, 'buffer division', self.buffer_[0][0])
-                                        
+                        divisor = ccd_hw.settings['num_acc']
+                    
+                    bg = None
                     if self.bg_subtract.val and not self.acquire_bg.val:
                         bg = ccd_hw.background
-                        if bg is not None:
-                            if bg.shape == self.buffer_.shape:
-                                self.buffer_ = self.buffer_ - bg
-                            else:
-                                self.log.warning("Background not the correct shape {} != {}".format( self.buffer_.shape, bg.shape))
-                        else:
+                        if bg is None:
                             self.log.warning( "No Background available, raw data shown")
-
-                    #print(self.name, 'after bg', self.buffer_[0][0])
-
-                    self.spectra_data = np.average(self.buffer_, axis=0)
+                        elif bg.shape != raw.shape[-bg.ndim:]:
+                            self.log.warning("Background not the correct shape {} != {}".format( raw.shape, bg.shape))
+                            bg = None
+                    
+                    self.pipeline.configure(raw.shape, flip, divisor, bg)
+                    t_frame = time.time()
+                    if self.recorder is not None:
+                        # every ring frame is recorded, not only the displayed newest one
+                        for ii in range(n_ring - 1):
+                            frame, spectrum = self.pipeline.process(frames[ii])
+                            self.recorder.put(frame, frame_indices[ii], t_frame, np.sum(spectrum)/t_acq)
+                    self.buffer_, self.spectra_data = self.pipeline.process(raw)
+                    if n_ring:
+                        ccd_dev.release_ring_frames(n_ring)
+                    if self.buffer_.ndim == 3:
+                        # kinetic series: summed once per series, not per display update
+                        self.update_kinetic_sum(self.buffer_)
+                    self.frame_count += 1
                     self.settings['count_rate'] = np.sum(self.spectra_data)/t_acq
+                    if self.recorder is not None:
+                        index = frame_indices[-1] if n_ring else self.frame_count
+                        self.recorder.put(self.buffer_, index, t_frame, self.settings['count_rate'])
+                        self.settings['frames_recorded'] = self.recorder.n_written
+                        self.settings['frames_dropped'] = self.recorder.n_dropped
  
                     if self.acquire_bg.val or not self.settings.continuous.val:
                         break # end the while loop for non-continuous scans
-                    else:
+                    elif ccd_hw.settings['acq_mode'] != 'run_till_abort':
                         # restart acq
                         ccd_dev.start_acquisition()
 
@@ -291,20 +366,15 @@ class AndorCCDReadoutMeasure(Measurement):
                         else:
                             pct = 100 * (time.time()-t0)/t_acq
                         self.set_progress(pct)
-
-                    sleep(0.01)
-                    
-                    
-                    try:
-                        ccd_hw.settings.temperature.read_from_hardware()
-                        ccd_hw.settings.temp_status.read_from_hardware()
-                    except Exception as err:
-                        pass # sometimes temperature can't be read during acquisition
+                    # status and temperature are polled by ccd_hw (telemetry)
         #except Exception as err:
         #    self.log.error( "{} error: {}".format(self.name, err))
         finally:            
             # while-loop is complete
             ccd_hw.interrupt_acquisition()
+            
+            if self.recorder is not None:
+                self.stop_recording()
 
             
             #is this right place to put this?
@@ -334,6 +404,10 @@ class AndorCCDReadoutMeasure(Measurement):
                     #create h5 data arrays
                     H['wls'] = self.wls
                     H['spectrum'] = self.spectrum
+                    if self.track_mode:
+                        H['tracks'] = ccd_dev.ro_tracks
+                    if self.settings['frame_stats']:
+                        self.frame_stats.save_h5(H)
                 
                     self.h5_file.close()
 
@@ -359,27 +433,104 @@ class AndorCCDReadoutMeasure(Measurement):
                 self.log.info( "Andor CCD single acq successfully acquired")
                 # print("Andor CCD single acq successfully acquired")
                 # self.settings.continuous.update_value(True)
+            
+            elif (self.settings['frame_stats'] and self.settings['save_h5']
+                      and self.frame_stats is not None and self.frame_stats.n > 0):
+                # long software accumulation, only the statistics are kept
+                self.h5_file = h5_io.h5_base_file(self.app, measurement=self )
+                self.h5_file.attrs['time_id'] = time.time()
+                H = self.h5_meas_group  =  h5_io.h5_create_measurement_group(self, self.h5_file)
+                H['wls'] = self.wls
+                self.frame_stats.save_h5(H)
+                self.h5_file.close()
                 
-            ccd_hw.settings.ccd_status.read_from_hardware()
-            ccd_hw.settings.temperature.read_from_hardware()
-            ccd_hw.settings.temp_status.read_from_hardware()
-
+            ccd_hw.poll_telemetry()
+
+    def start_recording(self, frame_shape, t_acq):
+        """opens the h5 file and starts the background writer of record mode"""
+        S = self.settings
+        self.h5_record_file = h5_io.h5_base_file(self.app, measurement=self)
+        self.h5_record_file.attrs['time_id'] = time.time()
+        H = h5_io.h5_create_measurement_group(self, self.h5_record_file)
+        H['wls'] = self.app.hardware['andor_ccd'].get_wl_axis(S['wl_calib'])
+        H.attrs['exposure_time'] = t_acq
+        compression = S['record_compression']
+        self.recorder = H5FrameWriter(H, frame_shape, dtype=np.float32,
+                                      queue_size=S['record_queue_size'],
+                                      compression=None if compression == 'none' else compression,
+                                      flush_interval=S['record_flush_interval'],
+                                      backpressure=S['record_backpressure'])
+        S['frames_recorded'] = 0
+        S['frames_dropped'] = 0
+        self.recorder.start()
+    
+    def stop_recording(self):
+        """writes the queued frames and closes the record file"""
+        recorder, self.recorder = self.recorder, None
+        try:
+            recorder.close()
+        finally:
+            self.settings['frames_recorded'] = recorder.n_written
+            self.settings['frames_dropped'] = recorder.n_dropped
+            recorder.h5_group.attrs['frames_dropped'] = recorder.n_dropped
+            self.h5_record_file.close()
+            self.log.info("recorded {} frames, {} dropped, {:.2f} s writing".format(
+                recorder.n_written, recorder.n_dropped, recorder.write_time))
+    
+    def update_kinetic_sum(self, frames):
+        if getattr(self, 'kinetic_sum', None) is None or self.kinetic_sum.shape != frames.shape[1:]:
+            self.kinetic_sum = np.zeros(frames.shape[1:], dtype=np.float64)
+            self.kinetic_spectrum = np.zeros(frames.shape[2], dtype=np.float64)
+        np.sum(frames, axis=0, out=self.kinetic_sum)
+        np.sum(self.kinetic_sum, axis=0, out=self.kinetic_spectrum)
+    
     def update_display(self):
-        if hasattr(self, 'buffer_'):
-            #print('update_display', self.buffer_.shape)
-            if len(self.buffer_.shape) == 2:
-                self.img_item.setImage(self.buffer_.astype(np.float32).T, autoLevels=False)
-                self.hist_lut.imageChanged(autoLevel=True, autoRange=True)
-                y = self.spectra_data
-                
-            else: # kinetic
-                self.img_item.setImage(self.buffer_[:,:,:].sum(axis=0).astype(np.float32).T, autoLevels=False)
-                self.hist_lut.imageChanged(autoLevel=True, autoRange=True)
-                y = self.buffer_[:,:,:].sum(axis=(0,1))
-
-            x = self.wls        
-            
+        if not hasattr(self, 'buffer_'):
+            return
+        stats_display = self.settings['stats_display']
+        show_stats = (stats_display != 'frame' and self.settings['frame_stats']
+                      and self.frame_stats is not None and self.frame_stats.n > 0)
+        if show_stats:
+            frame_id = (stats_display, self.frame_stats.n)
+        else:
+            frame_id = self.frame_count
+        if frame_id == self.live_display.frame_id:
+            return # no new frame since the last update
+        
+        tracks = None
+        if show_stats:
+            img = self.frame_stats.snapshot()[stats_display]
+            y = img.mean(axis=0)
+        elif self.buffer_.ndim == 2:
+            img = self.buffer_
+            y = self.spectra_data
+            if getattr(self, 'track_mode', False):
+                tracks = self.buffer_
+        else: # kinetic
+            img = self.kinetic_sum
+            y = self.kinetic_spectrum
+        self.live_display.render(img, frame_id)
+        
+        x = self.wls
+        if tracks is None:
             self.spec_plot_line.setData(x,y)
+        self.update_track_lines(x, tracks)
+    
+    def update_track_lines(self, x, tracks):
+        """one spectrum line per track, hides the extra lines if tracks is None"""
+        if not hasattr(self, 'track_plot_lines'):
+            self.track_plot_lines = []
+        n = 0 if tracks is None else len(tracks)
+        while len(self.track_plot_lines) < n:
+            self.track_plot_lines.append(self.spec_plot.plot())
+        for i, line in enumerate(self.track_plot_lines):
+            if i < n:
+                line.setPen(pg.mkPen((i, n)))
+                line.setData(x, tracks[i])
+                line.show()
+            else:
+                line.hide()
+        self.spec_plot_line.setVisible(tracks is None)
     
     def get_spectrum(self):
         return np.squeeze(self.spectrum)
@@ -387,18 +538,30 @@ class AndorCCDReadoutMeasure(Measurement):
     def get_wavelengths(self):
         return self.wls
     
-    def set_explore_mode(self):
+    def wait_until_stopped(self, timeout=5.0):
+        """interrupts the measurement and waits until its thread has ended
+        and post_run is done. Returns False on timeout"""
         self.interrupt()
-        time.sleep(0.1)
+        t0 = time.time()
+        while self.is_measuring():
+            if time.time() - t0 > timeout:
+                self.log.warning("{} did not stop within {} s".format(self.name, timeout))
+                return False
+            if self.acq_thread is not None:
+                self.acq_thread.wait(10)
+            # deliver the queued finished signal (post_run)
+            pg.QtCore.QCoreApplication.processEvents()
+        return True
+    
+    def set_explore_mode(self):
+        t0 = time.time()
+        self.wait_until_stopped()
         if self.settings['explore_mode']:
             if not self.hw.settings['connected']: 
                 self.hw.settings['connected'] = True
                 self.hw.read_from_hardware()
-            time.sleep(0.1)
             # store hw and measurement settings
-            self.ccd_state0 = {}
-            for lqname, lq in self.hw.settings.as_dict().items():
-                self.ccd_state0.update({lqname:lq.val})                
+            self.ccd_state0 = self.hw.get_config()
             self.continuous0 = self.settings['continuous']
             self.activation0 = self.settings['activation']
             self.save_h50 = self.settings['save_h5']            
@@ -411,18 +574,26 @@ class AndorCCDReadoutMeasure(Measurement):
         else:
             # set to previous (stored) settings
             if hasattr(self, 'ccd_state0'):
-                for lqname, val in self.ccd_state0.items():
-                    if lqname in ['connected']: #exclude some settings 
-                        continue
-                    else:
-                        self.hw.settings[lqname] = val      
+                # only the changed settings, in dependency order
+                changed = self.hw.apply_config(self.ccd_state0)
+                self.log.info("explore mode restored {}".format(changed))
                 self.settings['continuous'] = self.continuous0           
                 self.settings['save_h5'] = self.save_h50
                 self.settings['activation'] = self.activation0           
+        self.log.info("explore mode {} in {:.3f} s".format(
+            'on' if self.settings['explore_mode'] else 'off', time.time() - t0))
 
                   
                   
 class AndorCCDStepAndGlue(Measurement):
+    """
+    Broadband spectrum from a series of spectrometer (andor_spec) center
+    wavelengths, glued onto a common wavelength grid (see SpectrumGlue).
+    
+    Acquisition is pipelined: as soon as frame N is exposed, the grating
+    starts moving to the center wavelength of N+1 in a worker thread, while
+    frame N is read out, processed, glued and queued for writing.
+    """
 
     name = "andor_ccd_step_and_glue"
     
@@ -438,108 +609,163 @@ class AndorCCDStepAndGlue(Measurement):
         self.center_wl_start = self.add_logged_quantity('center_wl_start', dtype=float, initial=400, ro=False)
         self.center_wl_stop  = self.add_logged_quantity('center_wl_stop', dtype=float, initial=1100, ro=False)
         self.center_wl_step = self.add_logged_quantity('center_wl_step', dtype=float, initial=50, ro=False)
+        
+        self.settings.New('glue_step', dtype=float, initial=0, unit='nm', vmin=0,
+                          description='wavelength step of the glued spectrum, 0: finest pixel spacing')
+        self.settings.New('move_during_readout', dtype=bool, initial=True,
+                          description='start moving the grating when the exposure ends, not after the readout')
+        self.settings.New('save_h5', dtype=bool, initial=True)
+        self.settings.New('compression', dtype=str, initial='gzip', choices=('none', 'gzip', 'lzf'))
+        
+        self.step_index = -1
+        self.display_step = None
+        self.glue = None # created by run()
 
-    
     def setup_figure(self):
-        ui = self.ui = load_qt_ui_file(sibling_path(__file__, 'andor_ccd_readout.ui'))
-    
-        #connect events
-        self.bg_subtract.connect_bidir_to_widget(self.ui.andor_ccd_bgsub_checkBox)
-        
-    
+        self.ui = QtWidgets.QWidget()
+        layout = QtWidgets.QVBoxLayout()
+        self.ui.setLayout(layout)
+        layout.addWidget(self.settings.New_UI(exclude=('activation', 'run_state', 'profile', 'progress')))
+        layout.addWidget(self.new_start_stop_button())
+        self.graph_layout = pg.GraphicsLayoutWidget()
+        layout.addWidget(self.graph_layout)
+        self.spec_plot = self.graph_layout.addPlot(title='glued spectrum')
+        self.spec_plot.setLabel('bottom', 'wavelength', units='nm')
+        self.window_plot_line = self.spec_plot.plot(pen=pg.mkPen((100, 100, 255), width=1))
+        self.glue_plot_line = self.spec_plot.plot(pen='w')
 
-    def _run(self):
+    def run(self):
 
         # Hardware
         ccd_hw = self.app.hardware['andor_ccd']
-        ccd = ccd_hw.ccd_dev
+        ccd_dev = ccd_hw.ccd_dev
+        spec_hw = self.app.hardware['andor_spec']
+        S = self.settings
         
-        if 'acton_spec' in self.app.hardware:
-            acton_spec_hc = self.gui.acton_spec_hc
-    
-        width_px = ccd.Nx_ro
-        height_px = ccd.Ny_ro
-        
-        #ccd_shape=(self.Ny_ro, self.Nx_ro)
-
-        # h5 data file setup
-        self.t0 = time.time()
-        self.h5_file = h5_io.h5_base_file(self.gui, "%i_%s.h5" % (self.t0, self.name) )
-        self.h5_file.attrs['time_id'] = self.t0
-        h5m = self.h5_meas_group = self.h5_file.create_group(self.name)
-        
-        h5m.attrs['time_id'] = self.t0
-        h5_io.h5_save_measurement_settings(self, h5m)
-        h5_io.h5_save_hardware_lq(self.gui, h5m)
-
-        #setup data arrays (in h5 file)
-        
-        # center wl array contains start and stop centers         
-        self.center_wl_array = np.arange(self.center_wl_start.val, 
-                                         self.center_wl_stop.val + self.center_wl_step.val,
-                                         self.center_wl_step.val)
-        num_specs = len(self.center_wl_array)
-        self.center_wl_array = h5m.create_dataset('center_wl_array', data=self.center_wl_array)
-        self.center_wl_actual = h5m.create_dataset('center_wl_actual', shape=self.center_wl_array.shape)
-        
-        self.wls = h5m.create_dataset('wls', (num_specs, width_px), dtype=float)
-        self.spectra_data = h5m.create_dataset('spectra_data', 
-                                               shape=(num_specs, height_px, width_px,),
-                                               dtype=np.int32, compression='gzip')
-        
-        if self.bg_subtract.val:
-            bg = self.bg = ccd_hw.background
-            if bg is not None and bg.shape == ccd.buffer.shape:
-                h5m['andor_ccd_bg'] = self.bg
-            else:
-                self.log.warning( "Background not avail or the correct shape {}".format(ccd.buffer.shape))#,# bg#bg.shape
-                self.bg_subtract.update_value(False)
+        ccd_config0 = ccd_hw.get_config()
         try:
-            for ii, center_wl in enumerate(self.center_wl_array):
-                if self.interrupt_measurement_called:
-                    break
-                
-                #TODO add progress update
-                
-
-                # move to center wl
-                acton_spec_hc.center_wl.update_value(center_wl)
-                self.center_wl_actual[ii] = acton_spec_hc.center_wl.val 
-                
-                self.wls[ii,:]  = pixel2wavelength(acton_spec_hc.center_wl.val, 
-                                             np.arange(width_px), binning=ccd.get_current_hbin())
-
-                self.log.info("starting ccd acq")
-                ccd.start_acquisition()
-                
-                # wait until ccd is done acquiring
-                while True:
+            if ccd_hw.settings['acq_mode'] not in ('single', 'accumulate'):
+                ccd_hw.settings['acq_mode'] = 'single'
+            ccd_hw.settings['trigger_mode'] = 'internal'
+        
+            # end of the exposure after start_acquisition, readout not included
+            exp, acc, kin = ccd_dev.get_acquisition_timings()
+            t_exposed = exp
+            if ccd_hw.settings['acq_mode'] == 'accumulate':
+                t_exposed += (ccd_hw.settings['num_acc'] - 1)*acc
+            # the exposure may start late (keep clean cycle, shutter)
+            t_exposure_end = t_exposed + ccd_dev.get_exposure_end_margin()
+        
+            # center wl array contains start and stop centers         
+            self.center_wl_array = center_wls = np.arange(
+                self.center_wl_start.val, self.center_wl_stop.val + 0.5*self.center_wl_step.val,
+                self.center_wl_step.val)
+            num_specs = len(center_wls)
+            width_px = ccd_dev.Nx_ro
+            px = np.arange(width_px)
+            hbin = ccd_dev.get_current_hbin()
+        
+            # the glue grid covers the requested windows
+            windows = [spec_hw.get_wl_calibration(px, hbin, center_wl=c) for c in center_wls]
+            self.glue = SpectrumGlue(SpectrumGlue.make_grid(windows, S['glue_step']))
+            self.wls = np.zeros((num_specs, width_px))
+            self.spectra = np.zeros((num_specs, width_px))
+            self.center_wl_actual = np.full(num_specs, np.nan)
+            self.step_index = -1
+        
+            bg = None
+            if self.bg_subtract.val:
+                bg = ccd_hw.background
+                if bg is None or bg.shape != ccd_dev.buffer.shape:
+                    self.log.warning( "Background not avail or the correct shape {}".format(ccd_dev.buffer.shape))
+                    self.bg_subtract.update_value(False)
+                    bg = None
+            flip = ccd_hw.settings['output_amp'] == 1
+            divisor = 1
+            if ccd_hw.settings['acq_mode'] == 'accumulate':
+                divisor = ccd_hw.settings['num_acc']
+            pipeline = FramePipeline(ccd_dev.buffer.shape, flip=flip, divisor=divisor, background=bg)
+        
+            writer = None
+            if S['save_h5']:
+                self.h5_file = h5_io.h5_base_file(self.app, measurement=self)
+                self.h5_file.attrs['time_id'] = time.time()
+                h5m = self.h5_meas_group = h5_io.h5_create_measurement_group(self, self.h5_file)
+                h5m['center_wl_array'] = center_wls
+                if bg is not None:
+                    h5m['andor_ccd_bg'] = bg
+                compression = S['compression']
+                writer = H5FrameWriter(h5m, ccd_dev.buffer.shape, dtype=np.float32,
+                                       queue_size=min(num_specs, 16),
+                                       compression=None if compression == 'none' else compression,
+                                       backpressure=True)
+                writer.start()
+        
+            mover = SpectrometerMover(spec_hw)
+            interrupted = lambda: self.interrupt_measurement_called
+            t0 = time.time()
+            try:
+                move = mover.move(center_wls[0])
+                for ii in range(num_specs):
                     if self.interrupt_measurement_called:
                         break
-                    stat = ccd.get_status()
-                    if stat == 'IDLE':
-                        self.ccd_buffer = ccd.get_acquired_data()
-    
-                        if self.bg_subtract.val:
-                            self.ccd_buffer = self.ccd_buffer - self.bg
-                            self.log.debug("self.bg.shape {}".format(self.bg.shape))
-                            self.log.debug("self.ccd_buffer.shape {}".format(self.ccd_buffer.shape))
-                            
-
-                        self.spectra_data[ii,:,:] = self.ccd_buffer
+                    self.center_wl_actual[ii] = move.result()
+                    self.wls[ii] = spec_hw.get_wl_calibration(px, hbin, center_wl=self.center_wl_actual[ii])
+                
+                    t_start = time.time()
+                    ccd_dev.start_acquisition()
+                    if S['move_during_readout']:
+                        # the grating moves on while frame ii is read out
+                        ccd_dev.wait_for_acquisition(timeout=max(0, t_start + t_exposure_end - time.time()),
+                                                     interrupt_func=interrupted)
+                        if ii + 1 < num_specs:
+                            move = mover.move(center_wls[ii+1])
+                    if not ccd_dev.wait_for_acquisition(interrupt_func=interrupted):
                         break
-                    else:
-                        sleep(0.01) # wait for a while before polling
-                self.h5_file.flush()
-                        
-        except Exception as err:
-            self.log.error( "{} error: {}".format(self.name, err))
-        finally:            
-            ccd_hw.interrupt_acquisition()
-            self.h5_file.close()            
+                    if ii + 1 < num_specs and not S['move_during_readout']:
+                        move = mover.move(center_wls[ii+1])
+                
+                    # ... and while it is processed, glued and queued for writing
+                    frame, spectrum = pipeline.process(ccd_dev.get_acquired_data())
+                    self.spectra[ii] = spectrum
+                    self.glue.add(self.wls[ii], spectrum)
+                    if writer is not None:
+                        writer.put(frame, ii, t_start)
+                    self.step_index = ii
+                    self.set_progress(100.*(ii+1)/num_specs)
+                self.log.info("{} steps in {:.2f} s, exposures {:.2f} s".format(
+                    self.step_index+1, time.time() - t0, (self.step_index+1)*t_exposed))
+            finally:
+                mover.close()
+                ccd_hw.interrupt_acquisition()
+                if writer is not None:
+                    try:
+                        writer.close()
+                    finally:
+                        h5m['center_wl_actual'] = self.center_wl_actual
+                        h5m['wls'] = self.wls
+                        h5m['spectra'] = self.spectra
+                        h5m['glued_wls'] = self.glue.grid
+                        h5m['glued_spectrum'] = self.glue.glued()
+                        self.h5_file.close()
+        finally:
+            ccd_hw.apply_config(ccd_config0)
+    
+    def update_display(self):
+        ii = self.step_index
+        if ii < 0 or ii == self.display_step:
+            return
+        self.display_step = ii
+        self.window_plot_line.setData(self.wls[ii], self.spectra[ii])
+        self.glue_plot_line.setData(self.glue.grid, self.glue.glued(), connect='finite')
             
     def get_spectrum(self):
-        return np.squeeze(self.spectrum)
+        """glued spectrum of the last run, empty before the first one"""
+        if self.glue is None:
+            return np.zeros(0)
+        return self.glue.glued()
     
     def get_wavelengths(self):
-        return self.wls
\ No newline at end of file
+        if self.glue is None:
+            return np.zeros(0)
+        return self.glue.grid
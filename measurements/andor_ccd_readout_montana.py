@@ -10,6 +10,7 @@ from time import sleep
 
 from ScopeFoundry import h5_io
 from ScopeFoundry.helper_funcs import load_qt_ui_file, sibling_path
+from .frame_pipeline import subtract_background
 
 # ROW0 = 240
 # ROW1 = 271
@@ -242,32 +243,16 @@ class AndorCCDReadoutMeasureMontana(Measurement):
 
             while not self.interrupt_measurement_called:
 
+                # cached in ccd_hw, recomputed only after a readout or calibration change
                 wl_calib = self.settings['wl_calib']
-                hbin = ccd_dev.get_current_hbin()
-                if wl_calib=='acton_spectrometer':
-                    px_index = np.arange(width_px)
-                    spec_hw = self.app.hardware['acton_spectrometer']
-                    self.wls = spec_hw.get_wl_calibration(px_index, hbin)
-                elif wl_calib=='andor_spectrometer':
-                    px_index = np.arange(width_px)
-                    spec_hw = self.app.hardware['andor_spec']
-                    if self.ui.Wavelength_Energy_Combobox.currentText()=='Energy':
-                        self.wls= 1239.84/spec_hw.get_wl_calibration(px_index, hbin)
-                        self.xLabel='Energy(eV)'
-                    else:
-                        self.wls = spec_hw.get_wl_calibration(px_index, hbin)
-                        self.xLabel='Wavelength (nm)'  
-                elif wl_calib=='pixels':
-                    binning = hbin
-                    px_index = np.arange(width_px)
-                    self.wls = binned_px = binning*px_index + 0.5*(binning-1)
-                    self.xLabel='Pixels'
-                elif wl_calib=='raw_pixels':
-                    self.wls = np.arange(width_px)
-                    self.xLabel='Pixels'
+                if wl_calib=='andor_spectrometer':
+                    energy = self.ui.Wavelength_Energy_Combobox.currentText()=='Energy'
+                    self.wls = ccd_hw.get_wl_axis(wl_calib, energy=energy)
+                    self.xLabel = 'Energy(eV)' if energy else 'Wavelength (nm)'
                 else:
-                    self.wls = np.arange(width_px)
-                    self.xLabel='Pixels'
+                    self.wls = ccd_hw.get_wl_axis(wl_calib)
+                    if wl_calib in ('pixels', 'raw_pixels'):
+                        self.xLabel='Pixels'
             
                 stat = ccd_hw.settings.ccd_status.read_from_hardware()
 
@@ -288,7 +273,7 @@ class AndorCCDReadoutMeasureMontana(Measurement):
                         bg = ccd_hw.background
                         if bg is not None:
                             if bg.shape == self.buffer_.shape:
-                                self.buffer_ = self.buffer_ - bg
+                                self.buffer_ = subtract_background(self.buffer_, bg)
                             else:
                                 self.log.warning("Background not the correct shape {} != {}".format( self.buffer_.shape, bg.shape))
                         else:
@@ -314,12 +299,7 @@ class AndorCCDReadoutMeasureMontana(Measurement):
                     
                     finished_percent=np.ceil((time.time()-t0)/meas_time*100)
                     self.settings['progress']=finished_percent
-
-                    try:
-                        ccd_hw.settings.temperature.read_from_hardware()
-                        ccd_hw.settings.temp_status.read_from_hardware()
-                    except Exception as err:
-                        pass # sometimes temperature can't be read during acquisition
+                    # status and temperature are polled by ccd_hw (telemetry)
         #except Exception as err:
         #    self.log.error( "{} error: {}".format(self.name, err))
         finally:            
@@ -386,9 +366,7 @@ class AndorCCDReadoutMeasureMontana(Measurement):
                 # print("Andor CCD single acq successfully acquired")
                 # self.settings.continuous.update_value(True)
                 
-            ccd_hw.settings.ccd_status.read_from_hardware()
-            ccd_hw.settings.temperature.read_from_hardware()
-            ccd_hw.settings.temp_status.read_from_hardware()
+            ccd_hw.poll_telemetry()
 
 
     
@@ -510,7 +488,7 @@ class AndorCCDStepAndGlue(Measurement):
         self.wls = h5m.create_dataset('wls', (num_specs, width_px), dtype=float)
         self.spectra_data = h5m.create_dataset('spectra_data', 
                                                shape=(num_specs, height_px, width_px,),
-                                               dtype=np.int32, compression='gzip')
+                                               dtype=np.float32, compression='gzip')
         
         if self.bg_subtract.val:
             bg = self.bg = ccd_hw.background
@@ -545,7 +523,7 @@ class AndorCCDStepAndGlue(Measurement):
                         self.ccd_buffer = ccd.get_acquired_data()
     
                         if self.bg_subtract.val:
-                            self.ccd_buffer = self.ccd_buffer - self.bg
+                            self.ccd_buffer = subtract_background(self.ccd_buffer, self.bg)
                             self.log.debug("self.bg.shape {}".format(self.bg.shape))
                             self.log.debug("self.ccd_buffer.shape {}".format(self.ccd_buffer.shape))
                             
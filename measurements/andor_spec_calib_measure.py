@@ -2,21 +2,46 @@ from ScopeFoundry import Measurement, h5_io
 from ScopeFoundry.helper_funcs import sibling_path, load_qt_ui_file,\
     replace_spinbox_in_layout
 
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import pyqtgraph as pg
 import numpy as np
 import time
 
+from .spectrometer_sweep import sweep_order, SpectrometerMover
+
 class AndorSpecCalibMeasure(Measurement):
+    """
+    Sweeps the spectrometer center wavelength (for one or more gratings)
+    and records a spectrum at every step, with the requested and the
+    actual center wavelength and the wavelength axis of the step.
+    
+    The spectrometer moves to the next step as soon as an exposure ends,
+    while the frame is read out. Row averaging and HDF5 writes run in a
+    worker thread. Multi grating sweeps change each grating once, see
+    sweep_order().
+    """
     
     name = 'andor_spec_calib'
     
+    # steps that may wait for the processing thread
+    max_pending = 4
+    
     def setup(self):
         
         self.settings.New_Range('sweep_wls', dtype=float)
+        self.settings.New('sweep_gratings', dtype=str, initial='',
+                          description='comma separated grating ids to sweep, empty: the current grating')
+        self.settings.New('move_during_readout', dtype=bool, initial=True,
+                          description='start moving the spectrometer when the exposure ends, not after the readout')
+        self.settings.New('save_h5', dtype=bool, initial=True)
         
         self.ui_filename = sibling_path(__file__, 'andor_spec_calib_measure.ui')
         self.ui = load_qt_ui_file(self.ui_filename)
         
+        self.step_index = -1
+        self.display_step = None
+        
     def setup_figure(self):
 
         self.graph_layout=pg.GraphicsLayoutWidget()
@@ -56,6 +81,9 @@ class AndorSpecCalibMeasure(Measurement):
             self.ui.sweep_wls_step_doubleSpinBox)
         self.settings.sweep_wls_num.connect_to_widget(
             self.ui.sweep_wls_num_doubleSpinBox)
+        controls = self.ui.controls_groupBox.layout()
+        controls.insertWidget(controls.count()-1, 
+                              self.settings.New_UI(include=('sweep_gratings', 'move_during_readout', 'save_h5')))
         
         # Camera settings
         self.andor_ccd = self.app.hardware['andor_ccd']
@@ -86,54 +114,127 @@ class AndorSpecCalibMeasure(Measurement):
         self.andor_ccd.settings['trigger_mode'] = 'internal'
         self.andor_ccd.set_readout()
         
+        S = self.settings
         ccd_hw = self.app.hardware['andor_ccd']
         ccd_dev = ccd_hw.ccd_dev
+        spec = self.spec
         
         width_px = ccd_dev.Nx_ro
-        height_px = ccd_dev.Ny_ro
-
+        px = np.arange(width_px)
+        hbin = ccd_dev.get_current_hbin()
+        t_exposed = ccd_dev.get_acquisition_timings()[0]
+        # the exposure may start late (keep clean cycle, shutter), moves
+        # during the readout start only once it has surely ended
+        t_exposure_end = t_exposed + ccd_dev.get_exposure_end_margin()
+        
+        # sweep plan, acquisition order
+        self.sweep_wls = self.settings.ranges['sweep_wls'].array
+        gratings = [int(g) for g in self.settings['sweep_gratings'].split(',') if g.strip()]
+        order = sweep_order(self.sweep_wls, gratings, spec.settings['grating_id'],
+                            spec.settings['center_wl'])
+        n_steps = len(order)
+        self.grating_ids = np.array([g for g, i in order])
+        self.center_wl_requested = np.array([self.sweep_wls[i] for g, i in order])
+        self.center_wl_actual = np.full(n_steps, np.nan)
+        self.wls = np.zeros((n_steps, width_px), dtype=float)
+        self.spectra = np.zeros((n_steps, width_px), dtype=float)
+        self.step_time = np.zeros(n_steps)
+        self.spectrum = np.zeros(width_px)
+        self.step_index = -1
+        self.display_step = None
+        
+        self.h5_file = None
+        mover = SpectrometerMover(spec)
+        worker = ThreadPoolExecutor(max_workers=1)
+        pending = deque()
+        interrupted = lambda: self.interrupt_measurement_called
+        t0 = time.time()
         try:
-            # create data file and array
-            self.h5_file = h5_io.h5_base_file(app=self.app, measurement=self)
-            self.h5m = h5_io.h5_create_measurement_group(measurement=self, 
-                                                         h5group=self.h5_file)
-            
-            self.sweep_wls = self.settings.ranges['sweep_wls'].array
-            self.h5m['sweep_wls'] = self.sweep_wls
-            
-            self.spectra = np.zeros((len(self.sweep_wls), width_px), dtype=float)
-            self.spectra_h5 = self.h5m.create_dataset('spectra', 
-                                                      shape=(len(self.sweep_wls), width_px),
-                                                      dtype=float)
+            if self.settings['save_h5']:
+                # create data file and arrays
+                self.h5_file = h5_io.h5_base_file(app=self.app, measurement=self)
+                self.h5m = h5_io.h5_create_measurement_group(measurement=self, 
+                                                             h5group=self.h5_file)
+                self.h5m['sweep_wls'] = self.sweep_wls
+                self.h5m['grating_id'] = self.grating_ids
+                self.h5m['center_wl_requested'] = self.center_wl_requested
+                for name in ('center_wl_actual', 'step_time'):
+                    self.h5m.create_dataset(name, shape=(n_steps,), dtype=float, fillvalue=np.nan)
+                for name in ('wls', 'spectra'):
+                    self.h5m.create_dataset(name, shape=(n_steps, width_px), dtype=float)
             
-            for ii, center_wl in enumerate(self.sweep_wls):
+            grating, i = order[0]
+            move = mover.move(self.sweep_wls[i], grating)
+            for ii in range(n_steps):
                 if self.interrupt_measurement_called:
                     break
-                # move spectrometer to center wavelength
-                self.spec.settings['center_wl'] = center_wl
+                center_wl = move.result()
+                # calibration of the grating and position reached
+                wls = self.step_wls(px, hbin, center_wl)
                 
+                t_start = time.time()
                 ccd_dev.start_acquisition()
-    
-                stat = ccd_hw.settings.ccd_status.read_from_hardware()
-                while stat == 'ACQUIRING':
-                    if self.interrupt_measurement_called:
-                        break
-                    time.sleep(0.01)
-                    stat = ccd_hw.settings.ccd_status.read_from_hardware()
-    
-                if stat == 'IDLE':
-                    self.ccd_img = ccd_dev.get_acquired_data()
-                    self.spectrum = np.average(self.ccd_img, axis=0)
-                    self.spectra[ii,:] = self.spectrum
-                    self.spectra_h5[ii,:] = self.spectrum
-
+                if S['move_during_readout']:
+                    # the spectrometer moves on while the frame is read out
+                    ccd_dev.wait_for_acquisition(timeout=max(0, t_start + t_exposure_end - time.time()),
+                                                 interrupt_func=interrupted)
+                    if ii + 1 < n_steps:
+                        grating, i = order[ii+1]
+                        move = mover.move(self.sweep_wls[i], grating)
+                if not ccd_dev.wait_for_acquisition(interrupt_func=interrupted):
+                    break
+                if ii + 1 < n_steps and not S['move_during_readout']:
+                    grating, i = order[ii+1]
+                    move = mover.move(self.sweep_wls[i], grating)
+                
+                # the data buffer is reused by the next acquisition
+                frame = np.array(ccd_hw.get_acquired_data())
+                pending.append(worker.submit(self.process_step, ii, frame, wls, center_wl, t_start))
+                while len(pending) > self.max_pending:
+                    pending.popleft().result()
+                self.set_progress(100.*(ii+1)/n_steps)
+            
+            while pending:
+                pending.popleft().result()
+            self.log.info("{} steps in {:.2f} s, exposures {:.2f} s".format(
+                self.step_index+1, time.time() - t0, (self.step_index+1)*t_exposed))
         finally:
+            mover.close()
+            worker.shutdown(wait=True)
+            ccd_hw.interrupt_acquisition()
             print(self.name, 'done')
-            self.h5_file.close()
+            if self.h5_file is not None:
+                self.h5_file.close()
+    
+    def step_wls(self, px, hbin, center_wl):
+        """wavelength axis at center_wl, pixel centers without a calibration"""
+        if hasattr(self.spec, 'get_wl_calibration'):
+            return self.spec.get_wl_calibration(px, hbin, center_wl=center_wl)
+        return hbin*px + 0.5*(hbin-1)
+    
+    def process_step(self, ii, frame, wls, center_wl, t):
+        """row average and HDF5 rows of step ii, runs in the worker thread"""
+        spectrum = np.mean(frame, axis=0)
+        self.spectra[ii] = spectrum
+        self.wls[ii] = wls
+        self.center_wl_actual[ii] = center_wl
+        self.step_time[ii] = t
+        if self.h5_file is not None:
+            H = self.h5m
+            H['spectra'][ii] = spectrum
+            H['wls'][ii] = wls
+            H['center_wl_actual'][ii] = center_wl
+            H['step_time'][ii] = t
+        self.spectrum = spectrum
+        self.step_index = ii
         
     def update_display(self):
+        ii = self.step_index
+        if ii < 0 or ii == self.display_step:
+            return
+        self.display_step = ii
         self.img_item.setImage(self.spectra.T)
-        self.current_spec_plotline.setData(self.spectrum)
+        self.current_spec_plotline.setData(self.wls[ii], self.spectrum)
         
 if __name__ == '__main__':
     import sys
@@ -6,6 +6,12 @@ import numpy as np
 from ScopeFoundry import h5_io
 import traceback
 
+from .scan_writer import ScanBlockWriter
+from .frame_pipeline import subtract_background
+from .adaptive_scan import (SparseScanWriter, new_adaptive_settings, new_adaptive_grid,
+                            pass_scan_arrays, save_adaptive)
+from ScopeFoundryHW.mcl_stage.scan_trajectory import ScanTrajectory, MICRODRIVE_SPEED
+
 
 class Example2DSlowScanMeasure(BaseRaster2DSlowScan):
 
@@ -15,39 +21,100 @@ class Example2DSlowScanMeasure(BaseRaster2DSlowScan):
         self.detector: HardwareComponent = self.app.hardware["andor_ccd"]
         self.stage: HardwareComponent = self.app.hardware["mcl_xy_stage"]
 
+        # line: one triggered kinetic series per scan line, the camera stays
+        # armed while the stage steps through the line
+        self.settings.New("acquisition", dtype=str, initial="pixel", choices=("pixel", "line"))
+        self.settings.New("line_trigger", dtype=str, initial="software", choices=("software", "external"),
+                          description="external: the stage controller (not this program) has to send one TTL pulse "
+                                      "to the camera's external trigger input after each move")
+        self.settings.New("frames_per_read", dtype=int, initial=16, vmin=1,
+                          description="line acquisition: images retrieved per GetImages call")
+        self.settings.New("h5_block_lines", dtype=int, initial=1, vmin=1,
+                          description="scan lines buffered in memory per HDF5 write (line layout)")
+        # signal_map storage, see scan_writer.scan_chunks
+        self.settings.New("h5_dtype", dtype=str, initial="float32", choices=("float64", "float32", "int32"))
+        self.settings.New("h5_layout", dtype=str, initial="balanced", choices=("line", "balanced"),
+                          description="line: chunks of whole scan lines, balanced: spatial tiles x band blocks")
+        self.settings.New("h5_compression", dtype=str, initial="none", choices=("none", "gzip"),
+                          description="gzip (lossless) is compressed in a worker thread")
+        # stage moves, see scan_trajectory.ScanTrajectory
+        self.settings["scan_type"] = "serpentine"
+        self.settings.New("backlash", dtype=float, initial=0.0, vmin=0, unit="um", spinbox_decimals=3,
+                          description="lost motion of the stage on reversal, corrected in the commanded positions")
+        self.settings.New("approach_travel", dtype=float, initial=28.5, vmin=0, unit="um",
+                          description="travel past a pixel before approaching it after a reversal (28.5 um = 300 steps)")
+        self.settings.New("est_stage_time", dtype=float, ro=True, unit="s",
+                          description="estimated time of the stage moves of the scan")
+        new_adaptive_settings(self.settings)
+
     def pre_scan_setup(self):
-        self.scan_shape = (1, self.Nv.val, self.Nh.val, 1600)  # _, Nv, Nh, signal length
+        S = self.settings
+        self.adaptive = S["scan_mode"] == "adaptive"
+        self.progress_span = (0.0, 100.0)
+        if self.adaptive:
+            _, Nv, Nh = self.scan_shape
+            self.adaptive_grid = new_adaptive_grid(S, Nv, Nh)
+        else:
+            self.plan_trajectory()
+        self.scan_writer = None
         if self.settings["save_h5"]:
-            self.signal_map = self.h5_meas_group.create_dataset(
-                name="signal_map", shape=self.scan_shape, dtype=float
+            if self.adaptive:
+                # the samples as they are taken, the interpolated map at the end
+                self.scan_writer = SparseScanWriter(self.h5_meas_group)
+            else:
+                # one hyperslab write per block of chunk rows instead of per pixel
+                self.scan_writer = ScanBlockWriter(
+                    self.h5_meas_group, self.scan_shape, S["h5_block_lines"], layout=S["h5_layout"],
+                    compression=None if S["h5_compression"] == "none" else S["h5_compression"],
+                )
+            self.signal_map = self.scan_writer.create_dataset(
+                "signal_map", pixel_shape=(self.detector.ccd_dev.Nx_ro,), dtype=S["h5_dtype"]
             )
+            self.pixel_time_h5 = self.scan_writer.create_dataset("pixel_time", layout="line")
+        if self.settings["acquisition"] == "line":
+            self.setup_line_acquisition()
 
     def setup_figure(self):
         super().setup_figure()
         self.ui.details_layout.addWidget(
-            self.settings.New_UI(include=("h_axis", "v_axis"))
+            self.settings.New_UI(include=("h_axis", "v_axis", "acquisition",
+                                          "line_trigger", "frames_per_read", "h5_block_lines",
+                                          "h5_dtype", "h5_layout", "h5_compression",
+                                          "backlash", "approach_travel", "est_stage_time",
+                                          "scan_mode", "adaptive_coarse_step",
+                                          "adaptive_signal_threshold", "adaptive_gradient_threshold"))
         )
 
     def move_position_start(self, h, v):  ##H and V axes are now always X and Y axes
         self.stage.settings.x_target.update_value(h)
         self.stage.settings.y_target.update_value(v)
 
+    def plan_trajectory(self):
+        S = self.settings
+        microdrive = getattr(self.stage, "microdrive", None)
+        speed = 1e3 * microdrive.velocity if microdrive is not None else MICRODRIVE_SPEED
+        self.trajectory = ScanTrajectory(
+            self.scan_h_positions, self.scan_v_positions, self.scan_slow_move,
+            backlash=S["backlash"], approach_travel=S["approach_travel"], speed=speed,
+        )
+        S["est_stage_time"] = self.trajectory.total_time
+        self.log.info("stage moves: {} take-up moves, estimated {:.1f} s".format(
+            self.trajectory.n_compensations, self.trajectory.total_time))
+
     def move_position_slow(self, h, v, dh, dv):
-        self.stage.settings.x_target.update_value(h)
-        self.stage.settings.y_target.update_value(v)
+        self.move_position_fast(h, v, dh, dv)
 
     def move_position_fast(self, h, v, dh, dv):
-        self.stage.settings.x_target.update_value(h)
-        self.stage.settings.y_target.update_value(v)
-
-    def backlash_correction_h(self):
-        self.stage.backlash_correction('X')
-
-    def backlash_correction_v(self):
-        self.stage.backlash_correction('Y')
+        # commanded positions of the planned trajectory, an axis is only
+        # moved when its target changes
+        for h_cmd, v_cmd in self.trajectory.moves(self.pixel_i):
+            self.stage.settings.x_target.update_value(h_cmd)
+            self.stage.settings.y_target.update_value(v_cmd)
 
 
     def collect_pixel(self, pixel_num, k, j, i):
+        if self.settings["acquisition"] == "line":
+            return self.collect_line_pixel(pixel_num, k, j, i)
         ccd_hw = self.detector
         ccd_dev = ccd_hw.ccd_dev
 
@@ -57,31 +124,24 @@ class Example2DSlowScanMeasure(BaseRaster2DSlowScan):
             self.log.info("starting acq")
             ccd_dev.start_acquisition()
 
-            while not self.interrupt_measurement_called:
-
-                stat = ccd_hw.settings.ccd_status.read_from_hardware()
-                
-                if stat == 'IDLE':
-                    # grab data
-                    buffer_ = ccd_hw.get_acquired_data()
-
-
-                    bg = ccd_hw.background
-                    if bg is not None:
-                        if bg.shape == buffer_.shape:
-                            buffer_ = buffer_ - bg
-                        else:
-                            self.log.warning("Background not the correct shape {} != {}".format( self.buffer_.shape, bg.shape))
-                    else:
-                        self.log.warning( "No Background available, raw data shown")
-
-                    signal = np.average(buffer_, axis=0)
+            if not ccd_dev.wait_for_acquisition(interrupt_func=lambda: self.interrupt_measurement_called):
+                return
+            
+            # grab data
+            buffer_ = ccd_hw.get_acquired_data()
 
-                    break # end the while loop for non-continuous scans
+            bg = ccd_hw.background
+            if bg is not None:
+                if bg.shape == buffer_.shape:
+                    buffer_ = subtract_background(buffer_, bg)
                 else:
-                    time.sleep(0.01)
+                    self.log.warning("Background not the correct shape {} != {}".format( buffer_.shape, bg.shape))
+            else:
+                self.log.warning( "No Background available, raw data shown")
+
+            signal = np.average(buffer_, axis=0)
         finally:            
-            # while-loop is complete
+            # acquisition is complete
             ccd_hw.interrupt_acquisition()
 
         self.display_image_map[k, j, i] = np.sum(signal, axis=0)
@@ -89,8 +149,226 @@ class Example2DSlowScanMeasure(BaseRaster2DSlowScan):
             self.signal_map[k, j, i] = signal
 
 
+    def setup_line_acquisition(self):
+        ccd_hw = self.detector
+        ccd_dev = ccd_hw.ccd_dev
+        trigger = self.settings["line_trigger"]
+        if not ccd_dev.is_trigger_mode_available(trigger):
+            raise ValueError("camera does not support the {} trigger mode".format(trigger))
+        self.line_active = False
+        # restored in post_scan_cleanup
+        self.ccd_config0 = ccd_hw.get_config()
+        ccd_hw.apply_config(dict(acq_mode="kinetic", trigger_mode=trigger, kinetic_stream=True))
+        # one frame per pixel, the buffer is (1, Ny, Nx) with kinetic_stream
+        bg = ccd_hw.background
+        if bg is None:
+            self.log.warning("No Background available, raw data shown")
+        elif bg.shape != (ccd_dev.Ny_ro, ccd_dev.Nx_ro):
+            self.log.warning("Background not the correct shape {} != {}, raw data shown".format(
+                (ccd_dev.Ny_ro, ccd_dev.Nx_ro), bg.shape))
+
+        self.set_line_lengths()
+        self.line_frames = np.zeros((self.settings["frames_per_read"], ccd_dev.Ny_ro, ccd_dev.Nx_ro),
+                                    dtype=ccd_dev.buffer_dtype)
+        self.t_exposed, _, self.t_cycle = ccd_dev.get_acquisition_timings()
+        # the exposure may start late after a trigger (keep clean cycle, shutter)
+        self.t_exposure_end = self.t_exposed + ccd_dev.get_exposure_end_margin()
+        # time for the image of a trigger, the stage move of the pixel included
+        self.trigger_timeout = 4 * self.t_cycle + 1.0
+        if trigger == "external":
+            self.log.info("external line trigger: the stage controller has to trigger the camera after every move")
+
+    def wait_line_images(self, n_images):
+        """waits for the image of the n_images-th trigger of the line.
+        Returns False when interrupted, raises if the image does not come"""
+        ccd_dev = self.detector.ccd_dev
+        if ccd_dev.wait_for_images(n_images, timeout=self.trigger_timeout,
+                                   interrupt_func=lambda: self.interrupt_measurement_called):
+            return True
+        if self.interrupt_measurement_called:
+            return False
+        msg = "image {} of the line not acquired within {:.2f} s".format(n_images, self.trigger_timeout)
+        if self.settings["line_trigger"] == "external":
+            msg += ", is the trigger output of the stage controller connected to the camera?"
+        raise TimeoutError(msg)
+
+    def set_line_lengths(self):
+        line_starts = np.flatnonzero(self.scan_slow_move)
+        self.line_lengths = dict(zip(line_starts, np.diff(np.append(line_starts, self.Npixels))))
+
+    def start_line(self, pixel_num):
+        """arms a kinetic series with one image per pixel of the line starting at pixel_num"""
+        self.detector.apply_config(dict(num_kin=int(self.line_lengths[pixel_num])))
+        self.detector.ccd_dev.start_acquisition()
+        self.line_pixels = []  # (k, j, i) of each triggered image
+        self.line_triggered = 0
+        self.line_read = 0
+        self.line_active = True
+
+    def finish_line(self):
+        """reads the remaining images of the line and stops its series"""
+        if not self.line_active:
+            return
+        self.line_active = False
+        try:
+            if not self.detector.ccd_dev.wait_for_images(
+                    self.line_triggered, timeout=self.trigger_timeout,
+                    interrupt_func=lambda: self.interrupt_measurement_called):
+                self.log.warning("line incomplete: {} of {} images acquired".format(
+                    self.detector.ccd_dev.get_total_number_images_acquired(), self.line_triggered))
+            while self.line_read < self.line_triggered and self.read_line_frames():
+                pass
+        finally:
+            self.detector.interrupt_acquisition()
+
+    def collect_line_pixel(self, pixel_num, k, j, i):
+        ccd_dev = self.detector.ccd_dev
+
+        if self.scan_slow_move[pixel_num]:
+            self.start_line(pixel_num)
+
+        # the camera takes the next trigger once the previous image is read out
+        if not self.wait_line_images(self.line_triggered):
+            return
+        if self.line_triggered - self.line_read >= len(self.line_frames):
+            self.read_line_frames()
+
+        self.line_pixels.append((k, j, i))
+        self.line_triggered += 1
+        if self.settings["line_trigger"] == "software":
+            ccd_dev.send_software_trigger()
+            # the stage moves on during the readout
+            time.sleep(self.t_exposure_end)
+        else:
+            # the stage controller triggers after the move, nothing to overlap
+            self.wait_line_images(self.line_triggered)
+
+    def read_line_frames(self):
+        """retrieves the new images of the line with one GetImages call and
+        stores their signals. Returns the number of images read"""
+        ccd_hw = self.detector
+        new_images = ccd_hw.ccd_dev.get_number_new_images()
+        if new_images is None:
+            return 0
+        first, last = new_images
+        last = min(last, first + len(self.line_frames) - 1)
+        frames = self.line_frames[: last - first + 1]
+        ccd_hw.ccd_dev.get_images(first, last, frames)
+        if ccd_hw.settings["output_amp"] == 1:
+            frames = frames[..., ::-1]
+
+        # average of (frame - bg) over the rows of all frames at once
+        signals = np.mean(frames, axis=1)
+        bg = ccd_hw.background
+        if bg is not None and bg.shape == frames.shape[1:]:
+            signals -= np.mean(bg, axis=0)
+
+        for signal, (k, j, i) in zip(signals, self.line_pixels[first - 1 : last]):
+            self.display_image_map[k, j, i] = np.sum(signal, axis=0)
+            if self.settings["save_h5"]:
+                self.signal_map[k, j, i] = signal
+        self.line_read = last
+        return len(frames)
+
+    def post_scan_cleanup(self):
+        try:
+            if hasattr(self, "ccd_config0"):
+                try:
+                    self.finish_line()
+                finally:
+                    self.detector.apply_config(self.ccd_config0)
+                    del self.ccd_config0
+        finally:
+            if getattr(self, "scan_writer", None) is not None:
+                self.scan_writer.close()
+                self.scan_writer = None
+
+    def scan_pixels(self):
+        """scans the pixels of the scan arrays, returns the number collected"""
+        for self.pixel_i in range(self.Npixels):
+            if self.interrupt_measurement_called:
+                return self.pixel_i
+
+            i = self.pixel_i
+
+            self.current_scan_index = self.scan_index_array[i]
+            kk, jj, ii = self.current_scan_index
+
+            h, v = self.scan_h_positions[i], self.scan_v_positions[i]
+
+            if self.pixel_i == 0:
+                dh = 0
+                dv = 0
+            else:
+                dh = self.scan_h_positions[i] - self.scan_h_positions[i - 1]
+                dv = self.scan_v_positions[i] - self.scan_v_positions[i - 1]
+
+            if self.scan_slow_move[i]:
+                if self.interrupt_measurement_called:
+                    return self.pixel_i
+                self.move_position_slow(h, v, dh, dv)
+
+                if self.settings["acquisition"] == "line":
+                    # the last image of the previous line was read out during the move
+                    self.finish_line()
+                # self.app.qtapp.ProcessEvents()
+                time.sleep(0.01)
+            else:
+                self.move_position_fast(h, v, dh, dv)
+
+            self.pos = (h, v)
+            # each pixel:
+            # acquire signal and save to data array
+            pixel_t0 = time.time()
+            self.pixel_time[kk, jj, ii] = pixel_t0
+            if self.settings["save_h5"]:
+                self.pixel_time_h5[kk, jj, ii] = pixel_t0
+            self.collect_pixel(self.pixel_i, kk, jj, ii)
+            p0, p1 = self.progress_span
+            self.set_progress(p0 + (p1 - p0) * self.pixel_i / self.Npixels)
+        return self.Npixels
+
+    def scan_adaptive(self):
+        """scans the passes of the adaptive grid, each like a scan of its
+        pixels, and shows the interpolated map after every pass"""
+        grid = self.adaptive_grid
+        k = 0
+        # the raster arrays, set_scan_pixels replaces them for each pass
+        raster = (self.scan_h_positions, self.scan_v_positions, self.scan_slow_move,
+                  self.scan_index_array, self.Npixels)
+        samples = []  # (h, v, index) of the pixels taken in each pass
+        try:
+            pixels = grid.next_pass()
+            while len(pixels) and not self.interrupt_measurement_called:
+                self.set_scan_pixels(k, pixels)
+                level = grid.level
+                self.progress_span = (100.0 * level / len(grid.steps), 100.0 * (level + 1) / len(grid.steps))
+                n = self.scan_pixels()
+                if self.settings["acquisition"] == "line":
+                    self.finish_line()
+                done = pixels[:n]
+                samples.append((self.scan_h_positions[:n], self.scan_v_positions[:n], self.scan_index_array[:n]))
+                grid.add(done, self.display_image_map[k, done[:, 0], done[:, 1]])
+                self.display_image_map[k] = grid.interpolated()
+                pixels = grid.next_pass()
+        finally:
+            (self.scan_h_positions, self.scan_v_positions, self.scan_slow_move,
+             self.scan_index_array, self.Npixels) = raster
+        if self.settings["save_h5"]:
+            h, v, index = (np.concatenate(a) for a in zip(*samples)) if samples else ([], [], [])
+            save_adaptive(self.h5_meas_group, [grid], dict(h=h, v=v), index)
+
+    def set_scan_pixels(self, k, pixels):
+        """replaces the scan arrays by the (j, i) pixels of plane k, scan_adaptive restores them"""
+        (self.scan_h_positions, self.scan_v_positions, self.scan_slow_move,
+         self.scan_index_array) = pass_scan_arrays(k, pixels, self.h_array, self.v_array)
+        self.Npixels = len(pixels)
+        self.plan_trajectory()
+        if self.settings["acquisition"] == "line":
+            self.set_line_lengths()
+
     def run(self):
-            '''Overwrite scan to implement backlash correction'''
+            '''Overwrite scan to move along the planned trajectory (backlash correction)'''
             S = self.settings
 
             # Hardware
@@ -141,10 +419,6 @@ class Example2DSlowScanMeasure(BaseRaster2DSlowScan):
                     self.current_scan_index = self.scan_index_array[0]
 
                     self.pixel_time = np.zeros(self.scan_shape, dtype=float)
-                    if self.settings["save_h5"]:
-                        self.pixel_time_h5 = H.create_dataset(
-                            name="pixel_time", shape=self.scan_shape, dtype=float
-                        )
 
                     self.pre_scan_setup()
 
@@ -152,52 +426,10 @@ class Example2DSlowScanMeasure(BaseRaster2DSlowScan):
                         self.scan_h_positions[0], self.scan_v_positions[0]
                     )
 
-                    self.backlash_correction_v() #backlash on slow axis is done only once
-
-                    for self.pixel_i in range(self.Npixels):
-                        if self.interrupt_measurement_called:
-                            break
-
-                        i = self.pixel_i
-
-                        self.current_scan_index = self.scan_index_array[i]
-                        kk, jj, ii = self.current_scan_index
-
-                        h, v = self.scan_h_positions[i], self.scan_v_positions[i]
-
-                        if self.pixel_i == 0:
-                            dh = 0
-                            dv = 0
-                        else:
-                            dh = self.scan_h_positions[i] - self.scan_h_positions[i - 1]
-                            dv = self.scan_v_positions[i] - self.scan_v_positions[i - 1]
-
-                        if self.scan_slow_move[i]:
-                            if self.interrupt_measurement_called:
-                                break
-                            self.move_position_slow(h, v, dh, dv)
-
-                            if ii==0:   # backlash correction on fast axis
-                                print("backlash correction on fast axis")
-                                time.sleep(0.1)  # wait for slow move to finish
-                                self.backlash_correction_h()
-
-                            if self.settings["save_h5"]:
-                                self.h5_file.flush()  # flush data to file every slow move
-                            # self.app.qtapp.ProcessEvents()
-                            time.sleep(0.01)
-                        else:
-                            self.move_position_fast(h, v, dh, dv)
-
-                        self.pos = (h, v)
-                        # each pixel:
-                        # acquire signal and save to data array
-                        pixel_t0 = time.time()
-                        self.pixel_time[kk, jj, ii] = pixel_t0
-                        if self.settings["save_h5"]:
-                            self.pixel_time_h5[kk, jj, ii] = pixel_t0
-                        self.collect_pixel(self.pixel_i, kk, jj, ii)
-                        self.set_progress(100.0 * self.pixel_i / (self.Npixels))
+                    if self.adaptive:
+                        self.scan_adaptive()
+                    else:
+                        self.scan_pixels()
                 except Exception as err:
                     self.last_err = err
                     self.log.error("Failed to Scan {}".format(repr(err)))
@@ -1,6 +1,14 @@
+import time
+import traceback
+
+import numpy as np
 from ScopeFoundry import HardwareComponent
 from ScopeFoundry.scanning import BaseRaster3DSlowScanV2
 
+from .scan_writer import ScanBlockWriter
+from .adaptive_scan import (SparseScanWriter, new_adaptive_settings, new_adaptive_grid,
+                            pass_scan_arrays, save_adaptive)
+
 
 class Example3DSlowScanMeasure(BaseRaster3DSlowScanV2):
 
@@ -8,15 +16,153 @@ class Example3DSlowScanMeasure(BaseRaster3DSlowScanV2):
 
     def scan_specific_setup(self):
         self.detector: HardwareComponent = self.app.hardware["noiser_200"]
+        self.settings.New("h5_block_lines", dtype=int, initial=1, vmin=1,
+                          description="scan lines buffered in memory per HDF5 write")
+        # adaptive: every z plane is refined on its own, see adaptive_scan.AdaptiveGrid
+        new_adaptive_settings(self.settings)
 
     def pre_scan_setup(self):
+        self.adaptive = self.settings["scan_mode"] == "adaptive"
+        self.scan_writer = None
         if self.settings["save_h5"]:
-            self.signal_map = self.h5_meas_group.create_dataset(
-                name="signal_map", shape=self.scan_shape, dtype=float
-            )
+            if self.adaptive:
+                # the samples as they are taken, the interpolated maps at the end
+                self.scan_writer = SparseScanWriter(self.h5_meas_group)
+            else:
+                # one hyperslab write per scan line (block) instead of per pixel
+                self.scan_writer = ScanBlockWriter(
+                    self.h5_meas_group, self.scan_shape, self.settings["h5_block_lines"]
+                )
+            self.signal_map = self.scan_writer.create_dataset("signal_map")
+            # replaces the per pixel pixel_time dataset of the base class run()
+            if "pixel_time" in self.h5_meas_group:
+                del self.h5_meas_group["pixel_time"]
+            self.pixel_time_h5 = self.scan_writer.create_dataset("pixel_time")
 
     def collect_pixel(self, pixel_num, k, j, i):
         signal = self.detector.settings.get_lq("signal").read_from_hardware()
         self.display_image_map[k, j, i] = signal
         if self.settings["save_h5"]:
             self.signal_map[k, j, i] = signal
+
+    def post_scan_cleanup(self):
+        if getattr(self, "scan_writer", None) is not None:
+            self.scan_writer.close()
+            self.scan_writer = None
+
+    def scan_pixels(self):
+        """scans the pixels of the scan arrays, returns the number collected"""
+        for n in range(self.Npixels):
+            if self.interrupt_measurement_called:
+                return n
+            self.current_scan_index = self.scan_index_array[n]
+            kk, jj, ii = self.current_scan_index
+            h, v, z = self.scan_h_positions[n], self.scan_v_positions[n], self.scan_z_positions[n]
+            dh, dv = (0, 0) if n == 0 else (h - self.scan_h_positions[n - 1], v - self.scan_v_positions[n - 1])
+            if self.scan_start_move[n]:
+                self.move_position_start(h, v, z)
+                time.sleep(0.01)
+            elif self.scan_slow_move[n]:
+                self.move_position_slow(h, v, dh, dv)
+                time.sleep(0.01)
+            else:
+                self.move_position_fast(h, v, dh, dv)
+            self.pos = (h, v)
+            pixel_t0 = time.time()
+            self.pixel_time[kk, jj, ii] = pixel_t0
+            if self.settings["save_h5"]:
+                self.pixel_time_h5[kk, jj, ii] = pixel_t0
+            self.collect_pixel(self.pixel_i, kk, jj, ii)
+            self.pixel_i += 1
+            p0, p1 = self.progress_span
+            self.set_progress(p0 + (p1 - p0) * n / self.Npixels)
+        return self.Npixels
+
+    def scan_adaptive(self):
+        """scans the z planes one after the other, each in the passes of its
+        own adaptive grid, and shows the interpolated map after every pass"""
+        Nz, Nv, Nh = self.scan_shape
+        # the raster arrays, replaced for each pass
+        raster = (self.scan_h_positions, self.scan_v_positions, self.scan_z_positions, self.scan_slow_move,
+                  self.scan_start_move, self.scan_index_array, self.Npixels)
+        grids = []
+        samples = []  # (h, v, z, index) of the pixels taken in each pass
+        self.pixel_i = 0
+        try:
+            for k in range(Nz):
+                if self.interrupt_measurement_called:
+                    break
+                grid = new_adaptive_grid(self.settings, Nv, Nh)
+                grids.append(grid)
+                pixels = grid.next_pass()
+                while len(pixels) and not self.interrupt_measurement_called:
+                    (self.scan_h_positions, self.scan_v_positions, self.scan_slow_move,
+                     self.scan_index_array) = pass_scan_arrays(k, pixels, self.h_array, self.v_array)
+                    self.Npixels = len(pixels)
+                    self.scan_z_positions = np.full(self.Npixels, self.z_array[k])
+                    # z only moves at the start of a plane
+                    self.scan_start_move = np.zeros(self.Npixels, dtype=bool)
+                    self.scan_start_move[0] = grid.level == 0
+                    steps = len(grid.steps)
+                    self.progress_span = (100.0 * (k + grid.level / steps) / Nz,
+                                          100.0 * (k + (grid.level + 1) / steps) / Nz)
+                    n = self.scan_pixels()
+                    done = pixels[:n]
+                    samples.append((self.scan_h_positions[:n], self.scan_v_positions[:n],
+                                    self.scan_z_positions[:n], self.scan_index_array[:n]))
+                    grid.add(done, self.display_image_map[k, done[:, 0], done[:, 1]])
+                    self.display_image_map[k] = grid.interpolated()
+                    pixels = grid.next_pass()
+        finally:
+            (self.scan_h_positions, self.scan_v_positions, self.scan_z_positions, self.scan_slow_move,
+             self.scan_start_move, self.scan_index_array, self.Npixels) = raster
+        if self.settings["save_h5"] and grids:
+            h, v, z, index = (np.concatenate(a) for a in zip(*samples)) if samples else ([], [], [], [])
+            save_adaptive(self.h5_meas_group, grids, dict(h=h, v=v, z=z), index)
+
+    def run(self):
+        """the base class run() for uniform scans, an adaptive scan is
+        planned pass by pass from the data"""
+        if self.settings["scan_mode"] != "adaptive":
+            return super().run()
+
+        self.compute_scan_arrays()
+        self.initial_scan_setup_plotting = True
+        self.display_image_map = np.zeros(self.scan_shape, dtype=float)
+
+        while not self.interrupt_measurement_called:
+            try:
+                self.t0 = time.time()
+                if self.settings["save_h5"]:
+                    H = self.open_new_h5_file()
+                    self.h5_filename = self.h5_file.filename
+                    H["h_array"] = self.h_array
+                    H["v_array"] = self.v_array
+                    H["z_array"] = self.z_array
+                    H["range_extent"] = self.range_extent
+                    H["corners"] = self.corners
+                    H["imshow_extent"] = self.imshow_extent
+                    H["scan_h_positions"] = self.scan_h_positions
+                    H["scan_v_positions"] = self.scan_v_positions
+                    H["scan_z_positions"] = self.scan_z_positions
+                    H["scan_slow_move"] = self.scan_slow_move
+                    H["scan_index_array"] = self.scan_index_array
+
+                self.current_scan_index = self.scan_index_array[0]
+                self.pixel_time = np.zeros(self.scan_shape, dtype=float)
+                self.pre_scan_setup()
+                self.scan_adaptive()
+            except Exception as err:
+                self.last_err = err
+                self.log.error("Failed to Scan {}".format(repr(err)))
+                traceback.print_exc()
+            finally:
+                self.post_scan_cleanup()
+                if hasattr(self, "h5_file"):
+                    try:
+                        self.h5_file.close()
+                    except ValueError as err:
+                        self.log.warning("failed to close h5_file: {}".format(err))
+                if not self.settings["continuous_scan"]:
+                    break
+        print(self.name, "done")
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def subtract_background(frame, background):
+    """frame - background, without wrapping around: unsigned integer data is
+    promoted to a signed type, float data (e.g. accumulate averages) stays float"""
+    dtype = np.result_type(frame.dtype, background.dtype)
+    if dtype.kind == 'u':
+        dtype = np.result_type(dtype, np.int32)
+    return np.subtract(frame, background, dtype=dtype)
+
+
+class FramePipeline(object):
+    """
+    Processes raw CCD frames into buffers that are allocated once per
+    readout configuration:
+
+        flip -> divide -> subtract background -> average over axis 0
+
+    frame    float32, the processed frame (also the display image)
+    spectrum float64, frame averaged over axis 0 (the rows of a 2D frame)
+
+    All steps write into these buffers with out=, so the per frame memory
+    footprint is constant. Flipping is a strided view of the raw data.
+    The GUI does not keep frame: LiveImageDisplay.render() copies it into
+    its own (decimated) buffer.
+    """
+
+    def __init__(self, shape=None, flip=False, divisor=1, background=None):
+        self.shape = None
+        self.configure(shape, flip, divisor, background)
+
+    def configure(self, shape, flip=False, divisor=1, background=None):
+        """sets the processing steps, reallocates only if shape changed"""
+        self.flip = flip
+        self.divisor = divisor
+        if shape is not None and tuple(shape) != self.shape:
+            self.shape = tuple(shape)
+            self.frame = np.zeros(self.shape, dtype=np.float32)
+            self.spectrum = np.zeros(self.shape[1:], dtype=np.float64)
+        # checked against the new shape
+        self.set_background(background)
+
+    def set_background(self, background):
+        """background (None to disable) in the processed (flipped, divided) frame
+        orientation, one frame is subtracted from every frame of a kinetic series"""
+        if (background is not None and self.shape is not None
+                and background.shape != self.shape[-background.ndim:]):
+            raise ValueError("background shape {} != {}".format(background.shape, self.shape))
+        self.background = background
+
+    def process(self, raw):
+        """returns (frame, spectrum), both are overwritten by the next call"""
+        if raw.shape != self.shape:
+            self.configure(raw.shape, self.flip, self.divisor, self.background)
+        frame = self.frame
+        src = raw[..., ::-1] if self.flip else raw
+        if self.divisor != 1:
+            np.multiply(src, 1.0/self.divisor, out=frame)
+        else:
+            np.copyto(frame, src)
+        if self.background is not None:
+            np.subtract(frame, self.background, out=frame)
+        np.mean(frame, axis=0, dtype=np.float64, out=self.spectrum)
+        return frame, self.spectrum
+
+
+def benchmark(shape=(1024, 1024), n_frames=200, num_acc=4):
+    """frames/s of the per frame processing of AndorCCDReadoutMeasure
+    before (temporaries for every step) and with FramePipeline"""
+    import time
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 2**16, size=shape).astype(np.int32)
+    bg = rng.integers(0, 100, size=shape).astype(np.float32)
+
+    t0 = time.perf_counter()
+    for i in range(n_frames):
+        buffer_ = raw[..., ::-1]
+        buffer_ = buffer_ / num_acc
+        buffer_ = np.subtract(buffer_, bg, dtype=np.float32)
+        spectrum = np.average(buffer_, axis=0)
+        img = buffer_.astype(np.float32).T
+    before = n_frames/(time.perf_counter() - t0)
+
+    pipeline = FramePipeline(shape, flip=True, divisor=num_acc, background=bg)
+    t0 = time.perf_counter()
+    for i in range(n_frames):
+        frame, spectrum = pipeline.process(raw)
+        img = frame.T
+    after = n_frames/(time.perf_counter() - t0)
+    return before, after
+
+
+if __name__ == '__main__':
+    before, after = benchmark()
+    print("1024x1024 frames/s  before: {:.1f}  pipeline: {:.1f}".format(before, after))
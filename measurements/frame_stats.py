@@ -0,0 +1,99 @@
+import numpy as np
+from threading import Lock
+
+
+class FrameStats(object):
+    """
+    Streaming per-pixel statistics of a series of frames.
+
+    Keeps running mean, variance (Welford), min and max in preallocated
+    float64 arrays, so arbitrarily long series (software accumulations,
+    noise maps) are reduced at constant memory without keeping the frames.
+
+    Usage:
+        stats = FrameStats((Ny, Nx))
+        stats.update(frame)     # a single frame (Ny, Nx)
+        stats.update(frames)    # or a stack (N, Ny, Nx), e.g. ring buffer slots
+        snap = stats.snapshot() # dict of copies, safe to keep
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.lock = Lock()
+        self.mean = np.zeros(self.shape, dtype=np.float64)
+        self.m2 = np.zeros(self.shape, dtype=np.float64) # sum of squared deviations
+        self.min = np.zeros(self.shape, dtype=np.float64)
+        self.max = np.zeros(self.shape, dtype=np.float64)
+        # scratch for the update, no allocations per frame
+        self._delta = np.zeros(self.shape, dtype=np.float64)
+        self._delta2 = np.zeros(self.shape, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.n = 0
+            self.mean.fill(0)
+            self.m2.fill(0)
+            self.min.fill(np.inf)
+            self.max.fill(-np.inf)
+
+    def update(self, frames):
+        """add a frame (shape) or a stack of frames (N, *shape)"""
+        frames = np.asarray(frames)
+        if frames.shape == self.shape:
+            frames = frames[np.newaxis]
+        if frames.shape[1:] != self.shape:
+            raise ValueError("frame shape {} does not match {}".format(frames.shape[1:], self.shape))
+
+        delta, delta2 = self._delta, self._delta2
+        with self.lock:
+            for frame in frames:
+                self.n += 1
+                # Welford: mean += (x-mean)/n, m2 += (x-mean_old)*(x-mean_new)
+                np.subtract(frame, self.mean, out=delta)
+                np.multiply(delta, 1.0/self.n, out=delta2)
+                self.mean += delta2
+                np.subtract(frame, self.mean, out=delta2)
+                delta *= delta2
+                self.m2 += delta
+                np.minimum(self.min, frame, out=self.min)
+                np.maximum(self.max, frame, out=self.max)
+
+    def snapshot(self, ddof=1):
+        """copies of the current statistics:
+        n, mean, var, std, min, max (var with ddof, nan for too few frames)"""
+        with self.lock:
+            n = self.n
+            mean = self.mean.copy()
+            if n > ddof:
+                var = self.m2 / (n - ddof)
+            else:
+                var = np.full(self.shape, np.nan)
+            snap = dict(n=n, mean=mean, var=var, std=np.sqrt(var),
+                        min=self.min.copy(), max=self.max.copy())
+        return snap
+
+    def save_h5(self, h5_group, name='frame_stats'):
+        """writes a snapshot into a new sub group of h5_group"""
+        snap = self.snapshot()
+        G = h5_group.create_group(name)
+        G.attrs['n'] = snap['n']
+        for key in ('mean', 'var', 'min', 'max'):
+            G[key] = snap[key]
+        return G
+
+
+if __name__ == '__main__':
+    import time
+    rng = np.random.default_rng(0)
+    frames = rng.poisson(100, size=(200, 512, 512)).astype(np.int32)
+    stats = FrameStats(frames.shape[1:])
+    t0 = time.perf_counter()
+    for i in range(0, len(frames), 16):
+        stats.update(frames[i:i+16])
+    dt = time.perf_counter() - t0
+    snap = stats.snapshot()
+    print("{:.2f} ms/frame".format(1e3*dt/len(frames)))
+    print("max |mean error| ", np.abs(snap['mean'] - frames.mean(axis=0)).max())
+    print("max |var error| ", np.abs(snap['var'] - frames.var(axis=0, ddof=1)).max())
+    print("min/max ok", np.all(snap['min'] == frames.min(axis=0)), np.all(snap['max'] == frames.max(axis=0)))
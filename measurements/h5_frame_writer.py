@@ -0,0 +1,132 @@
+import threading
+import time
+import queue
+import numpy as np
+from ScopeFoundry import h5_io
+
+
+class H5FrameWriter(threading.Thread):
+    """
+    Appends frames to extendable HDF5 datasets from a background thread.
+
+    put() copies a frame into one of queue_size preallocated slots and
+    returns immediately. The writer thread appends the queued frames in
+    batches to
+
+        frames       (N, *frame_shape)
+        frame_index  (N,)  SDK image index or frame counter
+        frame_time   (N,)  time.time() when the frame was retrieved
+        count_rate   (N,)
+
+    and flushes the file at most every flush_interval seconds.
+    When all slots are in use put() either waits for the writer
+    (backpressure=True) or drops the frame and counts it in n_dropped.
+    """
+
+    def __init__(self, h5_group, frame_shape, dtype=np.float32, queue_size=64,
+                 compression=None, flush_interval=1.0, backpressure=False):
+        threading.Thread.__init__(self, name='H5FrameWriter')
+        self.daemon = True
+        self.h5_group = h5_group
+        self.frame_shape = tuple(frame_shape)
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+
+        # preallocated slots, indices of free slots and of queued ones
+        self.slots = np.zeros((queue_size,) + self.frame_shape, dtype=dtype)
+        self.slot_index = np.zeros(queue_size, dtype=np.int64)
+        self.slot_time = np.zeros(queue_size, dtype=float)
+        self.slot_count_rate = np.zeros(queue_size, dtype=float)
+        self.free_slots = queue.Queue()
+        for i in range(queue_size):
+            self.free_slots.put(i)
+        self.queued = queue.Queue()
+
+        # hdf5 chunks of about 1MB, whole frames
+        frame_bytes = self.slots[0].nbytes
+        chunk_frames = int(max(1, min(queue_size, 2**20 // frame_bytes)))
+        kw = dict(compression=compression) if compression else {}
+        H = h5_group
+        self.frames_h5 = h5_io.create_extendable_h5_dataset(
+            H, 'frames', shape=(0,) + self.frame_shape, dtype=dtype,
+            chunks=(chunk_frames,) + self.frame_shape, **kw)
+        self.frame_index_h5 = h5_io.create_extendable_h5_dataset(
+            H, 'frame_index', shape=(0,), dtype=np.int64, chunks=(1024,))
+        self.frame_time_h5 = h5_io.create_extendable_h5_dataset(
+            H, 'frame_time', shape=(0,), dtype=float, chunks=(1024,))
+        self.count_rate_h5 = h5_io.create_extendable_h5_dataset(
+            H, 'count_rate', shape=(0,), dtype=float, chunks=(1024,))
+        self.batch = np.zeros((chunk_frames,) + self.frame_shape, dtype=dtype)
+
+        self.n_written = 0
+        self.n_dropped = 0
+        self.write_time = 0 # total seconds spent writing, for diagnostics
+        self.error = None
+
+    def put(self, frame, index, t, count_rate=np.nan):
+        """queues a copy of frame, returns False if it was dropped"""
+        while True:
+            try:
+                slot = self.free_slots.get(block=self.backpressure, timeout=0.1)
+                break
+            except queue.Empty:
+                # no waiting for a writer that has stopped
+                if not self.backpressure or not self.is_alive():
+                    self.n_dropped += 1
+                    return False
+        self.slots[slot] = frame
+        self.slot_index[slot] = index
+        self.slot_time[slot] = t
+        self.slot_count_rate[slot] = count_rate
+        self.queued.put(slot)
+        return True
+
+    def close(self):
+        """writes the remaining frames and stops the thread (the file is left open)"""
+        self.queued.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        last_flush = time.time()
+        done = False
+        try:
+            while not done:
+                try:
+                    slots = [self.queued.get(timeout=self.flush_interval)]
+                except queue.Empty:
+                    slots = []
+                # batch whatever else is already queued
+                while len(slots) < len(self.batch):
+                    try:
+                        slots.append(self.queued.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in slots:
+                    done = True
+                    slots = [s for s in slots if s is not None]
+                if slots:
+                    self.write(slots)
+                if done or time.time() - last_flush > self.flush_interval:
+                    self.h5_group.file.flush()
+                    last_flush = time.time()
+        except Exception as err:
+            self.error = err
+
+    def write(self, slots):
+        t0 = time.time()
+        n = len(slots)
+        n0, n1 = self.n_written, self.n_written + n
+        batch = self.batch[:n]
+        np.take(self.slots, slots, axis=0, out=batch)
+        for ds in (self.frames_h5, self.frame_index_h5, self.frame_time_h5, self.count_rate_h5):
+            ds.resize(n1, axis=0)
+        self.frames_h5[n0:n1] = batch
+        self.frame_index_h5[n0:n1] = self.slot_index[slots]
+        self.frame_time_h5[n0:n1] = self.slot_time[slots]
+        self.count_rate_h5[n0:n1] = self.slot_count_rate[slots]
+        for slot in slots:
+            self.free_slots.put(slot)
+        self.n_written = n1
+        self.write_time += time.time() - t0
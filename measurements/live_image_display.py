@@ -0,0 +1,98 @@
+import numpy as np
+import pyqtgraph as pg
+
+
+def block_max(frame, step):
+    """maximum of the step x step blocks of frame (NaN only where a whole
+    block is NaN), the last blocks may be smaller"""
+    if step <= 1:
+        return frame
+    # step strided passes per axis instead of a reshape, the small block
+    # axis would be the innermost loop
+    rows = frame[::step].copy()
+    for s in range(1, step):
+        part = frame[s::step]
+        np.fmax(rows[:len(part)], part, out=rows[:len(part)])
+    blocks = rows[:, ::step].copy()
+    for s in range(1, step):
+        part = rows[:, s::step]
+        n = part.shape[1]
+        np.fmax(blocks[:, :n], part, out=blocks[:, :n])
+    return blocks
+
+
+class LiveImageDisplay(object):
+    """
+    Renders frames (Ny, Nx) into a pg.ImageItem with a HistogramLUTItem at a
+    GUI cost that does not grow with the sensor size:
+
+    - the frame is reduced to about the resolution of the viewport by the
+      maximum of step x step blocks (like pyqtgraph's downsample, but
+      narrow lines and single bright pixels stay visible), into a display
+      buffer that is reused
+    - auto levels are min/max of a strided subsample of about
+      max_level_samples pixels
+    - the image keeps its pixel coordinates (setRect), so zooming,
+      lines and ROIs are not affected by the decimation
+
+    Redraws only happen when render() gets a new frame_id (dirty tracking),
+    or force=True.
+    """
+
+    def __init__(self, img_item, hist_lut=None, max_level_samples=2**16):
+        self.img_item = img_item
+        self.hist_lut = hist_lut
+        self.max_level_samples = max_level_samples
+        self.frame_id = None
+        self.buf = None
+        self.rect = None
+
+    def decimation(self, shape):
+        """data pixels per screen pixel of the view (>=1)"""
+        vb = self.img_item.getViewBox()
+        if vb is None:
+            return 1
+        view = vb.viewRect()
+        w, h = vb.width(), vb.height()
+        if w < 1 or h < 1:
+            return 1
+        # visible part of the image only, zoomed in views get full resolution
+        vis_w = min(view.width(), shape[1])
+        vis_h = min(view.height(), shape[0])
+        return max(1, int(min(vis_w/w, vis_h/h)))
+
+    def render(self, frame, frame_id=None, force=False):
+        """displays frame (transposed, x = columns) unless frame_id was
+        already rendered. Returns True if the image was updated"""
+        if not force and frame_id is not None and frame_id == self.frame_id:
+            return False
+        self.frame_id = frame_id
+
+        step = self.decimation(frame.shape)
+        src = block_max(frame, step)
+        if self.buf is None or self.buf.shape != src.shape:
+            self.buf = np.zeros(src.shape, dtype=np.float32)
+        np.copyto(self.buf, src)
+
+        lo, hi = self.auto_levels(self.buf)
+        self.img_item.setImage(self.buf.T, autoLevels=False, levels=(lo, hi))
+        # the scale of the image item depends on the decimation, a partial
+        # last block is drawn full size
+        rect = (self.buf.shape[1]*step, self.buf.shape[0]*step)
+        if rect != self.rect:
+            self.rect = rect
+            self.img_item.setRect(pg.QtCore.QRectF(0, 0, rect[0], rect[1]))
+        if self.hist_lut is not None:
+            # pyqtgraph histograms a subsample of the (decimated) image
+            self.hist_lut.imageChanged(autoLevel=False, autoRange=True)
+        return True
+
+    def auto_levels(self, img):
+        stride = max(1, int(np.ceil(np.sqrt(img.size/self.max_level_samples))))
+        sample = img[::stride, ::stride]
+        lo, hi = np.nanmin(sample), np.nanmax(sample)
+        if not np.isfinite(lo) or not np.isfinite(hi):
+            return 0., 1.
+        if hi <= lo:
+            hi = lo + 1
+        return float(lo), float(hi)
@@ -0,0 +1,296 @@
+import threading
+import queue
+import time
+import zlib
+import numpy as np
+
+
+def scan_chunks(scan_shape, pixel_shape=(), itemsize=8, layout='line', block_lines=1,
+                chunk_bytes=2**18):
+    """
+    Chunk shape of a scan dataset of shape scan_shape (K, Nv, Nh) + pixel_shape.
+
+    line      (1, block_lines, Nh) + pixel_shape, whole scan lines
+    balanced  (1, t, t) spatial tiles with b bands (last pixel axis) of about
+              chunk_bytes, with t*t = b: reading a pixel spectrum reads t*t
+              times the data it needs, reading a band image b times, so
+              neither access pattern is much slower than the other
+    """
+    K, Nv, Nh = scan_shape
+    pixel_shape = tuple(pixel_shape)
+    if layout == 'line':
+        return (1, min(block_lines, Nv), Nh) + pixel_shape
+    if layout != 'balanced':
+        raise ValueError("unknown layout {}".format(layout))
+    n = max(1, chunk_bytes//(itemsize*int(np.prod(pixel_shape[:-1], dtype=int))))
+    if pixel_shape:
+        b = int(min(pixel_shape[-1], max(1, round(np.sqrt(n)))))
+    else:
+        b = 1
+    # tiles are widened along h where the scan has fewer lines than t
+    t = max(1, int(np.sqrt(n//b)))
+    rows = min(t, Nv)
+    cols = min(Nh, max(t, n//(b*rows)))
+    # same number of chunks, split evenly, less padding in the edge chunks
+    even = lambda size, c: -(-size//(-(-size//c)))
+    chunks = (1, even(Nv, rows), even(Nh, cols)) + pixel_shape[:-1]
+    if pixel_shape:
+        chunks += (even(pixel_shape[-1], b),)
+    return chunks
+
+
+class ScanBlockWriter(object):
+    """
+    Buffers the per pixel data of a slow scan in memory and writes it to
+    HDF5 one block of chunk rows at a time.
+
+    The scan datasets have the scan shape (K, Nv, Nh) followed by the
+    shape of the per pixel data, with chunks from scan_chunks(). Pixels
+    are set through the objects returned by create_dataset(), with the
+    same indexing as an h5py dataset:
+
+        signal_map = writer.create_dataset('signal_map', pixel_shape=(1600,))
+        signal_map[k, j, i] = signal
+
+    When a pixel of another block of chunk rows arrives, the current block
+    is written with one hyperslab write and the file is flushed. Pixels
+    that were never set keep the fill value (nan for float data).
+
+    With compression='gzip' the blocks are handed to a worker thread that
+    compresses every chunk (shuffle + deflate, zlib releases the GIL) and
+    stores it with write_direct_chunk, so compression does not hold up
+    the scan. Write and flush times of every block are saved as
+    io_write_time and io_flush_time by close().
+    """
+
+    def __init__(self, h5_group, scan_shape, block_lines=1, layout='line',
+                 compression=None, compression_level=4, chunk_bytes=2**18):
+        self.h5_group = h5_group
+        self.scan_shape = tuple(scan_shape)
+        self.block_lines = max(1, int(block_lines))
+        self.layout = layout
+        self.compression = compression
+        self.compression_level = compression_level
+        self.chunk_bytes = chunk_bytes
+        self.datasets = []
+        self.write_times = []
+        self.flush_times = []
+        self.error = None
+        if compression not in (None, 'gzip'):
+            raise ValueError("unsupported compression {}".format(compression))
+        self.queued = None
+        if compression:
+            self.queued = queue.Queue()
+            self.worker = threading.Thread(target=self.run_worker, name='ScanBlockWriter')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def create_dataset(self, name, pixel_shape=(), dtype=float, layout=None):
+        """creates name in h5_group, returns the object to set pixels with.
+        layout (default: the layout of the writer) see scan_chunks()"""
+        pixel_shape = tuple(pixel_shape)
+        dtype = np.dtype(dtype)
+        chunks = scan_chunks(self.scan_shape, pixel_shape, dtype.itemsize,
+                             layout or self.layout, self.block_lines, self.chunk_bytes)
+        fillvalue = np.nan if dtype.kind in 'fc' else 0
+        kw = {}
+        if self.compression:
+            kw = dict(compression=self.compression, compression_opts=self.compression_level,
+                      shuffle=True)
+        ds = self.h5_group.create_dataset(name, shape=self.scan_shape + pixel_shape, dtype=dtype,
+                                          chunks=chunks, fillvalue=fillvalue, **kw)
+        dset = _BlockDataset(self, ds, fillvalue, n_buffers=2 if self.compression else 1)
+        self.datasets.append(dset)
+        return dset
+
+    def write(self, dset, k, j0, n, buf):
+        """writes rows j0..j0+n of buf (a block of dset), in the worker if any"""
+        if self.queued is not None:
+            if self.error is not None:
+                raise self.error
+            self.queued.put((dset, k, j0, n, buf))
+        else:
+            self._write(dset, k, j0, n, buf)
+
+    def _write(self, dset, k, j0, n, buf):
+        t0 = time.perf_counter()
+        if self.compression:
+            self.write_compressed(dset, k, j0, n, buf)
+        else:
+            dset.ds[k, j0:j0+n] = buf[:n]
+        t1 = time.perf_counter()
+        self.h5_group.file.flush()
+        self.write_times.append(t1 - t0)
+        self.flush_times.append(time.perf_counter() - t1)
+        dset.release(buf)
+
+    def write_compressed(self, dset, k, j0, n, buf):
+        """shuffles and deflates the chunks of the block like the HDF5
+        filters would, and writes them as they are"""
+        ds = dset.ds
+        chunk = ds.chunks[1:]
+        itemsize = ds.dtype.itemsize
+        grid = [range(0, s, c) for s, c in zip(ds.shape[2:], chunk[1:])]
+        tmp = np.empty(chunk, dtype=ds.dtype)
+        for offset in np.ndindex(*[len(g) for g in grid]):
+            start = [g[o] for g, o in zip(grid, offset)]
+            src = buf[(slice(0, n),) + tuple(slice(s, s + c) for s, c in zip(start, chunk[1:]))]
+            if src.shape != chunk:
+                # edge chunks are stored whole
+                tmp.fill(dset.fillvalue)
+                tmp[tuple(slice(0, s) for s in src.shape)] = src
+                src = tmp
+            shuffled = np.ascontiguousarray(src).view(np.uint8).reshape(-1, itemsize).T.tobytes()
+            ds.id.write_direct_chunk((k, j0) + tuple(start),
+                                     zlib.compress(shuffled, self.compression_level))
+
+    def run_worker(self):
+        while True:
+            item = self.queued.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self._write(*item)
+            except Exception as err:
+                self.error = err
+                item[0].release(item[4])
+            finally:
+                self.queued.task_done()
+
+    def wait(self):
+        """waits until the queued blocks are written"""
+        if self.queued is not None:
+            self.queued.join()
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        """writes the buffered blocks and the io timings (the file is left open)"""
+        try:
+            for dset in self.datasets:
+                dset.commit()
+            self.wait()
+        finally:
+            if self.queued is not None:
+                self.queued.put(None)
+                self.worker.join()
+        self.h5_group['io_write_time'] = np.array(self.write_times)
+        self.h5_group['io_flush_time'] = np.array(self.flush_times)
+
+
+class _BlockDataset(object):
+    """one scan dataset, buffered one block of chunk rows at a time"""
+
+    def __init__(self, writer, ds, fillvalue, n_buffers=1):
+        self.writer = writer
+        self.ds = ds
+        self.fillvalue = fillvalue
+        self.rows = ds.chunks[1]
+        self.round = ds.dtype.kind in 'iu'
+        # buffers not in use by the writer
+        self.free = queue.Queue()
+        for i in range(n_buffers):
+            self.free.put(np.full((self.rows,) + ds.shape[2:], fillvalue, dtype=ds.dtype))
+        self.buf = self.free.get()
+        self.block = None # (k, block index) of the buffered rows
+        self.written_blocks = set()
+
+    @property
+    def shape(self):
+        return self.ds.shape
+
+    def __setitem__(self, index, value):
+        k, j, i = index
+        block = (k, j//self.rows)
+        if block != self.block:
+            self.commit()
+            self.start_block(block)
+        if self.round:
+            value = np.rint(value)
+        self.buf[j - block[1]*self.rows, i] = value
+
+    def start_block(self, block):
+        self.block = block
+        if block in self.written_blocks:
+            # revisited, keep what is already in the file
+            self.writer.wait()
+            k, b = block
+            rows = self.ds[k, b*self.rows:(b + 1)*self.rows]
+            self.buf[:len(rows)] = rows
+
+    def commit(self):
+        """hands the buffered block to the writer"""
+        if self.block is None:
+            return
+        k, b = self.block
+        j0 = b*self.rows
+        self.writer.write(self, k, j0, min(self.rows, self.ds.shape[1] - j0), self.buf)
+        self.written_blocks.add(self.block)
+        self.block = None
+        # waits for the writer when all buffers are queued
+        self.buf = self.free.get()
+
+    def release(self, buf):
+        buf.fill(self.fillvalue)
+        self.free.put(buf)
+
+
+# (dtype, layout, compression) compared by benchmark()
+BENCHMARK_POLICIES = (
+    ('float64', 'line', None),
+    ('float32', 'line', None),
+    ('float32', 'balanced', None),
+    ('float32', 'balanced', 'gzip'),
+    ('int32', 'balanced', 'gzip'),
+)
+
+def benchmark(scan_shape=(1, 64, 64), n_bands=1600, n_reads=20):
+    """writes a spectral map with each policy and reads back a pixel
+    spectrum, a band image and a 8x8 pixel region. Returns a list of
+    (policy, us per pixel in the scan thread, MB/s incl. the worker,
+    file MB, {access: read ms})"""
+    import os, tempfile, h5py
+    K, Nv, Nh = scan_shape
+    rng = np.random.default_rng(0)
+    # averaged counts: smooth spectra plus noise
+    wl = np.linspace(0, 1, n_bands)
+    signals = (1000 + 500*np.sin(10*wl) + rng.normal(0, 20, size=(Nv, Nh, n_bands))).astype(np.float32)
+    fname = os.path.join(tempfile.mkdtemp(), 'scan_writer_benchmark.h5')
+    results = []
+    for dtype, layout, compression in BENCHMARK_POLICIES:
+        with h5py.File(fname, 'w') as f:
+            t0 = time.perf_counter()
+            writer = ScanBlockWriter(f, scan_shape, layout=layout, compression=compression)
+            signal_map = writer.create_dataset('signal_map', (n_bands,), dtype)
+            for k in range(K):
+                for j in range(Nv):
+                    for i in range(Nh):
+                        signal_map[k, j, i] = signals[j, i]
+            t_scan = time.perf_counter() - t0
+            writer.close()
+            t_total = time.perf_counter() - t0
+        mb = K*Nv*Nh*n_bands*np.dtype(dtype).itemsize/2**20
+        reads = {}
+        with h5py.File(fname, 'r') as f:
+            ds = f['signal_map']
+            for access, func in (
+                    ('spectrum', lambda j, i, b: ds[0, j, i]),
+                    ('band', lambda j, i, b: ds[0, :, :, b]),
+                    ('region', lambda j, i, b: ds[0, j:j+8, i:i+8])):
+                t0 = time.perf_counter()
+                for r in range(n_reads):
+                    func(rng.integers(Nv - 8), rng.integers(Nh - 8), rng.integers(n_bands))
+                reads[access] = 1e3*(time.perf_counter() - t0)/n_reads
+        results.append(((dtype, layout, compression), 1e6*t_scan/(K*Nv*Nh), mb/t_total,
+                        os.path.getsize(fname)/2**20, reads))
+    return results
+
+
+if __name__ == '__main__':
+    print("64x64 scan, 1600 bands: scan thread us/pixel, write MB/s (uncompressed),"
+          " file MB, read latency ms")
+    for policy, us, rate, size, reads in benchmark():
+        print("{:8s} {:9s} {:5s} {:6.1f} us {:6.1f} MB/s {:5.1f} MB  ".format(
+            policy[0], policy[1], str(policy[2]), us, rate, size)
+            + "  ".join("{} {:.2f}".format(k, v) for k, v in reads.items()))
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def sweep_order(center_wls, gratings=None, current_grating=None, current_wl=None):
+    """
+    Order of a sweep over center_wls for each of gratings, as a list of
+    (grating, wl_index) pairs.
+
+    Grating changes are slow, so every grating is visited once, the current
+    grating first. The wavelengths are swept alternately up and down, so
+    each sweep starts near where the previous one ended, the first one at
+    the end closest to current_wl.
+    """
+    center_wls = np.asarray(center_wls)
+    if not gratings:
+        gratings = [current_grating]
+    gratings = list(gratings)
+    if current_grating in gratings:
+        gratings.remove(current_grating)
+        gratings.insert(0, current_grating)
+    up = np.argsort(center_wls, kind='stable')
+    ascending = True
+    if current_wl is not None and len(center_wls):
+        ascending = abs(center_wls[up[0]] - current_wl) <= abs(center_wls[up[-1]] - current_wl)
+    order = []
+    for grating in gratings:
+        order.extend((grating, int(i)) for i in (up if ascending else up[::-1]))
+        ascending = not ascending
+    return order
+
+
+class SpectrometerMover(object):
+    """
+    Moves a spectrometer (center_wl and grating_id settings of spec_hw)
+    in a worker thread, so the caller can keep acquiring and processing.
+    move() returns a future whose result() is the actual center_wl
+    reached, as re-read by the hardware component.
+    """
+
+    def __init__(self, spec_hw):
+        self.spec_hw = spec_hw
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def move(self, center_wl, grating_id=None):
+        return self.executor.submit(self._move, center_wl, grating_id)
+
+    def _move(self, center_wl, grating_id):
+        S = self.spec_hw.settings
+        if grating_id is not None and grating_id != S['grating_id']:
+            S['grating_id'] = grating_id
+        S['center_wl'] = center_wl
+        return S['center_wl']
+
+    def close(self):
+        """waits for the last move"""
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    wls = np.arange(400, 701, 100.)
+    for grating, i in sweep_order(wls, gratings=[1, 2, 3], current_grating=2, current_wl=690):
+        print(grating, wls[i])